@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # Add this first
+    # Before anything that reads or changes the response body
+    'core.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +87,18 @@ DATABASES = {
     }
 }
 
+# Bills, splits and settlements can be spread over CORE_SHARDS extra
+# databases, see core/sharding.py. Each one needs `migrate --database shard_N`
+# and `rebalance_shards --all` to bring the existing data over.
+CORE_SHARDS = int(os.environ.get('CORE_SHARDS', '0'))
+for shard in range(CORE_SHARDS):
+    DATABASES[f'shard_{shard}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'shard_{shard}.sqlite3',
+    }
+
+DATABASE_ROUTERS = ['core.sharding.ShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -134,8 +149,64 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # JSON encoded by orjson when installed, see core/renderers.py
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Requests cost their view's throttle_cost out of this per-user budget,
+    # see core/throttling.py
+    'DEFAULT_THROTTLE_CLASSES': [
+        'core.throttling.CostRateThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'user_cost': os.environ.get('CORE_THROTTLE_RATE', '600/min'),
+    },
 }
 
+# Brotli responses (core/middleware.py) need the brotli package and this
+# flag: unlike gzip they get no random padding against BREACH
+CORE_BROTLI = os.environ.get('CORE_BROTLI', '') == '1'
+
+# Throttle buckets and coalesced results live in the default cache, private
+# to each process unless CORE_REDIS_URL gives every process the same Redis
+CORE_REDIS_URL = os.environ.get('CORE_REDIS_URL')
+if CORE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CORE_REDIS_URL,
+        }
+    }
+
+# How overlapping identical requests to expensive views share one computation,
+# see core/coalescing.py: LocalFlights within a process, CacheFlights across
+# the processes sharing the cache
+CORE_COALESCING = os.environ.get(
+    'CORE_COALESCING', 'core.coalescing.CacheFlights' if CORE_REDIS_URL else 'core.coalescing.LocalFlights'
+)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'kv': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'kv'},
+    },
+    'loggers': {
+        # Debug records are skipped before formatting unless this is DEBUG
+        'core': {'handlers': ['console'], 'level': os.environ.get('CORE_LOG_LEVEL', 'INFO')},
+    },
+}
+
+# Reminder emails from send_reminders --deliver; in development they are
+# written to files under EMAIL_FILE_PATH instead of being sent
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.filebased.EmailBackend')
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH', BASE_DIR / 'sent_mail')
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'EvenSplit <noreply@evensplit.local>')
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # React development server
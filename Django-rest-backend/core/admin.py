@@ -1,3 +1,310 @@
-from django.contrib import admin
+from contextlib import nullcontext
 
-# Register your models here.
+from django.contrib import admin, messages
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max
+from django.http import HttpResponseRedirect
+from django.utils.functional import cached_property
+
+from .models import Bill, BillSplit, Friend, FxRate, Group, Settlement
+from .sharding import (
+    ID_STRIDE, SHARDS, ShardMoving, fan_out, home_shard, on_shard, shard_for_bill, shard_for_user,
+)
+from .tasks import refresh_snapshots_later
+
+# Lists count exactly up to this many rows, past it they settle for an estimate
+COUNT_LIMIT = 10000
+
+
+def estimated_rows(queryset):
+    # Row count of the queryset's whole table without scanning it
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            # -1 until the table was first analyzed
+            if row and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+                [table],
+            )
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                return row[0]
+    # Elsewhere the highest id, read off the primary key index
+    last = queryset.model._default_manager.using(queryset.db).aggregate(last=Max('pk'))['last'] or 0
+    return last // ID_STRIDE if queryset.db in SHARDS else last
+
+
+class EstimatedCountPaginator(Paginator):
+    # COUNT(*) is a full scan on big tables: count up to COUNT_LIMIT rows and
+    # past that use the table estimate (unfiltered lists) or the limit itself
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        counted = queryset.order_by()[:COUNT_LIMIT + 1].count()
+        if counted <= COUNT_LIMIT:
+            return counted
+        if not queryset.query.where:
+            return max(estimated_rows(queryset), counted)
+        return counted
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Skips the second COUNT(*) of the unfiltered table behind "N total"
+    show_full_result_count = False
+    list_per_page = 50
+
+
+@admin.action(description='Rebuild cached balances of the users involved')
+def rebuild_balances(modeladmin, request, queryset):
+    # Queued, one deduplicated job per user, like the writes in the API do
+    user_ids = set(modeladmin.involved_users(queryset))
+    refresh_snapshots_later(sorted(user_ids))
+    modeladmin.message_user(request, f'Queued a balance rebuild for {len(user_ids)} users.', messages.SUCCESS)
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    # Which shard's rows the list shows; the view is pinned to it, see
+    # ShardedAdmin.changelist_view
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in SHARDS]
+
+    def choices(self, changelist):
+        current = self.value() or SHARDS[0]
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': current == alias,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ShardedAdmin(ScalableAdmin):
+    # Bills, splits and settlements live on one shard each (core/sharding.py).
+    # Every view runs pinned to the shard holding the rows it works on, so
+    # reads, form validation and saves all go there.
+    # Set when the row is added only: changing them moves or re-prices every
+    # split of the row
+    fixed_fields = ()
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly = super().get_readonly_fields(request, obj)
+        return (*readonly, *self.fixed_fields) if obj is not None else readonly
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        return [ShardListFilter, *list_filter] if SHARDS else list_filter
+
+    def locate(self, object_id):
+        # Shard holding the object, or None
+        object_id = _int(object_id)
+        if object_id is None:
+            return None
+        found = fan_out(lambda: self.model.objects.filter(pk=object_id).exists())
+        return next((alias for alias, exists in zip(SHARDS, found) if exists), None)
+
+    def shard_for_new(self, request):
+        # Where an object posted to the add form goes
+        return SHARDS[0]
+
+    def check_writable(self, alias, object_id):
+        # Raises ShardMoving while the object's rows are being moved
+        pass
+
+    def _pinned(self, request, object_id=None):
+        if not SHARDS:
+            return nullcontext()
+        if object_id is None:
+            alias = self.shard_for_new(request) if request.method == 'POST' else SHARDS[0]
+        else:
+            alias = self.locate(object_id) or SHARDS[0]
+            if request.method == 'POST':
+                self.check_writable(alias, object_id)
+        return on_shard(alias)
+
+    def _refuse_moving(self, request, exc):
+        self.message_user(request, str(exc.detail), messages.ERROR)
+        return HttpResponseRedirect(request.path)
+
+    def changelist_view(self, request, extra_context=None):
+        if not SHARDS:
+            return super().changelist_view(request, extra_context)
+        alias = request.GET.get('shard')
+        with on_shard(alias if alias in SHARDS else SHARDS[0]):
+            return super().changelist_view(request, extra_context)
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        try:
+            pinned = self._pinned(request, object_id)
+        except ShardMoving as exc:
+            return self._refuse_moving(request, exc)
+        with pinned:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+    def delete_view(self, request, object_id, extra_context=None):
+        try:
+            pinned = self._pinned(request, object_id)
+        except ShardMoving as exc:
+            return self._refuse_moving(request, exc)
+        with pinned:
+            return super().delete_view(request, object_id, extra_context)
+
+    def history_view(self, request, object_id, extra_context=None):
+        with on_shard(self.locate(object_id) or SHARDS[0]) if SHARDS else nullcontext():
+            return super().history_view(request, object_id, extra_context)
+
+
+@admin.register(Bill)
+class BillAdmin(ShardedAdmin):
+    list_display = ('id', 'desc', 'amount', 'currency', 'category', 'split_type', 'created_by', 'group', 'created_at')
+    list_select_related = ('created_by', 'group')
+    list_filter = ('category', 'split_type', 'currency', ('created_at', admin.DateFieldListFilter), 'is_recurring')
+    # Exact id or description prefix, never a leading-wildcard LIKE
+    search_fields = ('=id', 'desc__startswith')
+    autocomplete_fields = ('created_by', 'participants', 'group')
+    ordering = ('-created_at',)
+    actions = [rebuild_balances]
+    fixed_fields = ('created_by', 'currency', 'fx_rate')
+
+    def involved_users(self, queryset):
+        yield from queryset.values_list('created_by_id', flat=True)
+        participants = Bill.participants.through.objects.filter(bill__in=queryset.values('pk'))
+        yield from participants.values_list('user_id', flat=True)
+
+    def shard_for_new(self, request):
+        return home_shard(_int(request.POST.get('group')), _int(request.POST.get('created_by')), for_write=True)
+
+    def check_writable(self, alias, object_id):
+        shard_for_bill(object_id, for_write=True)
+
+
+@admin.register(BillSplit)
+class BillSplitAdmin(ShardedAdmin):
+    list_display = ('id', 'bill', 'user', 'amount')
+    list_select_related = ('bill', 'bill__created_by', 'user')
+    list_filter = ('bill__category',)
+    search_fields = ('=bill__id',)
+    raw_id_fields = ('bill',)
+    autocomplete_fields = ('user',)
+    ordering = ('-id',)
+    actions = [rebuild_balances]
+
+    def involved_users(self, queryset):
+        for user_id, creator_id in queryset.values_list('user_id', 'bill__created_by_id'):
+            yield user_id
+            yield creator_id
+
+    def shard_for_new(self, request):
+        return shard_for_bill(request.POST.get('bill'), for_write=True) or SHARDS[0]
+
+    def check_writable(self, alias, object_id):
+        with on_shard(alias):
+            bill_id = BillSplit.objects.filter(pk=object_id).values_list('bill_id', flat=True).first()
+        shard_for_bill(bill_id, for_write=True)
+
+
+@admin.register(Settlement)
+class SettlementAdmin(ShardedAdmin):
+    list_display = ('id', 'payer', 'payee', 'amount', 'currency', 'bill', 'created_at')
+    list_select_related = ('payer', 'payee', 'bill', 'bill__created_by')
+    list_filter = (('created_at', admin.DateFieldListFilter),)
+    search_fields = ('=id', '=idempotency_key')
+    raw_id_fields = ('bill',)
+    autocomplete_fields = ('payer', 'payee')
+    ordering = ('-created_at',)
+    actions = [rebuild_balances]
+    fixed_fields = ('currency', 'fx_rate')
+
+    def involved_users(self, queryset):
+        for payer_id, payee_id in queryset.values_list('payer_id', 'payee_id'):
+            yield payer_id
+            yield payee_id
+
+    def _home(self, bill_id, payer_id):
+        if bill_id is not None:
+            return shard_for_bill(bill_id, for_write=True)
+        return shard_for_user(payer_id, for_write=True)
+
+    def shard_for_new(self, request):
+        return self._home(_int(request.POST.get('bill')), _int(request.POST.get('payer'))) or SHARDS[0]
+
+    def check_writable(self, alias, object_id):
+        with on_shard(alias):
+            row = Settlement.objects.filter(pk=object_id).values_list('bill_id', 'payer_id').first()
+        if row is not None:
+            self._home(*row)
+
+
+@admin.register(Group)
+class GroupAdmin(ScalableAdmin):
+    list_display = ('id', 'name', 'created_by', 'created_at')
+    list_select_related = ('created_by',)
+    list_filter = (('created_at', admin.DateFieldListFilter),)
+    search_fields = ('=id', 'name__startswith')
+    autocomplete_fields = ('created_by', 'members')
+    ordering = ('-id',)
+    actions = [rebuild_balances]
+
+    def involved_users(self, queryset):
+        members = Group.members.through.objects.filter(group__in=queryset.values('pk'))
+        return members.values_list('user_id', flat=True)
+
+
+@admin.register(Friend)
+class FriendAdmin(ScalableAdmin):
+    list_display = ('id', 'user', 'friend', 'created_at')
+    list_select_related = ('user', 'friend')
+    list_filter = (('created_at', admin.DateFieldListFilter),)
+    search_fields = ('=user__username', '=friend__username')
+    autocomplete_fields = ('user', 'friend')
+    ordering = ('-id',)
+    actions = [rebuild_balances]
+
+    def involved_users(self, queryset):
+        for user_id, friend_id in queryset.values_list('user_id', 'friend_id'):
+            yield user_id
+            yield friend_id
+
+
+@admin.register(FxRate)
+class FxRateAdmin(ScalableAdmin):
+    # Filled by the import_fx_rates command; a bill keeps the rate it was created with
+    list_display = ('currency', 'date', 'rate', 'imported_at')
+    list_filter = ('currency',)
+    search_fields = ('=currency',)
+    date_hierarchy = 'date'
+    ordering = ('-date', 'currency')
+
+
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class CoreUserAdmin(UserAdmin, ScalableAdmin):
+    actions = [rebuild_balances]
+
+    def involved_users(self, queryset):
+        return queryset.values_list('pk', flat=True)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Registers the background job handlers and the signal receivers
+        # feeding the event ledger, the budget totals, the social graph and the shards
+        from . import budgets, events, sharding, social, tasks  # noqa: F401
@@ -0,0 +1,247 @@
+from collections import defaultdict
+from decimal import Decimal
+from itertools import groupby
+
+from django.contrib.auth.models import User
+from django.db.models import Count, F, Max, Sum
+from django.db.models.functions import TruncMonth
+
+from .balances import SPLIT_VALUE, group_positions, pair_balances, spending_rollup
+from .currency import base_value
+from .events import suppress_ledger_events
+from .models import (
+    ArchivedBill, ArchivedBillSplit, ArchivedDebt, ArchivedGroupRollup, ArchivedSettlement,
+    ArchivedSpending, Bill, BillSplit, Settlement,
+)
+
+# Bills younger than this stay hot so the 30/60 day trends in AnalyticsView
+# and InsightsView never need the archive
+MIN_ARCHIVE_AGE_DAYS = 60
+
+CENT = Decimal('0.01')
+
+
+# A split is covered once the debtor's settlements to the bill creator, applied
+# oldest bill first, reach it. A bill is closed when every split on it that
+# isn't the creator's own share is covered.
+
+def closed_bill_ids(cutoff):
+    settled = dict(
+        ((payer_id, payee_id), total)
+        for payer_id, payee_id, total in
+        Settlement.objects.values_list('payer_id', 'payee_id').annotate(total=Sum(base_value())).order_by()
+    )
+    # Hot settlements already used up by splits that were archived earlier
+    consumed = dict(
+        ((debtor_id, creditor_id), owed - paid)
+        for debtor_id, creditor_id, owed, paid in
+        ArchivedDebt.objects.values_list('debtor_id', 'creditor_id', 'owed', 'paid')
+    )
+
+    splits = (
+        BillSplit.objects
+        .exclude(user=F('bill__created_by'))
+        .order_by('user_id', 'bill__created_by', 'bill__created_at', 'bill_id')
+        .values_list('user_id', 'bill__created_by', 'bill_id', SPLIT_VALUE)
+        .iterator(chunk_size=2000)
+    )
+    uncovered = set()
+    for pair, rows in groupby(splits, key=lambda row: row[:2]):
+        available = settled.get(pair, Decimal('0')) - consumed.get(pair, Decimal('0'))
+        cumulative = Decimal('0')
+        for _, _, bill_id, amount in rows:
+            cumulative += amount
+            if cumulative > available:
+                uncovered.add(bill_id)
+
+    candidates = Bill.objects.filter(created_at__lt=cutoff).order_by('id').values_list('id', flat=True)
+    return [bill_id for bill_id in candidates.iterator(chunk_size=2000) if bill_id not in uncovered]
+
+
+def _accumulate(model, keys, rows):
+    # Add rows of {key fields..., value fields...} onto existing rollup rows
+    if not rows:
+        return
+    values = [field for field in rows[0] if field not in keys]
+    lookup = {tuple(row[key] for key in keys): row for row in rows}
+    existing = model.objects.filter(**{f'{keys[0]}__in': {row[keys[0]] for row in rows}})
+    updated = []
+    for obj in existing:
+        row = lookup.pop(tuple(getattr(obj, key) for key in keys), None)
+        if row is None:
+            continue
+        for field in values:
+            setattr(obj, field, getattr(obj, field) + row[field])
+        updated.append(obj)
+    model.objects.bulk_update(updated, values, batch_size=1000)
+    model.objects.bulk_create([model(**row) for row in lookup.values()], batch_size=1000)
+
+
+def archive_bills(bill_ids):
+    # Move one chunk of closed bills, their splits and linked settlements to
+    # the cold tables and fold them into the carry-forward rollups
+    bills = Bill.objects.filter(pk__in=bill_ids)
+    splits = BillSplit.objects.filter(bill_id__in=bill_ids)
+    settlements = Settlement.objects.filter(bill_id__in=bill_ids)
+    participants = Bill.participants.through.objects.filter(bill_id__in=bill_ids)
+
+    ArchivedBill.objects.bulk_create([
+        ArchivedBill(
+            id=bill.id, desc=bill.desc, amount=bill.amount, created_at=bill.created_at,
+            created_by_id=bill.created_by_id, split_type=bill.split_type,
+            group_id=bill.group_id, category=bill.category, currency=bill.currency, fx_rate=bill.fx_rate,
+        )
+        for bill in bills
+    ], batch_size=1000)
+    ArchivedBill.participants.through.objects.bulk_create([
+        ArchivedBill.participants.through(archivedbill_id=bill_id, user_id=user_id)
+        for bill_id, user_id in participants.values_list('bill_id', 'user_id')
+    ], batch_size=1000)
+    ArchivedBillSplit.objects.bulk_create([
+        ArchivedBillSplit(id=split_id, bill_id=bill_id, user_id=user_id, amount=amount)
+        for split_id, bill_id, user_id, amount in splits.values_list('id', 'bill_id', 'user_id', 'amount')
+    ], batch_size=1000)
+    settlement_count = archive_settlements(settlements)
+
+    owed = (
+        splits.exclude(user=F('bill__created_by'))
+        .values('user_id', 'bill__created_by')
+        .annotate(total=Sum(SPLIT_VALUE))
+        .order_by()
+    )
+    _accumulate(ArchivedDebt, ('debtor_id', 'creditor_id'), [
+        {'debtor_id': row['user_id'], 'creditor_id': row['bill__created_by'], 'owed': row['total'], 'paid': Decimal('0')}
+        for row in owed
+    ])
+
+    spending = (
+        participants
+        .annotate(month=TruncMonth('bill__created_at'))
+        .values('user_id', 'bill__category', 'month')
+        .annotate(total=Sum(base_value('bill__amount', 'bill__fx_rate')), count=Count('bill_id'))
+        .order_by()
+    )
+    _accumulate(ArchivedSpending, ('user_id', 'category', 'month'), [
+        {'user_id': row['user_id'], 'category': row['bill__category'], 'month': row['month'].date(),
+         'total': row['total'], 'count': row['count']}
+        for row in spending
+    ])
+
+    group_rollup = defaultdict(lambda: {'bill_count': 0, 'paid': Decimal('0'), 'share': Decimal('0')})
+    paid = (
+        bills.filter(group__isnull=False)
+        .values_list('group_id', 'created_by_id')
+        .annotate(count=Count('id'), total=Sum(base_value()))
+        .order_by()
+    )
+    for group_id, user_id, count, total in paid:
+        group_rollup[(group_id, user_id)]['bill_count'] += count
+        group_rollup[(group_id, user_id)]['paid'] += total
+    share = (
+        splits.filter(bill__group__isnull=False)
+        .values_list('bill__group', 'user_id')
+        .annotate(total=Sum(SPLIT_VALUE))
+        .order_by()
+    )
+    for group_id, user_id, total in share:
+        group_rollup[(group_id, user_id)]['share'] += total
+    _accumulate(ArchivedGroupRollup, ('group_id', 'user_id'), [
+        {'group_id': group_id, 'user_id': user_id, **row}
+        for (group_id, user_id), row in group_rollup.items()
+    ])
+
+    # Cascades to splits, participants and the settlements copied above.
+    # Archiving doesn't change any balance, so the ledger doesn't record it.
+    with suppress_ledger_events():
+        bills.delete()
+    return settlement_count
+
+
+def archive_settlements(settlements):
+    rows = list(settlements.values_list(
+        'id', 'payer_id', 'payee_id', 'amount', 'bill_id', 'created_at', 'currency', 'fx_rate',
+    ))
+    ArchivedSettlement.objects.bulk_create([
+        ArchivedSettlement(
+            id=settlement_id, payer_id=payer_id, payee_id=payee_id, amount=amount,
+            bill_id=bill_id, created_at=created_at, currency=currency, fx_rate=fx_rate,
+        )
+        for settlement_id, payer_id, payee_id, amount, bill_id, created_at, currency, fx_rate in rows
+    ], batch_size=1000)
+
+    # The rollups are in the base currency
+    paid = defaultdict(Decimal)
+    for _, payer_id, payee_id, amount, _, _, _, fx_rate in rows:
+        paid[(payer_id, payee_id)] += amount * fx_rate
+    _accumulate(ArchivedDebt, ('debtor_id', 'creditor_id'), [
+        {'debtor_id': payer_id, 'creditor_id': payee_id, 'owed': Decimal('0'), 'paid': total}
+        for (payer_id, payee_id), total in paid.items()
+    ])
+    with suppress_ledger_events():
+        Settlement.objects.filter(pk__in=[row[0] for row in rows]).delete()
+    return len(rows)
+
+
+def archive_consumed_settlements():
+    # Unlinked settlements, oldest first, as long as archived debt still covers them
+    archived = 0
+    open_debts = ArchivedDebt.objects.filter(owed__gt=F('paid')).values_list('debtor_id', 'creditor_id', 'owed', 'paid')
+    for debtor_id, creditor_id, owed, paid in list(open_debts):
+        remaining = owed - paid
+        chosen = []
+        candidates = (
+            Settlement.objects
+            .filter(payer_id=debtor_id, payee_id=creditor_id, bill__isnull=True)
+            .order_by('created_at', 'id')
+            .values_list('id', base_value())
+        )
+        for settlement_id, amount in candidates:
+            if amount > remaining:
+                break
+            remaining -= amount
+            chosen.append(settlement_id)
+        if chosen:
+            archive_settlements(Settlement.objects.filter(pk__in=chosen))
+            archived += len(chosen)
+    return archived
+
+
+def ledger_totals():
+    # Everything the balance, analytics and group views can report, computed
+    # from the hot tables plus the rollups
+    hi = (User.objects.aggregate(hi=Max('id'))['hi'] or 0) + 1
+    groups = defaultdict(lambda: [0, Decimal('0')])
+    for group_id, count, total in (
+        Bill.objects.filter(group__isnull=False).values_list('group_id')
+        .annotate(count=Count('id'), total=Sum(base_value())).order_by()
+    ):
+        groups[group_id][0] += count
+        groups[group_id][1] += total
+    for group_id, count, total in (
+        ArchivedGroupRollup.objects.values_list('group_id')
+        .annotate(count=Sum('bill_count'), total=Sum('paid')).order_by()
+    ):
+        groups[group_id][0] += count
+        groups[group_id][1] += total
+
+    # SQLite sums decimals as floats, so compare at the stored precision
+    def cents(value):
+        return value.quantize(CENT) if isinstance(value, Decimal) else value
+
+    return {
+        'balances': {key: cents(amount) for key, amount in pair_balances(0, hi).items() if cents(amount)},
+        'spending': {key: tuple(map(cents, row)) for key, row in spending_rollup(0, hi).items() if row[1]},
+        'positions': {key: tuple(map(cents, row)) for key, row in group_positions(0, hi).items() if any(map(cents, row))},
+        'groups': {key: tuple(map(cents, row)) for key, row in groups.items() if row[0]},
+    }
+
+
+def diff_totals(before, after):
+    # Keys whose values differ, per section
+    problems = {}
+    for section in before:
+        keys = set(before[section]) | set(after[section])
+        changed = sorted(key for key in keys if before[section].get(key) != after[section].get(key))
+        if changed:
+            problems[section] = changed
+    return problems
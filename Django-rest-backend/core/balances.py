@@ -0,0 +1,202 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
+
+from .currency import base_value
+from .models import ArchivedDebt, ArchivedGroupRollup, ArchivedSpending, Bill, BillSplit, Settlement
+from .sharding import fan_out
+
+
+# Set-based versions of the per-user loops in BalancesView / AnalyticsView.
+# Each helper takes an inclusive-exclusive user id range so callers can work
+# through the user table in chunks. Amounts are in the base currency.
+
+SPLIT_VALUE = base_value('amount', 'bill__fx_rate')
+
+def _hot_pair_balances(lo, hi, since=None):
+    # Bills (created at or after since, when given) and settlements on one
+    # shard, as [(user_id, other_id, amount)]
+    rows = []
+    splits = BillSplit.objects.all()
+    if since is not None:
+        splits = splits.filter(bill__created_at__gte=since)
+
+    # What users in range owe to bill creators
+    owed = (
+        splits
+        .filter(user_id__gte=lo, user_id__lt=hi)
+        .exclude(bill__created_by=F('user'))
+        .values_list('user_id', 'bill__created_by')
+        .annotate(total=Sum(SPLIT_VALUE))
+    )
+    rows.extend((user_id, other_id, -total) for user_id, other_id, total in owed)
+
+    # What others owe to users in range for bills they created
+    lent = (
+        splits
+        .filter(bill__created_by__gte=lo, bill__created_by__lt=hi)
+        .exclude(user=F('bill__created_by'))
+        .values_list('bill__created_by', 'user_id')
+        .annotate(total=Sum(SPLIT_VALUE))
+    )
+    rows.extend(lent)
+    if since is not None:
+        return rows
+
+    # Settlements paid reduce debt, settlements received reduce credit
+    paid = (
+        Settlement.objects
+        .filter(payer_id__gte=lo, payer_id__lt=hi)
+        .values_list('payer_id', 'payee_id')
+        .annotate(total=Sum(base_value()))
+    )
+    rows.extend(paid)
+
+    received = (
+        Settlement.objects
+        .filter(payee_id__gte=lo, payee_id__lt=hi)
+        .values_list('payee_id', 'payer_id')
+        .annotate(total=Sum(base_value()))
+    )
+    rows.extend((user_id, other_id, -total) for user_id, other_id, total in received)
+    return rows
+
+
+def pair_balances(lo, hi):
+    # {(user_id, other_id): amount} where a positive amount means other owes user
+    balances = defaultdict(Decimal)
+    for rows in fan_out(_hot_pair_balances, lo, hi):
+        for user_id, other_id, amount in rows:
+            balances[(user_id, other_id)] += amount
+
+    # Carry-forward of archived bills and settlements
+    debts = ArchivedDebt.objects.filter(debtor_id__gte=lo, debtor_id__lt=hi)
+    for user_id, other_id, owed, paid in debts.values_list('debtor_id', 'creditor_id', 'owed', 'paid'):
+        balances[(user_id, other_id)] += paid - owed
+    credits = ArchivedDebt.objects.filter(creditor_id__gte=lo, creditor_id__lt=hi)
+    for user_id, other_id, owed, paid in credits.values_list('creditor_id', 'debtor_id', 'owed', 'paid'):
+        balances[(user_id, other_id)] += owed - paid
+
+    return balances
+
+
+def recent_charges(lo, hi, since):
+    # {(user_id, other_id): amount} like pair_balances, counting only the
+    # splits of bills created at or after since
+    charges = defaultdict(Decimal)
+    for rows in fan_out(_hot_pair_balances, lo, hi, since):
+        for user_id, other_id, amount in rows:
+            charges[(user_id, other_id)] += amount
+    return charges
+
+
+def _hot_spending(lo, hi):
+    # One shard's [(user_id, category, month, total, count)]
+    return list(
+        Bill.objects
+        .filter(participants__id__gte=lo, participants__id__lt=hi)
+        .annotate(month=TruncMonth('created_at'))
+        .values_list('participants', 'category', 'month')
+        .annotate(total=Sum(base_value()), count=Count('id'))
+        .order_by()
+    )
+
+
+def spending_rollup(lo, hi):
+    # {(user_id, category, month): [total, count]} of bills each user took part in
+    rollup = defaultdict(lambda: [Decimal('0'), 0])
+
+    for rows in fan_out(_hot_spending, lo, hi):
+        for user_id, category, month, total, count in rows:
+            row = rollup[(user_id, category, month.date())]
+            row[0] += total
+            row[1] += count
+
+    archived = (
+        ArchivedSpending.objects
+        .filter(user_id__gte=lo, user_id__lt=hi)
+        .values_list('user_id', 'category', 'month', 'total', 'count')
+    )
+    for user_id, category, month, total, count in archived:
+        row = rollup[(user_id, category, month)]
+        row[0] += total
+        row[1] += count
+
+    return rollup
+
+
+def _hot_positions(lo, hi):
+    # One shard's ([(user_id, group_id, paid)], [(user_id, group_id, share)])
+    paid = (
+        Bill.objects
+        .filter(group__isnull=False, created_by__gte=lo, created_by__lt=hi)
+        .values_list('created_by', 'group')
+        .annotate(total=Sum(base_value()))
+        .order_by()
+    )
+    share = (
+        BillSplit.objects
+        .filter(bill__group__isnull=False, user_id__gte=lo, user_id__lt=hi)
+        .values_list('user_id', 'bill__group')
+        .annotate(total=Sum(SPLIT_VALUE))
+        .order_by()
+    )
+    return list(paid), list(share)
+
+
+def group_positions(lo, hi):
+    # {(user_id, group_id): [paid, share]} for group bills
+    positions = defaultdict(lambda: [Decimal('0'), Decimal('0')])
+
+    for paid, share in fan_out(_hot_positions, lo, hi):
+        for user_id, group_id, total in paid:
+            positions[(user_id, group_id)][0] += total
+        for user_id, group_id, total in share:
+            positions[(user_id, group_id)][1] += total
+
+    archived = (
+        ArchivedGroupRollup.objects
+        .filter(user_id__gte=lo, user_id__lt=hi)
+        .values_list('user_id', 'group_id', 'paid', 'share')
+    )
+    for user_id, group_id, paid, share in archived:
+        positions[(user_id, group_id)][0] += paid
+        positions[(user_id, group_id)][1] += share
+
+    return positions
+
+
+def _pair_activity(user_id, other_id):
+    splits = BillSplit.objects.filter(
+        Q(bill__created_by=user_id, user_id=other_id) | Q(bill__created_by=other_id, user_id=user_id)
+    ).aggregate(
+        lent=Sum(SPLIT_VALUE, filter=Q(bill__created_by=user_id)),
+        owed=Sum(SPLIT_VALUE, filter=Q(bill__created_by=other_id)),
+    )
+    settlements = Settlement.objects.filter(
+        Q(payer_id=user_id, payee_id=other_id) | Q(payer_id=other_id, payee_id=user_id)
+    ).aggregate(
+        paid=Sum(base_value(), filter=Q(payer_id=user_id)),
+        received=Sum(base_value(), filter=Q(payer_id=other_id)),
+    )
+    return (
+        (splits['lent'] or Decimal('0')) - (splits['owed'] or Decimal('0'))
+        + (settlements['paid'] or Decimal('0')) - (settlements['received'] or Decimal('0'))
+    )
+
+
+def pair_balance(user_id, other_id):
+    # Net balance of a single pair from user's side; positive means other owes user
+    archived = ArchivedDebt.objects.filter(
+        Q(debtor_id=user_id, creditor_id=other_id) | Q(debtor_id=other_id, creditor_id=user_id)
+    ).aggregate(
+        archived_owed=Sum(F('owed') - F('paid'), filter=Q(debtor_id=user_id)),
+        archived_lent=Sum(F('owed') - F('paid'), filter=Q(debtor_id=other_id)),
+    )
+    # The pair's bills and settlements can sit on any shard
+    return (
+        sum(fan_out(_pair_activity, user_id, other_id), Decimal('0'))
+        + (archived['archived_lent'] or Decimal('0')) - (archived['archived_owed'] or Decimal('0'))
+    )
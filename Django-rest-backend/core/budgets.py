@@ -0,0 +1,139 @@
+import logging
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .events import recording
+from .models import Bill, BillSplit, Budget, BudgetAlert, SpendingPeriod
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+
+
+def month_start(moment=None):
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def _threshold(limit, alert_at):
+    return (limit * alert_at / 100).quantize(CENT)
+
+
+def _record_alerts(user_id, category, month, amount):
+    # Alert when this change carried the period total across a threshold
+    budget = Budget.objects.filter(user_id=user_id, category=category).values_list('limit', 'alert_at').first()
+    if budget is None:
+        return
+    limit, alert_at = budget
+    total = SpendingPeriod.objects.filter(user_id=user_id, category=category, month=month).values_list('total', flat=True).get()
+    total = Decimal(str(total)).quantize(CENT)
+    previous = total - amount
+    for level, threshold in (('warning', _threshold(limit, alert_at)), ('over', limit)):
+        if previous < threshold <= total:
+            _, created = BudgetAlert.objects.get_or_create(
+                user_id=user_id, category=category, month=month, level=level,
+                defaults={'total': total, 'limit': limit},
+            )
+            if created:
+                logger.info('budget.alert user=%s category=%s month=%s level=%s total=%s', user_id, category, month, level, total)
+
+
+def add_spending(user_id, category, created_at, amount, count, fx_rate=1):
+    # O(1) running total update for one split, in the base currency
+    amount = (Decimal(str(amount)) * fx_rate).quantize(CENT)
+    month = month_start(created_at)
+    periods = SpendingPeriod.objects.filter(user_id=user_id, category=category, month=month)
+    if not periods.update(total=F('total') + amount, count=F('count') + count):
+        try:
+            with transaction.atomic():
+                SpendingPeriod.objects.create(user_id=user_id, category=category, month=month, total=amount, count=count)
+        except IntegrityError:
+            periods.update(total=F('total') + amount, count=F('count') + count)
+    if amount > 0:
+        _record_alerts(user_id, category, month, amount)
+
+
+def _bill(bill_id):
+    # (category, created_at, fx_rate); spending is kept in the base currency
+    return Bill.objects.filter(pk=bill_id).values_list('category', 'created_at', 'fx_rate').first()
+
+
+@receiver(pre_save, sender=Bill)
+def remember_category(sender, instance, **kwargs):
+    if not instance._state.adding and recording():
+        instance._budget_previous = sender.objects.filter(pk=instance.pk).values_list('category', flat=True).first()
+
+
+@receiver(post_save, sender=BillSplit)
+def split_saved(sender, instance, created, **kwargs):
+    if not recording():
+        return
+    # The row before an edit, loaded by the ledger's pre_save receiver
+    previous = getattr(instance, '_ledger_previous', None)
+    if previous is not None:
+        if (previous.user_id, previous.amount, previous.bill_id) == (instance.user_id, instance.amount, instance.bill_id):
+            return
+        bill = _bill(previous.bill_id)
+        if bill is not None:
+            add_spending(previous.user_id, bill[0], bill[1], -previous.amount, -1, bill[2])
+    bill = _bill(instance.bill_id)
+    if bill is not None:
+        add_spending(instance.user_id, bill[0], bill[1], instance.amount, 1, bill[2])
+
+
+@receiver(post_delete, sender=BillSplit)
+def split_deleted(sender, instance, **kwargs):
+    if not recording():
+        return
+    bill = _bill(instance.bill_id)
+    if bill is not None:
+        add_spending(instance.user_id, bill[0], bill[1], -instance.amount, -1, bill[2])
+
+
+@receiver(post_save, sender=Bill)
+def bill_saved(sender, instance, created, **kwargs):
+    # Recategorised bills take their splits' spending along
+    previous = getattr(instance, '_budget_previous', None)
+    if previous is None or previous == instance.category or not recording():
+        return
+    for user_id, amount in BillSplit.objects.filter(bill=instance).values_list('user_id', 'amount'):
+        add_spending(user_id, previous, instance.created_at, -amount, -1, instance.fx_rate)
+        add_spending(user_id, instance.category, instance.created_at, amount, 1, instance.fx_rate)
+
+
+def spent_this_month():
+    # Subquery annotation for Budget querysets: the current period's total
+    decimal = DecimalField(max_digits=14, decimal_places=2)
+    period = SpendingPeriod.objects.filter(
+        user=OuterRef('user'), category=OuterRef('category'), month=month_start()
+    ).values('total')[:1]
+    return Coalesce(Subquery(period, output_field=decimal), Value(Decimal('0'), output_field=decimal))
+
+
+def budget_status(spent, limit, alert_at):
+    if spent >= limit:
+        return 'over'
+    if spent >= _threshold(limit, alert_at):
+        return 'warning'
+    return 'ok'
+
+
+def budgets_over(month=None, level='warning'):
+    # Every budget at or past its alert threshold (or its limit for
+    # level='over') in one query: (user_id, username, category, limit, spent)
+    decimal = DecimalField(max_digits=14, decimal_places=2)
+    month = month or month_start()
+    spent = SpendingPeriod.objects.filter(
+        user=OuterRef('user'), category=OuterRef('category'), month=month
+    ).values('total')[:1]
+    budgets = Budget.objects.annotate(spent=Subquery(spent, output_field=decimal)).filter(spent__isnull=False)
+    if level == 'over':
+        budgets = budgets.filter(spent__gte=F('limit'))
+    else:
+        budgets = budgets.filter(spent__gte=F('limit') * F('alert_at') / 100)
+    return budgets.order_by('user_id', 'category').values_list('user_id', 'user__username', 'category', 'limit', 'spent')
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Callers stop waiting on a computation running longer than this and run their own
+FLIGHT_TIMEOUT = 30
+# How long a finished result stays in the shared cache for callers still polling for it
+RESULT_TTL = 5
+# How often callers poll the shared cache for another process's result
+POLL_INTERVAL = 0.02
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LocalFlights:
+    # Single flight within this process: a caller asking for a key that is
+    # already being computed waits for that computation and gets its result
+    # (or its exception) instead of running it again. Nothing is kept once the
+    # computation finishes, so this never serves a stale result.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, compute):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(FLIGHT_TIMEOUT):
+                return compute()
+            logger.debug('coalesce.shared key=%s', key)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = compute()
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+class CacheFlights:
+    # Single flight across every process using the cache (CACHES[alias], e.g.
+    # Redis). The first caller takes a lock holding a token of its own and
+    # publishes its result under that token; callers elsewhere poll for it.
+    # Results must pickle. Callers in this process still share via LocalFlights.
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+        self.local = LocalFlights()
+
+    def run(self, key, compute):
+        return self.local.run(key, lambda: self._run_shared(key, compute))
+
+    def _run_shared(self, key, compute):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        lock_key = f'flight:{digest}'
+        token = uuid.uuid4().hex
+        if self.cache.add(lock_key, token, FLIGHT_TIMEOUT):
+            try:
+                result = compute()
+                self.cache.set(f'{lock_key}:{token}', result, RESULT_TTL)
+                return result
+            finally:
+                # Not if it expired and another caller holds it now
+                if self.cache.get(lock_key) == token:
+                    self.cache.delete(lock_key)
+
+        leader = self.cache.get(lock_key)
+        result_key = f'{lock_key}:{leader}'
+        deadline = time.monotonic() + FLIGHT_TIMEOUT
+        while leader is not None and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            found = self.cache.get_many([result_key, lock_key])
+            if result_key in found:
+                logger.debug('coalesce.shared key=%s', key)
+                return found[result_key]
+            if found.get(lock_key) != leader:
+                # The leader failed (its error isn't shared between processes)
+                break
+        return compute()
+
+
+# See CORE_COALESCING in settings
+flights = import_string(settings.CORE_COALESCING)()
+
+
+def coalesced(get):
+    # For the GET handler of an expensive view: identical requests (same user,
+    # view, path and query) that overlap share one run of the handler. Its
+    # response must be a plain Response; the data is shared, each caller
+    # renders its own. A coalesced handler must not call another one for the
+    # same request (it would wait on its own flight): share plain helpers.
+    @wraps(get)
+    def wrapper(view, request, *args, **kwargs):
+        query = urlencode(sorted(request.query_params.lists()), doseq=True)
+        key = f'{request.user.pk}:{type(view).__qualname__}:{request.path}?{query}'
+
+        def compute():
+            response = get(view, request, *args, **kwargs)
+            return response.status_code, response.data
+
+        status, data = flights.run(key, compute)
+        return Response(data, status=status)
+    return wrapper
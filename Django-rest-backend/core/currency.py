@@ -0,0 +1,88 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .models import BASE_CURRENCY, FxRate
+
+# Every stored total (balances, ledger events, budgets, rollups) is in the
+# base currency. A bill or settlement keeps its own currency and amount plus
+# the rate to the base currency on the day it was recorded (fx_rate), so
+# converting in SQL is amount * fx_rate. Views then convert base totals into
+# the viewer's currency with the latest rates.
+
+SYMBOLS = {'INR': '₹', 'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥', 'AUD': 'A$', 'CAD': 'C$', 'SGD': 'S$'}
+
+CENT = Decimal('0.01')
+
+# Latest rates are read once per process per this many seconds
+RATES_TTL = 300
+
+BASE_VALUE_FIELD = DecimalField(max_digits=24, decimal_places=10)
+
+
+def base_value(amount='amount', rate='fx_rate'):
+    # SQL expression for an amount in the base currency, e.g.
+    # base_value('amount', 'bill__fx_rate') on BillSplit
+    return ExpressionWrapper(F(amount) * F(rate), output_field=BASE_VALUE_FIELD)
+
+
+def symbol(currency):
+    return SYMBOLS.get(currency, f'{currency} ')
+
+
+def rate_on(currency, day=None):
+    # Rate of currency to the base currency on day (the latest one known then),
+    # for new bills and settlements
+    if currency == BASE_CURRENCY:
+        return Decimal('1')
+    day = day or timezone.localdate()
+    rate = (
+        FxRate.objects.filter(currency=currency, date__lte=day)
+        .order_by('-date').values_list('rate', flat=True).first()
+    )
+    if rate is None:
+        raise ValidationError({'currency': f'No exchange rate for {currency} yet.'})
+    return rate
+
+
+_cache = {'expires': 0, 'rates': None}
+_lock = threading.Lock()
+
+
+def latest_rates():
+    # {currency: rate to base} for every currency in the table, memoized
+    with _lock:
+        if _cache['rates'] is None or _cache['expires'] < time.monotonic():
+            newest = FxRate.objects.filter(currency=OuterRef('currency')).order_by('-date').values('date')[:1]
+            rates = dict(FxRate.objects.filter(date=Subquery(newest)).values_list('currency', 'rate'))
+            rates[BASE_CURRENCY] = Decimal('1')
+            _cache['rates'] = rates
+            _cache['expires'] = time.monotonic() + RATES_TTL
+        return _cache['rates']
+
+
+def forget_rates():
+    # After importing rates
+    with _lock:
+        _cache['rates'] = None
+
+
+def viewer_currency(request):
+    # ?currency=XXX, or the base currency
+    currency = (request.query_params.get('currency') or BASE_CURRENCY).upper()
+    if currency not in latest_rates():
+        raise ValidationError({'currency': f'Unknown currency {currency}.'})
+    return currency
+
+
+def converter(currency):
+    # Function turning base currency amounts into currency, rounded to cents
+    rate = latest_rates()[currency]
+
+    def convert(amount):
+        return (Decimal(amount or 0) / rate).quantize(CENT)
+    return convert
@@ -0,0 +1,193 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.db.models import F, Max, Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import BalancePair, Bill, BillSplit, LedgerEvent, LedgerSnapshot, Settlement
+
+_state = threading.local()
+
+CENT = Decimal('0.01')
+
+
+@contextmanager
+def suppress_ledger_events():
+    # For code that moves rows around without changing any balance or spend
+    # (archival, moves between shards)
+    previous = getattr(_state, 'suppressed', False)
+    _state.suppressed = True
+    try:
+        yield
+    finally:
+        _state.suppressed = previous
+
+
+def recording():
+    return not getattr(_state, 'suppressed', False)
+
+
+# Event amounts are in the base currency, converted at the bill's or
+# settlement's own rate
+
+def _bump_pair(user_id, other_id):
+    # Settling checks the balance against the pair's version (see
+    # SettlementListCreateView), so a split or an edit changing it moves the
+    # version too, in the same transaction as the change
+    user_a, user_b = sorted((user_id, other_id))
+    pair, _ = BalancePair.objects.get_or_create(user_a_id=user_a, user_b_id=user_b)
+    BalancePair.objects.filter(pk=pair.pk).update(version=F('version') + 1)
+
+
+def _split_event(kind, split, amount, bill=None):
+    # bill: (created_by_id, fx_rate) the split is charged under, read from
+    # the split's database unless given
+    if bill is None:
+        bill = Bill.objects.using(split._state.db).filter(pk=split.bill_id).values_list('created_by_id', 'fx_rate').first()
+    if bill is None or bill[0] == split.user_id:
+        return
+    creator_id, fx_rate = bill
+    _bump_pair(split.user_id, creator_id)
+    LedgerEvent.objects.create(
+        kind=kind, debtor_id=split.user_id, creditor_id=creator_id, amount=(Decimal(str(amount)) * fx_rate).quantize(CENT),
+        bill_id=split.bill_id, split_id=split.pk,
+    )
+
+
+def _settlement_event(kind, settlement, amount):
+    LedgerEvent.objects.create(
+        kind=kind, debtor_id=settlement.payer_id, creditor_id=settlement.payee_id,
+        amount=(Decimal(str(amount)) * settlement.fx_rate).quantize(CENT),
+        bill_id=settlement.bill_id, settlement_id=settlement.pk,
+    )
+
+
+@receiver(pre_save, sender=Bill)
+@receiver(pre_save, sender=BillSplit)
+@receiver(pre_save, sender=Settlement)
+def remember_previous(sender, instance, using, **kwargs):
+    # Edits are recorded as a removal of the old row and a new one
+    if instance.pk and recording():
+        instance._ledger_previous = sender.objects.using(using).filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=Bill)
+def bill_saved(sender, instance, created, using, **kwargs):
+    # A new creator or rate moves every split of the bill to another pair or amount
+    previous = getattr(instance, '_ledger_previous', None)
+    if not recording() or previous is None:
+        return
+    fields = ('created_by_id', 'currency', 'fx_rate')
+    if [getattr(previous, field) for field in fields] == [getattr(instance, field) for field in fields]:
+        return
+    for split in BillSplit.objects.using(using).filter(bill_id=instance.pk):
+        _split_event('split_removed', split, -split.amount, (previous.created_by_id, previous.fx_rate))
+        _split_event('split_created', split, split.amount, (instance.created_by_id, instance.fx_rate))
+
+
+@receiver(post_save, sender=BillSplit)
+def split_saved(sender, instance, created, **kwargs):
+    if not recording():
+        return
+    previous = getattr(instance, '_ledger_previous', None)
+    if previous is not None:
+        if (previous.user_id, previous.amount, previous.bill_id) == (instance.user_id, instance.amount, instance.bill_id):
+            return
+        _split_event('split_removed', previous, -previous.amount)
+    _split_event('split_created', instance, instance.amount)
+
+
+@receiver(post_delete, sender=BillSplit)
+def split_deleted(sender, instance, **kwargs):
+    if recording():
+        _split_event('split_removed', instance, -instance.amount)
+
+
+@receiver(post_save, sender=Settlement)
+def settlement_saved(sender, instance, created, **kwargs):
+    if not recording():
+        return
+    previous = getattr(instance, '_ledger_previous', None)
+    if previous is not None:
+        fields = ('payer_id', 'payee_id', 'amount', 'currency', 'fx_rate')
+        if [getattr(previous, field) for field in fields] == [getattr(instance, field) for field in fields]:
+            return
+        _settlement_event('settlement_removed', previous, previous.amount)
+        # New settlements move the version in SettlementListCreateView itself
+        _bump_pair(previous.payer_id, previous.payee_id)
+        _bump_pair(instance.payer_id, instance.payee_id)
+    _settlement_event('settlement_recorded', instance, -instance.amount)
+
+
+@receiver(post_delete, sender=Settlement)
+def settlement_deleted(sender, instance, **kwargs):
+    if recording():
+        _settlement_event('settlement_removed', instance, instance.amount)
+
+
+def _events_for(user_id):
+    return LedgerEvent.objects.filter(Q(debtor_id=user_id) | Q(creditor_id=user_id))
+
+
+def _apply(balances, user_id, events):
+    # balances: {counterparty id: Decimal}, positive when they owe user_id
+    for debtor_id, creditor_id, amount in events:
+        if debtor_id == user_id:
+            balances[creditor_id] -= amount
+        else:
+            balances[debtor_id] += amount
+    return balances
+
+
+def balances_at(user_id, at=None, use_snapshots=True):
+    # Nearest snapshot at or before `at`, then replay the events after it
+    balances = defaultdict(Decimal)
+    events = _events_for(user_id)
+    if at is not None:
+        events = events.filter(occurred_at__lte=at)
+    snapshot = None
+    if use_snapshots:
+        snapshots = LedgerSnapshot.objects.filter(user_id=user_id)
+        if at is not None:
+            snapshots = snapshots.filter(as_of__lte=at)
+        snapshot = snapshots.order_by('-event_id').first()
+    if snapshot is not None:
+        for other_id, amount in snapshot.balances.items():
+            balances[int(other_id)] = Decimal(amount)
+        events = events.filter(id__gt=snapshot.event_id)
+    _apply(balances, user_id, events.order_by('id').values_list('debtor_id', 'creditor_id', 'amount').iterator())
+    return {other_id: amount for other_id, amount in balances.items() if amount}
+
+
+def take_snapshot(user_id, event_id=None):
+    # Snapshot user_id's balances after event_id (default: the latest event)
+    if event_id is None:
+        event_id = LedgerEvent.objects.aggregate(last=Max('id'))['last']
+        if event_id is None:
+            return None
+    event = LedgerEvent.objects.filter(id__lte=event_id).order_by('-id').values('id', 'occurred_at').first()
+    if event is None:
+        return None
+
+    balances = defaultdict(Decimal)
+    base = LedgerSnapshot.objects.filter(user_id=user_id, event_id__lte=event_id).order_by('-event_id').first()
+    events = _events_for(user_id).filter(id__lte=event_id)
+    if base is not None:
+        if base.event_id == event_id:
+            return base
+        for other_id, amount in base.balances.items():
+            balances[int(other_id)] = Decimal(amount)
+        events = events.filter(id__gt=base.event_id)
+    _apply(balances, user_id, events.order_by('id').values_list('debtor_id', 'creditor_id', 'amount').iterator())
+
+    snapshot, _ = LedgerSnapshot.objects.update_or_create(
+        user_id=user_id, event_id=event['id'],
+        defaults={
+            'as_of': event['occurred_at'],
+            'balances': {str(other_id): str(amount) for other_id, amount in balances.items() if amount},
+        },
+    )
+    return snapshot
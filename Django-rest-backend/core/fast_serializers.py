@@ -0,0 +1,170 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Bill, BillSplit, Friend, Group
+
+# Read-only counterparts of the list serializers in serializers.py. They work
+# from .values() rows and fetch related rows with one query per relation, and
+# must produce exactly the JSON the ModelSerializers produce.
+
+CENT = Decimal('0.01')
+
+
+def _decimal(value):
+    # Same as DecimalField(decimal_places=2) with COERCE_DECIMAL_TO_STRING
+    if value is None:
+        return None
+    return '{:f}'.format(Decimal(value).quantize(CENT))
+
+
+def _datetime(value):
+    # Same as DateTimeField: current timezone, ISO 8601, 'Z' for UTC
+    if value is None:
+        return None
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _date(value):
+    return value.isoformat() if value is not None else None
+
+
+def user_rows(user_ids):
+    # {id: UserSerializer data}
+    return {
+        row['id']: row
+        for row in User.objects.filter(pk__in=set(user_ids)).values('id', 'username', 'email')
+    }
+
+
+def bill_rows(queryset):
+    bills = list(queryset.values(
+        'id', 'desc', 'amount', 'currency', 'created_at', 'created_by_id', 'split_type', 'group_id',
+        'category', 'is_recurring', 'recurrence_type', 'next_due_date',
+    ))
+    bill_ids = queryset.order_by().values('id')
+
+    participants = defaultdict(list)
+    for bill_id, user_id in (
+        Bill.participants.through.objects.filter(bill__in=bill_ids).order_by('user_id').values_list('bill_id', 'user_id')
+    ):
+        participants[bill_id].append(user_id)
+
+    splits = defaultdict(list)
+    split_values = list(
+        BillSplit.objects.filter(bill__in=bill_ids).order_by('id').values_list('id', 'bill_id', 'user_id', 'amount')
+    )
+    users = user_rows(
+        [bill['created_by_id'] for bill in bills] + [user_id for _, _, user_id, _ in split_values]
+    )
+    for split_id, bill_id, user_id, amount in split_values:
+        splits[bill_id].append({
+            'id': split_id,
+            'bill': bill_id,
+            'user': users[user_id],
+            'amount': _decimal(amount),
+        })
+
+    return [
+        {
+            'id': bill['id'],
+            'desc': bill['desc'],
+            'amount': _decimal(bill['amount']),
+            'currency': bill['currency'],
+            'created_at': _datetime(bill['created_at']),
+            'created_by': users[bill['created_by_id']],
+            'participants': participants[bill['id']],
+            'splits': splits[bill['id']],
+            'split_type': bill['split_type'],
+            'group': bill['group_id'],
+            'category': bill['category'],
+            'is_recurring': bill['is_recurring'],
+            'recurrence_type': bill['recurrence_type'],
+            'next_due_date': _date(bill['next_due_date']),
+        }
+        for bill in bills
+    ]
+
+
+def settlement_rows(queryset):
+    settlements = list(queryset.values('id', 'payer_id', 'payee_id', 'amount', 'currency', 'bill_id', 'created_at'))
+    users = user_rows(
+        [row['payer_id'] for row in settlements] + [row['payee_id'] for row in settlements]
+    )
+    return [
+        {
+            'id': row['id'],
+            'payer': users[row['payer_id']],
+            'payee': users[row['payee_id']],
+            'amount': _decimal(row['amount']),
+            'currency': row['currency'],
+            'bill': row['bill_id'],
+            'created_at': _datetime(row['created_at']),
+        }
+        for row in settlements
+    ]
+
+
+def group_rows(queryset, summary=False, hot=None):
+    # queryset must carry the annotations added by GroupListCreateView; hot
+    # adds {group_id: [bill_count, total_spend, net_position]} on top
+    groups = list(queryset.values(
+        'id', 'name', 'created_by_id', 'created_at', 'member_count', 'bill_count', 'total_spend', 'net_position',
+    ))
+    members = defaultdict(list)
+    member_ids = []
+    if not summary:
+        for group_id, user_id in (
+            Group.members.through.objects.filter(group__in=queryset.order_by().values('id'))
+            .order_by('user_id').values_list('group_id', 'user_id')
+        ):
+            members[group_id].append(user_id)
+            member_ids.append(user_id)
+    users = user_rows([row['created_by_id'] for row in groups] + member_ids)
+
+    rows = []
+    for group in groups:
+        if hot and group['id'] in hot:
+            count, total, position = hot[group['id']]
+            group['bill_count'] += count
+            group['total_spend'] = Decimal(group['total_spend']) + total
+            group['net_position'] = Decimal(group['net_position']) + position
+        row = {'id': group['id'], 'name': group['name']}
+        if not summary:
+            row['members'] = [users[user_id] for user_id in members[group['id']]]
+        row.update({
+            'created_by': users[group['created_by_id']],
+            'created_at': _datetime(group['created_at']),
+            'member_count': group['member_count'],
+            'bill_count': group['bill_count'],
+            'total_spend': _decimal(group['total_spend']),
+            'net_position': _decimal(group['net_position']),
+        })
+        rows.append(row)
+    return rows
+
+
+def friend_rows(user):
+    # Same de-duplication as FriendListCreateView.get_queryset
+    friendships = Friend.objects.filter(Q(user=user) | Q(friend=user)).values_list(
+        'id', 'user_id', 'friend_id', 'created_at'
+    )
+    seen_friends = set()
+    unique_friendships = []
+    for friendship_id, user_id, friend_id, created_at in friendships:
+        other_id = friend_id if user_id == user.pk else user_id
+        if other_id not in seen_friends:
+            seen_friends.add(other_id)
+            unique_friendships.append((friendship_id, other_id, created_at))
+
+    users = user_rows(seen_friends)
+    return [
+        {'id': friendship_id, 'friend_info': users[other_id], 'created_at': _datetime(created_at)}
+        for friendship_id, other_id, created_at in unique_friendships
+    ]
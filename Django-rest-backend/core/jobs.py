@@ -0,0 +1,130 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Retry delays double from BACKOFF_BASE up to BACKOFF_MAX
+BACKOFF_BASE = timedelta(seconds=10)
+BACKOFF_MAX = timedelta(hours=1)
+# A running job whose worker hasn't finished it by then is handed out again
+LOCK_TIMEOUT = timedelta(minutes=10)
+
+HANDLERS = {}
+
+
+def register(name):
+    # Decorator for job handlers; the handler receives the payload as kwargs
+    def decorator(func):
+        HANDLERS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, priority=0, dedup_key=None, delay=None, max_attempts=5):
+    # Returns the new job, or the queued job already holding dedup_key
+    fields = {
+        'name': name,
+        'payload': payload or {},
+        'priority': priority,
+        'dedup_key': dedup_key,
+        'max_attempts': max_attempts,
+        'run_at': timezone.now() + (delay or timedelta()),
+    }
+    if dedup_key is None:
+        return Job.objects.create(**fields)
+    try:
+        with transaction.atomic():
+            return Job.objects.create(**fields)
+    except IntegrityError:
+        existing = Job.objects.filter(dedup_key=dedup_key, status='queued').first()
+        if existing is None:
+            # It was claimed between the insert and the lookup
+            return Job.objects.create(**fields)
+        return existing
+
+
+def enqueue_on_commit(name, payload=None, **kwargs):
+    # For request code: only queue the job once the data it reads is committed
+    transaction.on_commit(lambda: enqueue(name, payload, **kwargs))
+
+
+def _requeue(jobs, **fields):
+    # Back to queued, for the job in `jobs` if it still matches them; if
+    # another queued copy took the dedup key meanwhile, this one gives its
+    # key up rather than failing the constraint
+    fields.update(status='queued', locked_by='', locked_at=None)
+    try:
+        with transaction.atomic():
+            return jobs.update(**fields)
+    except IntegrityError:
+        return jobs.update(dedup_key=None, **fields)
+
+
+def claim(worker, batch=5):
+    # Hand one due job to worker. Claiming is a conditional UPDATE, so two
+    # workers racing for the same row can't both win on any backend.
+    now = timezone.now()
+    # Re-evaluated on every use: a job that finished meanwhile drops out
+    stale = Job.objects.filter(status='running', locked_at__lt=now - LOCK_TIMEOUT)
+    # A job that keeps taking its worker down is given up like one that keeps failing
+    for job_id in list(stale.filter(attempts__gte=F('max_attempts')).values_list('id', flat=True)):
+        if stale.filter(pk=job_id).update(
+            status='failed', last_error='Worker lost the job on its last attempt', finished_at=now,
+            locked_by='', locked_at=None,
+        ):
+            logger.error('job.failed id=%s reason=stale', job_id)
+    for job_id in list(stale.values_list('id', flat=True)):
+        if _requeue(stale.filter(pk=job_id)):
+            logger.warning('job.stale id=%s', job_id)
+    candidates = (
+        Job.objects.filter(status='queued', run_at__lte=now)
+        .order_by('-priority', 'run_at', 'id')
+        .values_list('id', flat=True)[:batch]
+    )
+    for job_id in list(candidates):
+        claimed = Job.objects.filter(pk=job_id, status='queued').update(
+            status='running', locked_by=worker, locked_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def run(job):
+    # Finishing is conditional on the worker still holding the job: once
+    # it's been handed out again as stale, the new holder's outcome counts
+    held = Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by, locked_at=job.locked_at)
+    handler = HANDLERS.get(job.name)
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for job {job.name!r}')
+        handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            updated = held.update(
+                status='failed', last_error=error, finished_at=timezone.now(), locked_by='', locked_at=None
+            )
+            if updated:
+                logger.error('job.failed id=%s name=%s attempts=%s', job.pk, job.name, job.attempts)
+        else:
+            delay = min(BACKOFF_BASE * 2 ** (job.attempts - 1), BACKOFF_MAX)
+            updated = _requeue(held, last_error=error, run_at=timezone.now() + delay)
+            if updated:
+                logger.warning('job.retry id=%s name=%s attempts=%s delay=%s', job.pk, job.name, job.attempts, delay)
+        if not updated:
+            logger.warning('job.lost id=%s name=%s worker=%s', job.pk, job.name, job.locked_by)
+        return False
+
+    if not held.update(status='done', finished_at=timezone.now(), locked_by='', locked_at=None):
+        logger.warning('job.lost id=%s name=%s worker=%s', job.pk, job.name, job.locked_by)
+        return False
+    logger.debug('job.done id=%s name=%s', job.pk, job.name)
+    return True
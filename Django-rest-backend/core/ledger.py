@@ -0,0 +1,163 @@
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .balances import pair_balance
+from .models import Bill, BillSplit, Settlement
+from .sharding import current_shard, fan_out
+
+CENT = Decimal('0.01')
+CURSOR_SALT = 'core.ledger'
+
+
+class ForeignCursor(Exception):
+    # A validly signed cursor taken from another pair's ledger
+    pass
+
+# Each branch is one direction of money between the pair, newest first, and is
+# cut to the page size on its own so the (created_by, created_at) and
+# (payer, payee, created_at) indexes bound the work by the page, not the history.
+# delta is from the viewer's side, in the base currency: positive means the
+# other user owes more.
+BRANCH_SQL = {
+    'lent': f"""
+        SELECT 'split' AS kind, s.id AS ref_id, b.id AS bill_id, b."desc" AS description,
+               b.created_at AS created_at, s.amount * b.fx_rate AS delta
+        FROM {BillSplit._meta.db_table} s JOIN {Bill._meta.db_table} b ON b.id = s.bill_id
+        WHERE b.created_by_id = %(me)s AND s.user_id = %(other)s {{after}}
+        ORDER BY b.created_at DESC, s.id DESC LIMIT %(limit)s
+    """,
+    'owed': f"""
+        SELECT 'split' AS kind, s.id AS ref_id, b.id AS bill_id, b."desc" AS description,
+               b.created_at AS created_at, -s.amount * b.fx_rate AS delta
+        FROM {BillSplit._meta.db_table} s JOIN {Bill._meta.db_table} b ON b.id = s.bill_id
+        WHERE b.created_by_id = %(other)s AND s.user_id = %(me)s {{after}}
+        ORDER BY b.created_at DESC, s.id DESC LIMIT %(limit)s
+    """,
+    'paid': f"""
+        SELECT 'settlement' AS kind, st.id AS ref_id, st.bill_id AS bill_id, NULL AS description,
+               st.created_at AS created_at, st.amount * st.fx_rate AS delta
+        FROM {Settlement._meta.db_table} st
+        WHERE st.payer_id = %(me)s AND st.payee_id = %(other)s {{after}}
+        ORDER BY st.created_at DESC, st.id DESC LIMIT %(limit)s
+    """,
+    'received': f"""
+        SELECT 'settlement' AS kind, st.id AS ref_id, st.bill_id AS bill_id, NULL AS description,
+               st.created_at AS created_at, -st.amount * st.fx_rate AS delta
+        FROM {Settlement._meta.db_table} st
+        WHERE st.payer_id = %(other)s AND st.payee_id = %(me)s {{after}}
+        ORDER BY st.created_at DESC, st.id DESC LIMIT %(limit)s
+    """,
+}
+
+AFTER_SQL = {
+    'split': "AND (b.created_at, 'split', s.id) < (%(created_at)s, %(kind)s, %(ref_id)s)",
+    'settlement': "AND (st.created_at, 'settlement', st.id) < (%(created_at)s, %(kind)s, %(ref_id)s)",
+}
+
+# newer is the sum of deltas of this row and every newer row on the page
+PAGE_SQL = """
+    SELECT kind, ref_id, bill_id, description, created_at, delta,
+           SUM(delta) OVER (
+               ORDER BY created_at DESC, kind DESC, ref_id DESC
+               ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+           ) AS newer
+    FROM ({branches}) entries
+    ORDER BY created_at DESC, kind DESC, ref_id DESC
+    LIMIT %(limit)s
+"""
+
+
+def _cents(value):
+    return Decimal(str(value)).quantize(CENT)
+
+
+def _datetime(value):
+    # SQLite hands back text, other backends datetimes
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def _shard_page(params, position):
+    # The page as far as this shard's rows go; the pair's bills and
+    # settlements can sit on any shard
+    connection = connections[current_shard() or DEFAULT_DB_ALIAS]
+    params = dict(params)
+    if position:
+        params.update({
+            'created_at': connection.ops.adapt_datetimefield_value(parse_datetime(position['created_at'])),
+            'kind': position['kind'],
+            'ref_id': position['ref_id'],
+        })
+    branches = ' UNION ALL '.join(
+        'SELECT * FROM ({}) {}'.format(sql.format(
+            after=AFTER_SQL['split' if name in ('lent', 'owed') else 'settlement'] if position else ''
+        ), name)
+        for name, sql in BRANCH_SQL.items()
+    )
+    with connection.cursor() as db:
+        db.execute(PAGE_SQL.format(branches=branches), params)
+        return [(kind, ref_id, bill_id, description, _datetime(created_at), delta, newer)
+                for kind, ref_id, bill_id, description, created_at, delta, newer in db.fetchall()]
+
+
+def ledger_page(user_id, other_id, size, cursor=None):
+    # One page of the pair's history, newest first, with the viewer's balance
+    # after each entry. Returns (entries, next_cursor).
+    if cursor:
+        position = signing.loads(cursor, salt=CURSOR_SALT)
+        if (position.get('user'), position.get('other')) != (user_id, other_id):
+            raise ForeignCursor()
+        balance = Decimal(position['balance'])
+    else:
+        position = None
+        balance = _cents(pair_balance(user_id, other_id))
+
+    params = {'me': user_id, 'other': other_id, 'limit': size + 1}
+    parts = fan_out(_shard_page, params, position)
+    if len(parts) == 1:
+        rows = parts[0]
+    else:
+        # Each shard's running sum only covers its own rows: merge and sum again
+        merged = sorted(
+            (row for part in parts for row in part), key=lambda row: (row[4], row[0], row[1]), reverse=True,
+        )[:size + 1]
+        rows, newer = [], 0
+        for row in merged:
+            newer += row[5]
+            rows.append(row[:6] + (newer,))
+
+    entries = []
+    for kind, ref_id, bill_id, description, created_at, delta, newer in rows[:size]:
+        delta, newer = _cents(delta), _cents(newer)
+        entries.append({
+            'type': kind,
+            'id': ref_id,
+            'bill': bill_id,
+            'description': description,
+            'created_at': created_at,
+            'amount': delta,
+            # Undo everything newer than this entry
+            'balance': balance - newer + delta,
+        })
+
+    next_cursor = None
+    if len(rows) > size:
+        last = entries[-1]
+        next_cursor = signing.dumps({
+            # Only good for the ledger it came from
+            'user': user_id,
+            'other': other_id,
+            'created_at': last['created_at'].isoformat(),
+            'kind': last['type'],
+            'ref_id': last['id'],
+            'balance': str(last['balance'] - last['amount']),
+        }, salt=CURSOR_SALT)
+    return entries, next_cursor
@@ -0,0 +1,72 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from core.archive import (
+    MIN_ARCHIVE_AGE_DAYS, archive_bills, archive_consumed_settlements, closed_bill_ids,
+    diff_totals, ledger_totals,
+)
+from core.sharding import SHARDS
+
+
+class VerificationFailed(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Move fully settled bills and their settlements into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=90, help='Only archive bills older than this many days')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Bills per chunk')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many bills would be archived')
+        parser.add_argument('--no-verify', action='store_true',
+                            help='Commit chunk by chunk without comparing totals before and after')
+
+    def handle(self, *args, **options):
+        # Archival reads and deletes hot rows on default only; on shards it
+        # would find nothing to archive or roll up partial pair totals
+        if SHARDS:
+            raise CommandError('Archiving is not supported with CORE_SHARDS set')
+        days = options['older_than']
+        if days < MIN_ARCHIVE_AGE_DAYS:
+            raise CommandError(f'--older-than must be at least {MIN_ARCHIVE_AGE_DAYS} days')
+        cutoff = timezone.now() - timedelta(days=days)
+
+        bill_ids = closed_bill_ids(cutoff)
+        self.stdout.write(f'{len(bill_ids)} closed bills older than {cutoff:%Y-%m-%d}')
+        if options['dry_run'] or not bill_ids:
+            return
+
+        started = time.monotonic()
+        if options['no_verify']:
+            settlements = self.archive(bill_ids, options['chunk_size'])
+        else:
+            # One transaction so a mismatch leaves the tables untouched
+            try:
+                with transaction.atomic():
+                    before = ledger_totals()
+                    settlements = self.archive(bill_ids, options['chunk_size'])
+                    problems = diff_totals(before, ledger_totals())
+                    if problems:
+                        raise VerificationFailed(problems)
+            except VerificationFailed as exc:
+                raise CommandError(f'Totals changed, archive rolled back: {exc}')
+            self.stdout.write('Totals verified before and after archival')
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {len(bill_ids)} bills and {settlements} settlements in {elapsed:.1f}s'
+        ))
+
+    def archive(self, bill_ids, chunk_size):
+        settlements = 0
+        for start in range(0, len(bill_ids), chunk_size):
+            with transaction.atomic():
+                settlements += archive_bills(bill_ids[start:start + chunk_size])
+        with transaction.atomic():
+            settlements += archive_consumed_settlements()
+        return settlements
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from core.events import balances_at
+from core.models import LedgerEvent, LedgerSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Time balance reconstruction from snapshots against a full replay, by history length'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='How many of the busiest users to time')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per user')
+
+    def handle(self, *args, **options):
+        counts = {}
+        for field in ('debtor_id', 'creditor_id'):
+            for user_id, count in LedgerEvent.objects.values_list(field).annotate(count=Count('id')).order_by():
+                counts[user_id] = counts.get(user_id, 0) + count
+        busiest = sorted(counts, key=counts.get, reverse=True)[:options['users']]
+        if not busiest:
+            self.stdout.write('No ledger events yet.')
+            return
+        # After compact_ledger some snapshots predate the oldest event left
+        first_event = LedgerEvent.objects.order_by('id').values_list('id', flat=True).first()
+        compacted = LedgerSnapshot.objects.filter(event_id__lt=first_event).exists()
+
+        self.stdout.write(f'{"user":>8} {"events":>8} {"replayed":>9} {"snapshot ms":>12} {"full ms":>9}')
+        for user_id in sorted(busiest, key=counts.get):
+            snapshot = LedgerSnapshot.objects.filter(user_id=user_id).order_by('-event_id').first()
+            replayed = counts[user_id]
+            if snapshot is not None:
+                replayed = LedgerEvent.objects.filter(id__gt=snapshot.event_id).filter(
+                    debtor_id=user_id).count() + LedgerEvent.objects.filter(
+                    id__gt=snapshot.event_id, creditor_id=user_id).count()
+            fast = self.time(lambda: balances_at(user_id), options['repeat'])
+            # A full replay means nothing once old events have been compacted away
+            full = '-' if compacted else f'{self.time(lambda: balances_at(user_id, use_snapshots=False), options["repeat"]):9.2f}'
+            self.stdout.write(f'{user_id:>8} {counts[user_id]:>8} {replayed:>9} {fast:12.2f} {full:>9}')
+
+    def time(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
@@ -0,0 +1,78 @@
+import json
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test.utils import override_settings
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from core.middleware import BROTLI_QUALITY, USE_BROTLI, brotli
+from core.renderers import FastJSONRenderer, orjson
+
+ENDPOINTS = ['/api/bills/', '/api/settlements/', '/api/groups/', '/api/friends/']
+
+
+class Command(BaseCommand):
+    help = 'Measure bytes on the wire and encoding CPU of the list endpoints, before and after compression and the fast renderer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement')
+        parser.add_argument('--user', help='Username making the requests (defaults to the one in the most bills)')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+        else:
+            user = User.objects.annotate(bills=Count('bills_participated')).order_by('-bills').first()
+        if user is None:
+            raise CommandError('No user to benchmark with')
+
+        self.stdout.write(
+            f'user {user.username}, orjson {"on" if orjson else "missing"}, brotli {"on" if USE_BROTLI else "off" if brotli else "missing"}'
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        repeat = options['repeat']
+
+        # The test client's host has to be allowed
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for url in ENDPOINTS:
+                body = self.body(client.get(url))
+                data = json.loads(body)
+                if FastJSONRenderer().render(data) != JSONRenderer().render(data):
+                    raise CommandError(f'{url}: FastJSONRenderer output differs from JSONRenderer')
+
+                sizes = [f'identity {len(body)} B', f'gzip {len(compress_string(body))} B']
+                if brotli:
+                    sizes.append(f'br {len(brotli.compress(body, quality=BROTLI_QUALITY))} B')
+                slow = self.best(lambda: JSONRenderer().render(data), repeat)
+                fast = self.best(lambda: FastJSONRenderer().render(data), repeat)
+                requests = [
+                    f'{encoding} {self.best(lambda: self.body(client.get(url, HTTP_ACCEPT_ENCODING=encoding)), repeat) * 1000:.1f} ms'
+                    for encoding in ['identity', 'gzip'] + (['br'] if USE_BROTLI else [])
+                ]
+                rows = len(data) if isinstance(data, list) else 1
+                self.stdout.write(
+                    f'{url}: {rows} rows; {", ".join(sizes)}; '
+                    f'render JSONRenderer {slow * 1000:.2f} ms, FastJSONRenderer {fast * 1000:.2f} ms '
+                    f'({slow / fast:.1f}x); request CPU {", ".join(requests)}'
+                )
+
+    def body(self, response):
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+    def best(self, func, repeat):
+        # CPU time of this process, so waiting on the database doesn't count
+        best = None
+        for _ in range(repeat):
+            started = time.process_time()
+            func()
+            elapsed = time.process_time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return max(best, 1e-9)
@@ -0,0 +1,89 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from core.fast_serializers import bill_rows, friend_rows, group_rows, settlement_rows
+from core.models import Bill, Settlement
+from core.serializers import BillSerializer, FriendSerializer, GroupSerializer, SettlementSerializer
+from core.views import FriendListCreateView, GroupListCreateView
+
+
+class Command(BaseCommand):
+    help = 'Compare rows per second of the ModelSerializers and the fast read path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per serializer')
+        parser.add_argument('--user', help='Username whose groups and friends are serialized (defaults to the first user)')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['user']).first() if options['user'] else User.objects.first()
+        if user is None:
+            raise CommandError('No user to benchmark with')
+
+        request = Request(APIRequestFactory().get('/'))
+        request.user = user
+        groups_view = GroupListCreateView(request=request, format_kwarg=None)
+        groups = groups_view.get_queryset()
+        # The shard figures the endpoint adds on top of the annotations
+        hot = groups_view.group_figures(user)
+
+        def serialized_groups():
+            instances = list(groups.all())
+            for group in instances:
+                if group.pk in hot:
+                    count, total, position = hot[group.pk]
+                    group.bill_count += count
+                    group.total_spend += total
+                    group.net_position += position
+            return GroupSerializer(instances, many=True).data
+        friends_view = FriendListCreateView(request=request, format_kwarg=None)
+
+        bills = Bill.objects.order_by('-created_at')
+        cases = [
+            ('bills', bills,
+             lambda: BillSerializer(
+                 bills.select_related('created_by').prefetch_related('participants', 'splits__user'), many=True
+             ).data,
+             lambda: bill_rows(bills)),
+            ('settlements', Settlement.objects.order_by('-created_at'),
+             lambda: SettlementSerializer(
+                 Settlement.objects.order_by('-created_at').select_related('payer', 'payee'), many=True
+             ).data,
+             lambda: settlement_rows(Settlement.objects.order_by('-created_at'))),
+            ('groups', groups,
+             # .all() so neither side reuses an evaluated queryset
+             serialized_groups,
+             lambda: group_rows(groups.all(), hot=hot)),
+            ('friends', friends_view.get_queryset(),
+             lambda: FriendSerializer(friends_view.get_queryset(), many=True, context={'request': request}).data,
+             lambda: friend_rows(user)),
+        ]
+
+        for name, queryset, slow, fast in cases:
+            rows = len(queryset) if isinstance(queryset, list) else queryset.count()
+            if not rows:
+                self.stdout.write(f'{name}: no rows')
+                continue
+            # Canonical JSON so dict ordering can't hide a difference
+            if json.loads(JSONRenderer().render(slow())) != json.loads(JSONRenderer().render(fast())):
+                raise CommandError(f'{name}: fast path output differs from the serializer')
+            slow_rate = rows / self.time(slow, options['repeat'])
+            fast_rate = rows / self.time(fast, options['repeat'])
+            self.stdout.write(
+                f'{name}: {rows} rows, serializer {slow_rate:.0f} rows/s, '
+                f'fast path {fast_rate:.0f} rows/s ({fast_rate / slow_rate:.1f}x)'
+            )
+
+    def time(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            JSONRenderer().render(func())
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return max(best, 1e-9)
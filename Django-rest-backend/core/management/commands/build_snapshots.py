@@ -0,0 +1,84 @@
+import multiprocessing
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from core.models import BatchCheckpoint
+from core.snapshots import compute_chunk, write_chunk
+
+CHECKPOINT_NAME = 'build_snapshots'
+
+
+def _init_worker():
+    # Workers must not share the parent's database connections
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Recompute balance, spending and group position snapshots for all users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per chunk')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes computing chunks')
+        parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        workers = options['workers']
+
+        bounds = User.objects.aggregate(lo=Min('id'), hi=Max('id'))
+        if bounds['lo'] is None:
+            self.stdout.write('No users, nothing to do.')
+            return
+
+        checkpoint, _ = BatchCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+        start = bounds['lo']
+        if options['resume'] and checkpoint.position:
+            start = max(start, checkpoint.position + 1)
+            self.stdout.write(f'Resuming after user {checkpoint.position}')
+
+        chunks = [
+            (lo, min(lo + chunk_size, bounds['hi'] + 1))
+            for lo in range(start, bounds['hi'] + 1, chunk_size)
+        ]
+
+        started = time.monotonic()
+        rows = 0
+        if workers > 1:
+            # Children open their own connections after fork
+            connections.close_all()
+            with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+                # imap keeps chunk order so the checkpoint only moves forward
+                for result in pool.imap(compute_chunk, chunks):
+                    rows += self.write_chunk(checkpoint, *result)
+                    self.report(rows, started, result[1] - 1)
+        else:
+            for chunk in chunks:
+                result = compute_chunk(chunk)
+                rows += self.write_chunk(checkpoint, *result)
+                self.report(rows, started, result[1] - 1)
+
+        # A completed run starts from the beginning next time
+        checkpoint.position = 0
+        checkpoint.save(update_fields=['position', 'updated_at'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {rows} snapshot rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-6):.0f} rows/s)'
+        ))
+
+    def write_chunk(self, checkpoint, lo, hi, balances, spending, positions):
+        with transaction.atomic():
+            rows = write_chunk(lo, hi, balances, spending, positions)
+            checkpoint.position = hi - 1
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        return rows
+
+    def report(self, rows, started, position):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'  up to user {position}: {rows} rows, {rows / max(elapsed, 1e-6):.0f} rows/s')
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from core.events import take_snapshot
+from core.models import LedgerEvent, LedgerSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Fold ledger events older than a horizon into snapshots and delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=365, help='Horizon in days')
+
+    def handle(self, *args, **options):
+        horizon = timezone.now() - timedelta(days=options['older_than'])
+        # Ids and occurred_at don't always agree (long transactions, clock
+        # skew): stop before the first event at or past the horizon, so the
+        # snapshots at last_old only cover events older than it
+        first_new = LedgerEvent.objects.filter(occurred_at__gte=horizon).aggregate(first=Min('id'))['first']
+        old = LedgerEvent.objects.filter(occurred_at__lt=horizon)
+        if first_new is not None:
+            old = old.filter(id__lt=first_new)
+        last_old = old.aggregate(last=Max('id'))['last']
+        if last_old is None:
+            self.stdout.write('Nothing to compact.')
+            return
+
+        with transaction.atomic():
+            # Everyone touched by an event that goes away gets a snapshot at the
+            # horizon, so balances_at() never needs the deleted events
+            user_ids = set(old.filter(id__lte=last_old).values_list('debtor_id', flat=True))
+            user_ids |= set(old.filter(id__lte=last_old).values_list('creditor_id', flat=True))
+            for user_id in sorted(user_ids):
+                take_snapshot(user_id, last_old)
+            deleted_snapshots, _ = LedgerSnapshot.objects.filter(
+                user_id__in=user_ids, event_id__lt=last_old
+            ).delete()
+            deleted_events, _ = LedgerEvent.objects.filter(id__lte=last_old, occurred_at__lt=horizon).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Compacted {deleted_events} events for {len(user_ids)} users into snapshots at event {last_old}, '
+            f'dropped {deleted_snapshots} older snapshots'
+        ))
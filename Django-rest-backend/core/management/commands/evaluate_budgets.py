@@ -0,0 +1,98 @@
+import time as timer
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from core.budgets import CENT, budgets_over, month_start
+from core.currency import base_value
+from core.models import ArchivedBillSplit, BillSplit, BudgetAlert, SpendingPeriod
+from core.sharding import fan_out
+
+
+def month_totals(model, start, end):
+    # [(user_id, category, total, count)] of the splits of bills created in [start, end)
+    return list(
+        model.objects.filter(bill__created_at__gte=start, bill__created_at__lt=end)
+        .values_list('user_id', 'bill__category')
+        .annotate(total=Sum(base_value('amount', 'bill__fx_rate')), count=Count('id'))
+        .order_by()
+    )
+
+
+class Command(BaseCommand):
+    help = 'List every user at or over a budget this month, recording any alert the running totals missed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='YYYY-MM, defaults to the current month')
+        parser.add_argument('--over', action='store_true', help='Only budgets past their limit, not just their alert threshold')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute the month\'s running totals from the splits first')
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                month = datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('--month must look like 2025-01')
+        else:
+            month = month_start()
+
+        if options['rebuild']:
+            changed = self.rebuild(month)
+            self.stdout.write(f'Rebuilt {month:%Y-%m} totals, {changed} rows corrected')
+
+        started = timer.monotonic()
+        rows = list(budgets_over(month, level='over' if options['over'] else 'warning'))
+
+        # Budgets created after the threshold was crossed never saw a crossing
+        BudgetAlert.objects.bulk_create([
+            BudgetAlert(
+                user_id=user_id, category=category, month=month,
+                level='over' if spent >= limit else 'warning', total=spent, limit=limit,
+            )
+            for user_id, username, category, limit, spent in rows
+        ], ignore_conflicts=True)
+
+        digest = defaultdict(list)
+        for user_id, username, category, limit, spent in rows:
+            digest[username].append(f'{category} {spent:.2f}/{limit:.2f}')
+        for username, lines in digest.items():
+            self.stdout.write(f'{username}: {", ".join(lines)}')
+
+        elapsed = timer.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(digest)} users, {len(rows)} budgets over threshold for {month:%Y-%m} ({elapsed:.2f}s)'
+        ))
+
+    def rebuild(self, month):
+        # Set-based recount of one month, for drift in the incremental totals
+        start = timezone.make_aware(datetime.combine(month, time.min))
+        end = timezone.make_aware(datetime.combine((month + timedelta(days=32)).replace(day=1), time.min))
+        totals = defaultdict(lambda: [0, 0])
+        # Hot splits on every shard, archived ones on default
+        parts = fan_out(month_totals, BillSplit, start, end) + [month_totals(ArchivedBillSplit, start, end)]
+        for rows in parts:
+            for user_id, category, total, count in rows:
+                totals[(user_id, category)][0] += total
+                totals[(user_id, category)][1] += count
+
+        # Rows that dropped back to nothing count as absent
+        current = {
+            (user_id, category): (total.quantize(CENT), count)
+            for user_id, category, total, count in
+            SpendingPeriod.objects.filter(month=month).values_list('user_id', 'category', 'total', 'count')
+            if count
+        }
+        expected = {key: (total.quantize(CENT), count) for key, (total, count) in totals.items()}
+        changed = {key for key in set(current) | set(expected) if current.get(key) != expected.get(key)}
+        with transaction.atomic():
+            SpendingPeriod.objects.filter(month=month).delete()
+            SpendingPeriod.objects.bulk_create([
+                SpendingPeriod(user_id=user_id, category=category, month=month, total=total, count=count)
+                for (user_id, category), (total, count) in expected.items()
+            ], batch_size=1000)
+        return len(changed)
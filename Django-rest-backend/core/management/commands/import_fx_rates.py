@@ -0,0 +1,62 @@
+import csv
+import sys
+import time
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.currency import forget_rates
+from core.models import BASE_CURRENCY, FxRate
+
+
+class Command(BaseCommand):
+    help = 'Load exchange rates to the base currency from a CSV of date,currency,rate rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file, or - for stdin')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per statement')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['path'] == '-':
+            rates = self.parse(sys.stdin)
+        else:
+            try:
+                with open(options['path'], newline='') as source:
+                    rates = self.parse(source)
+            except OSError as exc:
+                raise CommandError(str(exc))
+
+        # Re-importing a day replaces its rate; bills already recorded keep theirs
+        with transaction.atomic():
+            FxRate.objects.bulk_create(
+                [FxRate(currency=currency, date=day, rate=rate) for (currency, day), rate in rates.items()],
+                batch_size=options['batch_size'],
+                update_conflicts=True, unique_fields=['currency', 'date'], update_fields=['rate', 'imported_at'],
+            )
+        forget_rates()
+
+        currencies = len({currency for currency, _ in rates})
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Imported {len(rates)} rates for {currencies} currencies ({elapsed:.2f}s)'))
+
+    def parse(self, source):
+        # {(currency, date): rate}, the last row winning; a header row is skipped
+        rates = {}
+        for line, row in enumerate(csv.reader(source), 1):
+            if not row or line == 1 and row[0].strip().lower() == 'date':
+                continue
+            try:
+                day, currency, rate = (value.strip() for value in row)
+                day = date.fromisoformat(day)
+                rate = Decimal(rate)
+            except (ValueError, InvalidOperation):
+                raise CommandError(f'Line {line}: expected date,currency,rate, got {",".join(row)}')
+            currency = currency.upper()
+            if len(currency) != 3 or not currency.isalpha() or rate <= 0:
+                raise CommandError(f'Line {line}: bad currency or rate {",".join(row)}')
+            if currency != BASE_CURRENCY:
+                rates[currency, day] = rate
+        return rates
@@ -0,0 +1,90 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from core.models import Bill, Settlement, ShardPlacement
+from core.sharding import (
+    SHARDS, data_filters, move_rows, replicate_all, shard_for_group, shard_for_user,
+)
+
+
+class Command(BaseCommand):
+    help = 'Move a group\'s (or a user\'s) bills and settlements to another shard, or put everything where the shard map says'
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--group', type=int, help='Group whose bills move')
+        target.add_argument('--user', type=int, help='User whose bills outside groups and standalone settlements move')
+        target.add_argument('--all', action='store_true',
+                            help='Copy users and groups to every shard, then move all misplaced data (including '
+                                 'whatever is still on default) to its mapped shard')
+        parser.add_argument('--to', help='Destination shard for --group/--user')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Bills per transaction')
+        parser.add_argument('--grace', type=float, default=2.0,
+                            help='Seconds to wait after refusing writes, for requests already writing to finish')
+
+    def handle(self, *args, **options):
+        if not SHARDS:
+            raise CommandError('Sharding is off, set CORE_SHARDS first')
+
+        if options['all']:
+            for alias in SHARDS:
+                replicate_all(alias)
+            self.stdout.write(f'Users and groups copied to {len(SHARDS)} shards')
+            moves = self.misplaced()
+        else:
+            if options['to'] not in SHARDS:
+                raise CommandError(f'--to must be one of {", ".join(SHARDS)}')
+            kind, key = ('group', options['group']) if options['group'] is not None else ('user', options['user'])
+            moves = {(kind, key): options['to']}
+
+        if not moves:
+            self.stdout.write('Nothing to move')
+            return
+
+        # Refuse writes to everything about to move, then give in-flight ones time to land
+        for (kind, key), target in moves.items():
+            current = shard_for_group(key) if kind == 'group' else shard_for_user(key)
+            placement, _ = ShardPlacement.objects.get_or_create(kind=kind, key=key, defaults={'shard': current})
+            ShardPlacement.objects.filter(pk=placement.pk).update(moving=True)
+        time.sleep(options['grace'])
+
+        started = time.monotonic()
+        total_bills = total_settlements = 0
+        for (kind, key), target in moves.items():
+            bills, settlements = data_filters(kind, key)
+            moved_bills = moved_settlements = 0
+            for source in [DEFAULT_DB_ALIAS] + SHARDS:
+                if source != target:
+                    counts = move_rows(source, target, bills, settlements, options['chunk_size'])
+                    moved_bills += counts[0]
+                    moved_settlements += counts[1]
+            ShardPlacement.objects.filter(kind=kind, key=key).update(shard=target, moving=False)
+            self.stdout.write(f'{kind} {key} -> {target}: {moved_bills} bills, {moved_settlements} settlements')
+            total_bills += moved_bills
+            total_settlements += moved_settlements
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {total_bills} bills and {total_settlements} settlements in {elapsed:.1f}s'
+        ))
+
+    def misplaced(self):
+        # {(kind, key): target} for every group or user with rows off its mapped shard
+        found = defaultdict(set)
+        for alias in [DEFAULT_DB_ALIAS] + SHARDS:
+            for group_id in Bill.objects.using(alias).filter(group__isnull=False).values_list('group_id', flat=True).distinct():
+                found[('group', group_id)].add(alias)
+            for user_id in Bill.objects.using(alias).filter(group__isnull=True).values_list('created_by_id', flat=True).distinct():
+                found[('user', user_id)].add(alias)
+            for user_id in Settlement.objects.using(alias).filter(bill__isnull=True).values_list('payer_id', flat=True).distinct():
+                found[('user', user_id)].add(alias)
+
+        moves = {}
+        for (kind, key), aliases in found.items():
+            target = shard_for_group(key) if kind == 'group' else shard_for_user(key)
+            if aliases - {target}:
+                moves[(kind, key)] = target
+        return moves
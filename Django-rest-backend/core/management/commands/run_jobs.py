@@ -0,0 +1,64 @@
+import os
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from core.jobs import claim, run
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help='Worker threads in this process')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(f'{socket.gethostname()}:{os.getpid()}:{index}', options['poll_interval'], options['burst'], stop),
+                daemon=True,
+            )
+            for index in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            # Let running jobs finish, claim nothing new
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, worker, poll_interval, burst, stop):
+        done = failed = 0
+        try:
+            while not stop.is_set():
+                try:
+                    job = claim(worker)
+                except OperationalError:
+                    # SQLite allows one writer; back off and try again
+                    job = None
+                    time.sleep(poll_interval)
+                    continue
+                if job is None:
+                    if burst:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                if run(job):
+                    done += 1
+                else:
+                    failed += 1
+        finally:
+            connection.close()
+        self.stdout.write(f'{worker}: {done} done, {failed} failed')
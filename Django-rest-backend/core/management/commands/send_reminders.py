@@ -0,0 +1,56 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from core.models import OutboxMessage
+from core.reminders import build_reminders, deliver_outbox
+
+
+class Command(BaseCommand):
+    help = 'Write "you owe / you are owed" digests for debts older than a few days to the outbox, optionally emailing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-amount', type=Decimal, default=Decimal('100'),
+                            help='Smallest overdue amount per friend worth a reminder')
+        parser.add_argument('--older-than', type=int, default=7,
+                            help='Only debts from bills at least this many days old are overdue')
+        parser.add_argument('--every', type=int, default=7,
+                            help='Days before the same user is reminded again')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per chunk')
+        parser.add_argument('--deliver', action='store_true',
+                            help='Then send unsent outbox messages through the email backend')
+        parser.add_argument('--dry-run', action='store_true', help='Count the reminders without writing them')
+
+    def handle(self, *args, **options):
+        if options['min_amount'] <= 0 or options['older_than'] < 0 or options['every'] < 0:
+            raise CommandError('--min-amount must be positive, --older-than and --every not negative')
+
+        now = timezone.now()
+        older_than = now - timedelta(days=options['older_than'])
+        throttle_since = now - timedelta(days=options['every'])
+        chunk_size = options['chunk_size']
+
+        started = time.monotonic()
+        written = 0
+        bounds = User.objects.aggregate(lo=Min('id'), hi=Max('id'))
+        if bounds['lo'] is not None:
+            for lo in range(bounds['lo'], bounds['hi'] + 1, chunk_size):
+                hi = min(lo + chunk_size, bounds['hi'] + 1)
+                messages = build_reminders(lo, hi, older_than, options['min_amount'], throttle_since, now)
+                if not options['dry_run']:
+                    OutboxMessage.objects.bulk_create(messages, batch_size=1000)
+                written += len(messages)
+                self.stdout.write(f'  up to user {hi - 1}: {written} reminders')
+
+        elapsed = time.monotonic() - started
+        verb = 'Would write' if options['dry_run'] else 'Wrote'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {written} reminders in {elapsed:.1f}s'))
+
+        if options['deliver'] and not options['dry_run']:
+            sent = deliver_outbox()
+            self.stdout.write(self.style.SUCCESS(f'Delivered {sent} messages'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max, Q
+
+from core.events import take_snapshot
+from core.models import LedgerEvent, LedgerSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Snapshot the balances of users with many ledger events since their last snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=500,
+                            help='Snapshot a user once this many of their events are not covered by a snapshot')
+
+    def handle(self, *args, **options):
+        last_event = LedgerEvent.objects.aggregate(last=Max('id'))['last']
+        if last_event is None:
+            self.stdout.write('No ledger events yet.')
+            return
+
+        latest = dict(LedgerSnapshot.objects.values_list('user_id').annotate(last=Max('event_id')).order_by())
+        # Events per user counted on both sides of the pair
+        counts = {}
+        for field in ('debtor_id', 'creditor_id'):
+            for user_id, count in LedgerEvent.objects.values_list(field).annotate(count=Count('id')).order_by():
+                counts[user_id] = counts.get(user_id, 0) + count
+
+        taken = 0
+        for user_id in sorted(counts):
+            since = latest.get(user_id)
+            if since is not None:
+                pending = LedgerEvent.objects.filter(
+                    Q(debtor_id=user_id) | Q(creditor_id=user_id), id__gt=since, id__lte=last_event
+                ).count()
+            else:
+                pending = counts[user_id]
+            if pending >= options['interval']:
+                take_snapshot(user_id, last_event)
+                taken += 1
+        self.stdout.write(self.style.SUCCESS(f'Took {taken} snapshots up to event {last_event}'))
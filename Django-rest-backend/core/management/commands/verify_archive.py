@@ -0,0 +1,108 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+
+from core.archive import CENT
+from core.currency import base_value
+from core.models import (
+    ArchivedBill, ArchivedBillSplit, ArchivedDebt, ArchivedGroupRollup, ArchivedSettlement, ArchivedSpending,
+)
+
+
+# The rollups are in the base currency, like archive.py writes them
+SPLIT_VALUE = base_value('amount', 'bill__fx_rate')
+
+
+def _cents(row):
+    return tuple(value.quantize(CENT) if isinstance(value, Decimal) else value for value in row)
+
+
+class Command(BaseCommand):
+    help = 'Check that the archive rollups match the archived bills and settlements'
+
+    def handle(self, *args, **options):
+        problems = {}
+        for name, (rollup, recomputed) in {
+            'debts': (self.debt_rollup(), self.debt_raw()),
+            'spending': (self.spending_rollup(), self.spending_raw()),
+            'groups': (self.group_rollup(), self.group_raw()),
+        }.items():
+            keys = set(rollup) | set(recomputed)
+            changed = sorted(key for key in keys if rollup.get(key) != recomputed.get(key))
+            self.stdout.write(f'{name}: {len(keys)} rows, {len(changed)} mismatched')
+            if changed:
+                problems[name] = changed[:20]
+
+        if problems:
+            raise CommandError(f'Archive rollups do not match archived rows: {problems}')
+        self.stdout.write(self.style.SUCCESS('Archive totals match'))
+
+    def debt_rollup(self):
+        return {
+            (debtor_id, creditor_id): _cents((owed, paid))
+            for debtor_id, creditor_id, owed, paid in
+            ArchivedDebt.objects.values_list('debtor_id', 'creditor_id', 'owed', 'paid')
+            if owed or paid
+        }
+
+    def debt_raw(self):
+        debts = defaultdict(lambda: [Decimal('0'), Decimal('0')])
+        owed = (
+            ArchivedBillSplit.objects.exclude(user=F('bill__created_by'))
+            .values_list('user_id', 'bill__created_by').annotate(total=Sum(SPLIT_VALUE)).order_by()
+        )
+        for debtor_id, creditor_id, total in owed:
+            debts[(debtor_id, creditor_id)][0] += total
+        paid = ArchivedSettlement.objects.values_list('payer_id', 'payee_id').annotate(total=Sum(base_value())).order_by()
+        for debtor_id, creditor_id, total in paid:
+            debts[(debtor_id, creditor_id)][1] += total
+        return {key: _cents(row) for key, row in debts.items()}
+
+    def spending_rollup(self):
+        return {
+            (user_id, category, month): _cents((total, count))
+            for user_id, category, month, total, count in
+            ArchivedSpending.objects.values_list('user_id', 'category', 'month', 'total', 'count')
+            if count
+        }
+
+    def spending_raw(self):
+        rows = (
+            ArchivedBill.participants.through.objects
+            .annotate(month=TruncMonth('archivedbill__created_at'))
+            .values_list('user_id', 'archivedbill__category', 'month')
+            .annotate(total=Sum(base_value('archivedbill__amount', 'archivedbill__fx_rate')), count=Count('archivedbill_id'))
+            .order_by()
+        )
+        return {
+            (user_id, category, month.date()): _cents((total, count))
+            for user_id, category, month, total, count in rows
+        }
+
+    def group_rollup(self):
+        return {
+            (group_id, user_id): _cents((count, paid, share))
+            for group_id, user_id, count, paid, share in
+            ArchivedGroupRollup.objects.values_list('group_id', 'user_id', 'bill_count', 'paid', 'share')
+            if count or paid or share
+        }
+
+    def group_raw(self):
+        groups = defaultdict(lambda: [0, Decimal('0'), Decimal('0')])
+        paid = (
+            ArchivedBill.objects.filter(group__isnull=False)
+            .values_list('group_id', 'created_by_id').annotate(count=Count('id'), total=Sum(base_value())).order_by()
+        )
+        for group_id, user_id, count, total in paid:
+            groups[(group_id, user_id)][0] += count
+            groups[(group_id, user_id)][1] += total
+        share = (
+            ArchivedBillSplit.objects.filter(bill__group__isnull=False)
+            .values_list('bill__group', 'user_id').annotate(total=Sum(SPLIT_VALUE)).order_by()
+        )
+        for group_id, user_id, total in share:
+            groups[(group_id, user_id)][2] += total
+        return {key: _cents(row) for key, row in groups.items()}
@@ -0,0 +1,81 @@
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+# A fast setting: API bodies are compressed on every request, not once
+BROTLI_QUALITY = 4
+# Up to this many random bytes go into each gzip header, like GZipMiddleware
+# does, so the compressed size of a body carrying secrets leaks less (BREACH)
+GZIP_RANDOM_BYTES = 100
+# Brotli has no such padding, so it is only offered when CORE_BROTLI is set
+USE_BROTLI = brotli is not None and settings.CORE_BROTLI
+
+_accepts = {name: re.compile(rf'\b{name}\b') for name in ('br', 'gzip')}
+
+
+def _brotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for item in sequence:
+        data = compressor.process(item)
+        # Flush each chunk so a streamed list reaches the client as it goes
+        data += compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware:
+    # Brotli when enabled and the client takes it, otherwise gzip. Streamed
+    # responses are compressed chunk by chunk.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or not response.streaming and len(response.content) < COMPRESS_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if USE_BROTLI and _accepts['br'].search(accept_encoding):
+            encoding = 'br'
+        elif _accepts['gzip'].search(accept_encoding):
+            encoding = 'gzip'
+        else:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                # Responses streamed under ASGI go out as they are
+                return response
+            if encoding == 'br':
+                response.streaming_content = _brotli_sequence(response.streaming_content)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content, max_random_bytes=GZIP_RANDOM_BYTES)
+            del response.headers['Content-Length']
+        else:
+            if encoding == 'br':
+                compressed = brotli.compress(response.content, quality=BROTLI_QUALITY)
+            else:
+                compressed = compress_string(response.content, max_random_bytes=GZIP_RANDOM_BYTES)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The body changed, so a strong ETag no longer describes it
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:38
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_settlement_idempotency_balancepair'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['group', 'created_at'], name='core_bill_group_i_c99ccf_idx'),
+        ),
+    ]
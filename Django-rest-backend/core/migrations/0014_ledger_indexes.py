@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['created_by', 'created_at'], name='core_bill_created_f1ebe0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='billsplit',
+            index=models.Index(fields=['user', 'bill'], name='core_billsp_user_id_ab9932_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='settlement',
+            index=models.Index(fields=['payer', 'payee', 'created_at'], name='core_settle_payer_i_631fc6_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:46
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('split_created', 'Split created'), ('split_removed', 'Split removed'), ('settlement_recorded', 'Settlement recorded'), ('settlement_removed', 'Settlement removed')], max_length=30)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('bill_id', models.BigIntegerField(blank=True, null=True)),
+                ('split_id', models.BigIntegerField(blank=True, null=True)),
+                ('settlement_id', models.BigIntegerField(blank=True, null=True)),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('creditor', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('debtor', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['debtor', 'id'], name='core_ledger_debtor__fe5006_idx'), models.Index(fields=['creditor', 'id'], name='core_ledger_credito_1e19dd_idx'), models.Index(fields=['occurred_at'], name='core_ledger_occurre_f685c3_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.BigIntegerField()),
+                ('as_of', models.DateTimeField()),
+                ('balances', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_snapshots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'as_of'], name='core_ledger_user_id_7b4e82_idx')],
+                'unique_together': {('user', 'event_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    # Seed the ledger with the history that existed before events were recorded
+    LedgerEvent = apps.get_model('core', 'LedgerEvent')
+    events = []
+    for model_name in ('BillSplit', 'ArchivedBillSplit'):
+        model = apps.get_model('core', model_name)
+        splits = model.objects.values_list('id', 'bill_id', 'user_id', 'bill__created_by_id', 'amount', 'bill__created_at')
+        for split_id, bill_id, user_id, creator_id, amount, created_at in splits.iterator():
+            if user_id != creator_id:
+                events.append(LedgerEvent(
+                    kind='split_created', debtor_id=user_id, creditor_id=creator_id, amount=amount,
+                    bill_id=bill_id, split_id=split_id, occurred_at=created_at,
+                ))
+    for model_name in ('Settlement', 'ArchivedSettlement'):
+        model = apps.get_model('core', model_name)
+        settlements = model.objects.values_list('id', 'bill_id', 'payer_id', 'payee_id', 'amount', 'created_at')
+        for settlement_id, bill_id, payer_id, payee_id, amount, created_at in settlements.iterator():
+            events.append(LedgerEvent(
+                kind='settlement_recorded', debtor_id=payer_id, creditor_id=payee_id, amount=-amount,
+                bill_id=bill_id, settlement_id=settlement_id, occurred_at=created_at,
+            ))
+    events.sort(key=lambda event: event.occurred_at)
+    LedgerEvent.objects.bulk_create(events, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_ledger_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_backfill_ledger_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardPlacement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('group', 'Group'), ('user', 'User')], max_length=10)),
+                ('key', models.BigIntegerField()),
+                ('shard', models.CharField(max_length=50)),
+                ('moving', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('kind', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+CENT = Decimal('0.01')
+
+
+def backfill(apps, schema_editor):
+    # Seed the running totals with the splits that existed before they were kept
+    SpendingPeriod = apps.get_model('core', 'SpendingPeriod')
+    totals = defaultdict(lambda: [Decimal('0'), 0])
+    for model_name in ('BillSplit', 'ArchivedBillSplit'):
+        model = apps.get_model('core', model_name)
+        rows = (
+            model.objects.annotate(month=TruncMonth('bill__created_at'))
+            .values_list('user_id', 'bill__category', 'month')
+            .annotate(total=Sum('amount'), count=Count('id'))
+            .order_by()
+        )
+        for user_id, category, month, total, count in rows:
+            entry = totals[(user_id, category, month.date())]
+            entry[0] += total
+            entry[1] += count
+    SpendingPeriod.objects.bulk_create([
+        SpendingPeriod(user_id=user_id, category=category, month=month, total=total.quantize(CENT), count=count)
+        for (user_id, category, month), (total, count) in totals.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_budgets'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:04
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['created_at'], name='core_bill_created_b14861_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['category', 'created_at'], name='core_bill_categor_6b7b27_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['split_type', 'created_at'], name='core_bill_split_t_d2d4a1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='settlement',
+            index=models.Index(fields=['created_at'], name='core_settle_created_53a711_idx'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_admin_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedbill',
+            name='currency',
+            field=models.CharField(default='INR', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='archivedbill',
+            name='fx_rate',
+            field=models.DecimalField(decimal_places=8, default=1, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='archivedsettlement',
+            name='currency',
+            field=models.CharField(default='INR', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='archivedsettlement',
+            name='fx_rate',
+            field=models.DecimalField(decimal_places=8, default=1, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='currency',
+            field=models.CharField(default='INR', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='fx_rate',
+            field=models.DecimalField(decimal_places=8, default=1, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='settlement',
+            name='currency',
+            field=models.CharField(default='INR', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='settlement',
+            name='fx_rate',
+            field=models.DecimalField(decimal_places=8, default=1, max_digits=18),
+        ),
+        migrations.CreateModel(
+            name='FxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('date', models.DateField()),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('imported_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('currency', 'date')},
+            },
+        ),
+    ]
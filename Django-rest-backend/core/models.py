@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 # Create your models here.
 CATEGORY_CHOICES = (
     ('food', 'Food'),
@@ -8,6 +9,8 @@ CATEGORY_CHOICES = (
     ('entertainment', 'Entertainment'),
     ('other', 'Other'),
 )
+# Currency every stored total is kept in, see core/currency.py
+BASE_CURRENCY = 'INR'
 RECURRENCE_CHOICES = [
     ('none', 'None'),
     ('daily', 'Daily'),
@@ -38,6 +41,21 @@ class Bill(models.Model):
     is_recurring = models.BooleanField(default=False)
     recurrence_type = models.CharField(max_length=20, choices=RECURRENCE_CHOICES, default='none')
     next_due_date = models.DateField(null=True, blank=True)
+    # ISO 4217 code; fx_rate converts amount to the base currency and is
+    # fixed when the bill is created
+    currency = models.CharField(max_length=3, default=BASE_CURRENCY)
+    fx_rate = models.DecimalField(max_digits=18, decimal_places=8, default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'created_at']),
+            models.Index(fields=['created_by', 'created_at']),
+            # Admin list filters and ordering
+            models.Index(fields=['created_at']),
+            models.Index(fields=['category', 'created_at']),
+            models.Index(fields=['split_type', 'created_at']),
+        ]
+
     def __str__(self):
         return f"{self.desc} - {self.amount} by {self.created_by.username} on {self.created_at.strftime('%Y-%m-%d %H:%M:%S')}"
 
@@ -45,7 +63,11 @@ class BillSplit(models.Model):
     bill = models.ForeignKey(Bill, related_name='splits', on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'bill']),
+        ]
 
     def __str__(self):
         return f"{self.user.username} owes {self.amount} for {self.bill.desc}"
@@ -57,6 +79,17 @@ class Settlement(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     bill = models.ForeignKey(Bill, related_name='settlements', on_delete=models.CASCADE, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Client supplied key so retried requests don't record the same payment twice
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
+    currency = models.CharField(max_length=3, default=BASE_CURRENCY)
+    fx_rate = models.DecimalField(max_digits=18, decimal_places=8, default=1)
+
+    class Meta:
+        unique_together = ('payer', 'idempotency_key')
+        indexes = [
+            models.Index(fields=['payer', 'payee', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
 
     def __str__(self):
         return f"{self.payer.username} paid {self.payee.username} {self.amount}"
@@ -70,3 +103,340 @@ class Group(models.Model):
     def __str__(self):
         return self.name
     
+
+
+class BalancePair(models.Model):
+    # One row per pair of users (user_a < user_b); version is bumped on every
+    # settlement and every split between them so concurrent writers for the
+    # same pair can detect each other
+    user_a = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    user_b = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user_a', 'user_b')
+
+
+class BalanceSnapshot(models.Model):
+    # Net balance between two users as of the last batch run; positive means counterparty owes user
+    user = models.ForeignKey(User, related_name='balance_snapshots', on_delete=models.CASCADE)
+    counterparty = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'counterparty')
+
+
+class SpendingSnapshot(models.Model):
+    user = models.ForeignKey(User, related_name='spending_snapshots', on_delete=models.CASCADE)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    count = models.PositiveIntegerField()
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'category', 'month')
+
+
+class GroupPositionSnapshot(models.Model):
+    user = models.ForeignKey(User, related_name='group_position_snapshots', on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, related_name='position_snapshots', on_delete=models.CASCADE)
+    paid = models.DecimalField(max_digits=14, decimal_places=2)
+    share = models.DecimalField(max_digits=14, decimal_places=2)
+    net = models.DecimalField(max_digits=14, decimal_places=2)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'group')
+
+
+class BatchCheckpoint(models.Model):
+    # Last user id fully processed by a resumable batch command
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
+
+
+# Cold storage for fully settled bills, see core/archive.py. Rows keep the
+# primary keys they had in the hot tables.
+
+class ArchivedBill(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    desc = models.CharField(max_length=500)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField()
+    created_by = models.ForeignKey(User, related_name='archived_bills_created', on_delete=models.CASCADE)
+    participants = models.ManyToManyField(User, related_name='archived_bills_participated')
+    split_type = models.CharField(max_length=20)
+    group = models.ForeignKey(Group, related_name='archived_bills', on_delete=models.CASCADE, null=True, blank=True)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    currency = models.CharField(max_length=3, default=BASE_CURRENCY)
+    fx_rate = models.DecimalField(max_digits=18, decimal_places=8, default=1)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.desc} - {self.amount} (archived)"
+
+
+class ArchivedBillSplit(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    bill = models.ForeignKey(ArchivedBill, related_name='splits', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class ArchivedSettlement(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    payer = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    payee = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    bill = models.ForeignKey(ArchivedBill, related_name='settlements', on_delete=models.CASCADE, null=True, blank=True)
+    created_at = models.DateTimeField()
+    currency = models.CharField(max_length=3, default=BASE_CURRENCY)
+    fx_rate = models.DecimalField(max_digits=18, decimal_places=8, default=1)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedDebt(models.Model):
+    # Carry-forward for one direction of a pair: archived splits the debtor
+    # owed the creditor and archived settlements the debtor paid them
+    debtor = models.ForeignKey(User, related_name='archived_debts', on_delete=models.CASCADE)
+    creditor = models.ForeignKey(User, related_name='archived_credits', on_delete=models.CASCADE)
+    owed = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('debtor', 'creditor')
+
+
+class ArchivedSpending(models.Model):
+    # Archived bills folded into the per participant category/month totals
+    user = models.ForeignKey(User, related_name='archived_spending', on_delete=models.CASCADE)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'category', 'month')
+
+
+class ArchivedGroupRollup(models.Model):
+    # Archived group bills: what each member paid and their share of them
+    group = models.ForeignKey(Group, related_name='archived_rollups', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    bill_count = models.PositiveIntegerField(default=0)
+    paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    share = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('group', 'user')
+
+
+JOB_STATUS_CHOICES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+]
+
+
+class Job(models.Model):
+    # Background work picked up by the run_jobs command, see core/jobs.py
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=20, choices=JOB_STATUS_CHOICES, default='queued')
+    # Only one queued job may hold a given key at a time
+    dedup_key = models.CharField(max_length=200, null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'priority', 'run_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedup_key'], condition=models.Q(status='queued'), name='unique_queued_job_dedup_key'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} [{self.status}]"
+
+
+LEDGER_EVENT_CHOICES = [
+    ('split_created', 'Split created'),
+    ('split_removed', 'Split removed'),
+    ('settlement_recorded', 'Settlement recorded'),
+    ('settlement_removed', 'Settlement removed'),
+]
+
+
+class LedgerEvent(models.Model):
+    # Append-only record of every change to what debtor owes creditor; amount
+    # is positive when the debt grows. Written by the signal handlers in core/events.py.
+    kind = models.CharField(max_length=30, choices=LEDGER_EVENT_CHOICES)
+    debtor = models.ForeignKey(User, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    creditor = models.ForeignKey(User, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    # Plain ids, the rows they point at may be gone
+    bill_id = models.BigIntegerField(null=True, blank=True)
+    split_id = models.BigIntegerField(null=True, blank=True)
+    settlement_id = models.BigIntegerField(null=True, blank=True)
+    occurred_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['debtor', 'id']),
+            models.Index(fields=['creditor', 'id']),
+            models.Index(fields=['occurred_at']),
+        ]
+
+
+class LedgerSnapshot(models.Model):
+    # A user's balances after every event up to and including event_id;
+    # balances maps counterparty id to amount, positive when they owe the user
+    user = models.ForeignKey(User, related_name='ledger_snapshots', on_delete=models.CASCADE)
+    event_id = models.BigIntegerField()
+    as_of = models.DateTimeField()
+    balances = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'event_id')
+        indexes = [
+            models.Index(fields=['user', 'as_of']),
+        ]
+
+
+SHARD_PLACEMENT_CHOICES = [
+    ('group', 'Group'),
+    ('user', 'User'),
+]
+
+
+class ShardPlacement(models.Model):
+    # Overrides the hashed shard of a group's bills, or of a user's bills and
+    # settlements outside groups, see core/sharding.py. moving is set while
+    # rebalance_shards copies the rows, writes are refused until it's done.
+    kind = models.CharField(max_length=10, choices=SHARD_PLACEMENT_CHOICES)
+    key = models.BigIntegerField()
+    shard = models.CharField(max_length=50)
+    moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('kind', 'key')
+
+    def __str__(self):
+        return f"{self.kind} {self.key} -> {self.shard}"
+
+
+class Budget(models.Model):
+    # Monthly limit on a user's share of bills in one category; an alert is
+    # raised once spending reaches alert_at percent of it and again past it
+    user = models.ForeignKey(User, related_name='budgets', on_delete=models.CASCADE)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    limit = models.DecimalField(max_digits=12, decimal_places=2)
+    alert_at = models.PositiveSmallIntegerField(default=80)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'category')
+
+    def __str__(self):
+        return f"{self.user.username} {self.category} {self.limit}"
+
+
+class SpendingPeriod(models.Model):
+    # Running total of a user's bill splits per category and month, updated
+    # on every split write by core/budgets.py
+    user = models.ForeignKey(User, related_name='spending_periods', on_delete=models.CASCADE)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'category', 'month')
+        indexes = [
+            models.Index(fields=['month', 'category']),
+        ]
+
+
+BUDGET_ALERT_CHOICES = [
+    ('warning', 'Warning'),
+    ('over', 'Over budget'),
+]
+
+
+class BudgetAlert(models.Model):
+    # At most one alert per level and budget period
+    user = models.ForeignKey(User, related_name='budget_alerts', on_delete=models.CASCADE)
+    category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
+    month = models.DateField()
+    level = models.CharField(max_length=10, choices=BUDGET_ALERT_CHOICES)
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    limit = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    notified_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('user', 'category', 'month', 'level')
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+OUTBOX_KIND_CHOICES = [
+    ('debt_reminder', 'Debt reminder'),
+]
+
+
+class OutboxMessage(models.Model):
+    # Rendered notifications waiting to be delivered; the rows of a kind
+    # also tell how recently a user was last sent one
+    user = models.ForeignKey(User, related_name='outbox_messages', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=30, choices=OUTBOX_KIND_CHOICES)
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'user', 'created_at']),
+            models.Index(fields=['sent_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for {self.user.username}"
+
+
+class FxRate(models.Model):
+    # Units of the base currency one unit of currency was worth on date,
+    # loaded by the import_fx_rates command
+    currency = models.CharField(max_length=3)
+    date = models.DateField()
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+    imported_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('currency', 'date')
+
+    def __str__(self):
+        return f"{self.currency} {self.date} {self.rate}"
@@ -0,0 +1,112 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from .balances import pair_balances, recent_charges
+from .currency import symbol
+from .models import BASE_CURRENCY, OutboxMessage
+
+CENT = Decimal('0.01')
+REMINDER_KIND = 'debt_reminder'
+
+
+def overdue_debts(lo, hi, older_than, min_amount):
+    # {(user_id, other_id): amount} for users lo <= id < hi, positive when
+    # other owes user. Payments go to the oldest charges first, so what is
+    # overdue is the balance minus whatever was charged since older_than,
+    # down to zero: recent charges never turn a debt into a credit.
+    recent = recent_charges(lo, hi, older_than)
+    overdue = {}
+    for (user_id, other_id), amount in pair_balances(lo, hi).items():
+        charged = recent.get((user_id, other_id), Decimal('0'))
+        if amount > 0:
+            amount = max(amount - max(charged, Decimal('0')), Decimal('0'))
+        else:
+            amount = min(amount - min(charged, Decimal('0')), Decimal('0'))
+        amount = amount.quantize(CENT)
+        if amount and abs(amount) >= min_amount:
+            overdue[(user_id, other_id)] = amount
+    return overdue
+
+
+def reminded_since(lo, hi, since):
+    # Users in range already sent a reminder at or after since
+    return set(
+        OutboxMessage.objects
+        .filter(kind=REMINDER_KIND, user_id__gte=lo, user_id__lt=hi, created_at__gte=since)
+        .values_list('user_id', flat=True)
+        .distinct()
+    )
+
+
+def render_digest(username, owe, owed):
+    # owe and owed are [(other_username, amount)] in the base currency, largest first
+    sign = symbol(BASE_CURRENCY)
+    lines = [f'Hi {username},', '']
+    if owe:
+        lines.append('You owe:')
+        lines.extend(f'  {other}: {sign}{amount:.2f}' for other, amount in owe)
+        lines.append('')
+    if owed:
+        lines.append('You are owed:')
+        lines.extend(f'  {other}: {sign}{amount:.2f}' for other, amount in owed)
+        lines.append('')
+    lines.append('Settle up in EvenSplit to stop these reminders.')
+    subject = 'Outstanding balances on EvenSplit'
+    return subject, '\n'.join(lines)
+
+
+def build_reminders(lo, hi, older_than, min_amount, throttle_since, now=None):
+    # Unsaved OutboxMessage rows for users lo <= id < hi
+    overdue = overdue_debts(lo, hi, older_than, min_amount)
+    skipped = reminded_since(lo, hi, throttle_since)
+    by_user = {}
+    for (user_id, other_id), amount in overdue.items():
+        if user_id not in skipped:
+            by_user.setdefault(user_id, []).append((other_id, amount))
+    if not by_user:
+        return []
+
+    ids = set(by_user) | {other_id for pairs in by_user.values() for other_id, _ in pairs}
+    usernames = dict(User.objects.filter(pk__in=ids).values_list('id', 'username'))
+    now = now or timezone.now()
+    messages = []
+    for user_id in sorted(by_user):
+        pairs = sorted(by_user[user_id], key=lambda pair: (-abs(pair[1]), pair[0]))
+        owe = [(usernames.get(other_id, other_id), -amount) for other_id, amount in pairs if amount < 0]
+        owed = [(usernames.get(other_id, other_id), amount) for other_id, amount in pairs if amount > 0]
+        subject, body = render_digest(usernames.get(user_id, user_id), owe, owed)
+        messages.append(OutboxMessage(
+            user_id=user_id, kind=REMINDER_KIND, subject=subject, body=body, created_at=now,
+        ))
+    return messages
+
+
+def deliver_outbox(chunk_size=500):
+    # Send unsent messages through the configured email backend (SMTP, or
+    # the file backend in development), one connection per chunk. Users
+    # without an email address keep their messages in the outbox.
+    sent = 0
+    last_id = 0
+    while True:
+        chunk = list(
+            OutboxMessage.objects
+            .filter(sent_at__isnull=True, id__gt=last_id)
+            .exclude(user__email='')
+            .order_by('id')
+            .values_list('id', 'subject', 'body', 'user__email')[:chunk_size]
+        )
+        if not chunk:
+            return sent
+        last_id = chunk[-1][0]
+        emails = [
+            EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [email])
+            for _, subject, body, email in chunk
+        ]
+        with get_connection() as connection:
+            connection.send_messages(emails)
+        OutboxMessage.objects.filter(pk__in=[row[0] for row in chunk]).update(sent_at=timezone.now())
+        sent += len(chunk)
@@ -0,0 +1,81 @@
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Lists longer than this are encoded and sent in chunks rather than as one body
+STREAM_THRESHOLD = 2000
+STREAM_CHUNK = 500
+
+_encoder = encoders.JSONEncoder()
+
+
+def _default(obj):
+    # Only called for types orjson doesn't encode itself; Decimals become
+    # numbers like in DRF's JSONEncoder, anything rarer (UUIDs are native,
+    # timedeltas, lazy strings, querysets, ...) is left to that encoder
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return _encoder.default(obj)
+
+
+def _escape(content):
+    # Like JSONRenderer: U+2028 and U+2029 are valid JSON but not JavaScript
+    if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+        content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return content
+
+
+if orjson is not None:
+    # Datetimes come out as DRF writes them: isoformat, 'Z' for UTC
+    _OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+    def dumps(data):
+        return _escape(orjson.dumps(data, default=_default, option=_OPTIONS))
+else:
+    def dumps(data):
+        return JSONRenderer().render(data)
+
+
+class FastJSONRenderer(JSONRenderer):
+    # Same output as JSONRenderer, encoded by orjson when it is installed.
+    # Indented output (?indent, the browsable API) still goes through json.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+def _chunks(rows):
+    # A JSON array, STREAM_CHUNK rows at a time
+    yield b'['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == STREAM_CHUNK:
+            yield (b'' if first else b',') + dumps(chunk)[1:-1]
+            chunk = []
+            first = False
+    if chunk:
+        yield (b'' if first else b',') + dumps(chunk)[1:-1]
+    yield b']'
+
+
+def list_response(request, rows, count):
+    # For list views: big lists are streamed to JSON clients instead of being
+    # rendered into one body. rows may be any iterable of count rows.
+    if count > STREAM_THRESHOLD and isinstance(getattr(request, 'accepted_renderer', None), FastJSONRenderer):
+        return StreamingHttpResponse(_chunks(rows), content_type=request.accepted_renderer.media_type)
+    return Response(list(rows))
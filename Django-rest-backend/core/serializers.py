@@ -1,6 +1,22 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Friend,Bill,BillSplit, Settlement,Group
+from .models import BASE_CURRENCY,Friend,Bill,BillSplit, Settlement,Group,Budget,BudgetAlert
+from .budgets import budget_status
+
+
+class CurrencyField(serializers.CharField):
+    # ISO 4217 code; whether a rate exists is checked when the row is saved
+    def __init__(self, **kwargs):
+        kwargs.setdefault('default', BASE_CURRENCY)
+        super().__init__(min_length=3, max_length=3, **kwargs)
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data).upper()
+        if not value.isalpha():
+            raise serializers.ValidationError('Expected a three letter currency code.')
+        return value
+
+
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
     email = serializers.EmailField(required=True)
@@ -93,9 +109,10 @@ class BillSerializer(serializers.ModelSerializer):
         default='none'
     )
     next_due_date = serializers.DateField(required=False, allow_null=True)
+    currency = CurrencyField()
     class Meta:
         model = Bill
-        fields = ['id', 'desc', 'amount', 'created_at', 'created_by', 'participants', 'splits','split_type','group','category','is_recurring', 'recurrence_type', 'next_due_date']
+        fields = ['id', 'desc', 'amount', 'currency', 'created_at', 'created_by', 'participants', 'splits','split_type','group','category','is_recurring', 'recurrence_type', 'next_due_date']
 
 class SettlementSerializer(serializers.ModelSerializer):
     payer = UserSerializer(read_only=True)
@@ -106,10 +123,11 @@ class SettlementSerializer(serializers.ModelSerializer):
     bill = serializers.PrimaryKeyRelatedField(
         queryset=Bill.objects.all(), required=False, allow_null=True
     )
+    currency = CurrencyField()
 
     class Meta:
         model = Settlement
-        fields = ['id', 'payer', 'payee', 'amount', 'bill', 'created_at', 'payee_id']
+        fields = ['id', 'payer', 'payee', 'amount', 'currency', 'bill', 'created_at', 'payee_id']
 
     
 class GroupSerializer(serializers.ModelSerializer):
@@ -118,7 +136,55 @@ class GroupSerializer(serializers.ModelSerializer):
         many=True, queryset=User.objects.all(), source='members', write_only=True
     )
     created_by = UserSerializer(read_only=True)
+    # Filled from queryset annotations, see GroupListCreateView
+    member_count = serializers.IntegerField(read_only=True)
+    bill_count = serializers.IntegerField(read_only=True)
+    total_spend = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)
+    net_position = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)
 
     class Meta:
         model = Group
-        fields = ['id', 'name', 'members', 'members_ids', 'created_by', 'created_at']
\ No newline at end of file
+        fields = ['id', 'name', 'members', 'members_ids', 'created_by', 'created_at',
+                  'member_count', 'bill_count', 'total_spend', 'net_position']
+
+
+class GroupSummarySerializer(GroupSerializer):
+    # Same as GroupSerializer without the member list, for large groups
+
+    class Meta(GroupSerializer.Meta):
+        fields = ['id', 'name', 'created_by', 'created_at',
+                  'member_count', 'bill_count', 'total_spend', 'net_position']
+
+
+class BudgetSerializer(serializers.ModelSerializer):
+    # spent is annotated by BudgetListCreateView, see core/budgets.py
+    spent = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)
+    remaining = serializers.SerializerMethodField()
+    status = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Budget
+        fields = ['id', 'category', 'limit', 'alert_at', 'spent', 'remaining', 'status']
+
+    def validate_limit(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Limit must be greater than zero.')
+        return value
+
+    def validate_alert_at(self, value):
+        if not 1 <= value <= 100:
+            raise serializers.ValidationError('alert_at is a percentage between 1 and 100.')
+        return value
+
+    def get_remaining(self, obj):
+        return f'{obj.limit - obj.spent:.2f}'
+
+    def get_status(self, obj):
+        return budget_status(obj.spent, obj.limit, obj.alert_at)
+
+
+class BudgetAlertSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = BudgetAlert
+        fields = ['id', 'category', 'month', 'level', 'total', 'limit', 'created_at']
@@ -0,0 +1,305 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import F, Max, Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework.exceptions import APIException
+
+from .events import suppress_ledger_events
+from .models import BatchCheckpoint, Bill, BillSplit, Group, Settlement, ShardPlacement
+
+# Database aliases holding bills, splits and settlements, see CORE_SHARDS in
+# settings. Empty when sharding is off and everything lives on default.
+SHARDS = sorted(alias for alias in settings.DATABASES if alias.startswith('shard_'))
+
+# Rows that live on exactly one shard
+SHARDED_MODELS = {'core.bill', 'core.bill_participants', 'core.billsplit', 'core.settlement'}
+# Rows copied to every shard so the foreign keys of sharded rows hold there
+REPLICATED_MODELS = {'auth.user', 'core.group'}
+# Bookkeeping every shard keeps for itself (the id counters)
+LOCAL_MODELS = {'core.batchcheckpoint'}
+# Apps whose tables a shard needs besides the models above
+SHARD_APPS = {'auth', 'contenttypes'}
+
+# Each shard numbers its rows n * ID_STRIDE + its shard number, so ids stay
+# unique across shards and survive a move between them
+ID_STRIDE = 64
+if len(SHARDS) > ID_STRIDE:
+    raise ImproperlyConfigured(f'At most {ID_STRIDE} shards are supported')
+
+_state = threading.local()
+
+
+class ShardMoving(APIException):
+    status_code = 503
+    default_detail = 'This data is being moved between databases, please retry shortly.'
+    default_code = 'shard_moving'
+
+
+@contextmanager
+def on_shard(alias):
+    # Queries on sharded models in this block go to alias
+    previous = getattr(_state, 'shard', None)
+    _state.shard = alias
+    try:
+        yield
+    finally:
+        _state.shard = previous
+
+
+def current_shard():
+    return getattr(_state, 'shard', None)
+
+
+class ShardRouter:
+    # Bills, their participants and splits, and settlements go to the pinned
+    # shard (see on_shard) or the shard of the instance they're reached from.
+    # Without either they fall through to default like every other model.
+
+    def _from_hints(self, hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in SHARDS:
+            return instance._state.db
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not SHARDS:
+            return None
+        label = model._meta.label_lower
+        if label in SHARDED_MODELS:
+            return current_shard() or self._from_hints(hints)
+        if label in REPLICATED_MODELS:
+            # The copy next to the sharded row that led here, for joins
+            return self._from_hints(hints)
+        return None
+
+    def db_for_write(self, model, **hints):
+        if SHARDS and model._meta.label_lower in SHARDED_MODELS:
+            return current_shard() or self._from_hints(hints)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if SHARDS and {obj1._meta.label_lower, obj2._meta.label_lower} & REPLICATED_MODELS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in SHARDS:
+            return None
+        if app_label in SHARD_APPS:
+            return True
+        # Data migrations (no model_name) only ever concern default
+        label = f'{app_label}.{model_name}'
+        return label in SHARDED_MODELS or label in REPLICATED_MODELS or label in LOCAL_MODELS
+
+
+def _placement(kind, key, for_write):
+    row = ShardPlacement.objects.filter(kind=kind, key=key).values_list('shard', 'moving').first()
+    if row is None:
+        return SHARDS[key % len(SHARDS)]
+    shard, moving = row
+    if moving and for_write:
+        raise ShardMoving()
+    return shard
+
+
+def shard_for_group(group_id, for_write=False):
+    if not SHARDS:
+        return DEFAULT_DB_ALIAS
+    return _placement('group', group_id, for_write)
+
+
+def shard_for_user(user_id, for_write=False):
+    # Home of the user's bills outside groups and settlements not tied to a bill
+    if not SHARDS:
+        return DEFAULT_DB_ALIAS
+    return _placement('user', user_id, for_write)
+
+
+def home_shard(group_id, user_id, for_write=False):
+    # Where a new bill goes: its group's shard, or its creator's outside groups
+    if group_id is not None:
+        return shard_for_group(group_id, for_write)
+    return shard_for_user(user_id, for_write)
+
+
+def shard_for_bill(bill_id, for_write=False):
+    # Where an existing bill lives; None when it isn't anywhere
+    if not SHARDS:
+        return DEFAULT_DB_ALIAS
+    try:
+        bill_id = int(bill_id)
+    except (TypeError, ValueError):
+        return None
+    owners = fan_out(lambda: Bill.objects.filter(pk=bill_id).values_list('group_id', 'created_by_id').first())
+    for alias, owner in zip(SHARDS, owners):
+        if owner is not None:
+            if for_write:
+                # Raises while the bill's rows are being moved
+                home_shard(*owner, for_write=True)
+            return alias
+    return None
+
+
+def fan_out(func, *args):
+    # Call func once per shard, in parallel, each call pinned to its shard.
+    # Results come back in SHARDS order; without shards func runs once, here.
+    if not SHARDS:
+        return [func(*args)]
+
+    def run(alias):
+        try:
+            with on_shard(alias):
+                return func(*args)
+        finally:
+            # Connections belong to the pool thread, don't leave them open
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(SHARDS)) as pool:
+        return list(pool.map(run, SHARDS))
+
+
+def _shard_number(alias):
+    return int(alias[len('shard_'):])
+
+
+def next_id(model, alias):
+    # The counter lives on the shard and moves in the same transaction as the
+    # insert, so a rolled back insert gives its number back
+    name = f'ids:{model._meta.db_table}'
+    counters = BatchCheckpoint.objects.using(alias)
+    with transaction.atomic(using=alias):
+        if not counters.filter(name=name).update(position=F('position') + 1):
+            # Start past the ids handed out before sharding, wherever those rows are now
+            legacy = max(
+                model.objects.using(db).aggregate(last=Max('pk'))['last'] or 0
+                for db in [DEFAULT_DB_ALIAS] + SHARDS
+            )
+            try:
+                with transaction.atomic(using=alias):
+                    counters.create(name=name, position=legacy // ID_STRIDE + 1)
+            except IntegrityError:
+                # Another writer created it first
+                counters.filter(name=name).update(position=F('position') + 1)
+        position = counters.filter(name=name).values_list('position', flat=True).get()
+    return position * ID_STRIDE + _shard_number(alias)
+
+
+@receiver(pre_save, sender=Bill)
+@receiver(pre_save, sender=BillSplit)
+@receiver(pre_save, sender=Settlement)
+def assign_id(sender, instance, raw, using, **kwargs):
+    if using in SHARDS and instance.pk is None and not raw:
+        instance.pk = next_id(sender, using)
+
+
+def _copy_fields(instance):
+    # Just what the foreign keys and joins on a shard need; users are copied
+    # without credentials, shards never authenticate anyone
+    if isinstance(instance, User):
+        return {
+            'username': instance.username, 'email': instance.email, 'first_name': instance.first_name,
+            'last_name': instance.last_name, 'is_active': instance.is_active, 'password': '!',
+        }
+    return {'name': instance.name, 'created_by_id': instance.created_by_id}
+
+
+def _replicate(model, instance, alias):
+    fields = _copy_fields(instance)
+    if not model.objects.using(alias).filter(pk=instance.pk).update(**fields):
+        model.objects.using(alias).create(pk=instance.pk, **fields)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Group)
+def replicate_saved(sender, instance, using, raw, **kwargs):
+    if not SHARDS or raw or using != DEFAULT_DB_ALIAS:
+        return
+    for alias in SHARDS:
+        _replicate(sender, instance, alias)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Group)
+def replicate_deleted(sender, instance, using, **kwargs):
+    # Cascades to the shard's bills like it does on default
+    if not SHARDS or using != DEFAULT_DB_ALIAS:
+        return
+    for alias in SHARDS:
+        sender.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+def replicate_all(alias):
+    # Bring a shard's copies of users and groups in line with default
+    for model in (User, Group):
+        stale = set(model.objects.using(alias).values_list('pk', flat=True))
+        for instance in model.objects.iterator():
+            _replicate(model, instance, alias)
+            stale.discard(instance.pk)
+        model.objects.using(alias).filter(pk__in=stale).delete()
+
+
+def data_filters(kind, key):
+    # (bills, standalone settlements) placed by a group or by a user
+    if kind == 'group':
+        return Q(group_id=key), Q(pk__in=[])
+    return Q(group__isnull=True, created_by_id=key), Q(bill__isnull=True, payer_id=key)
+
+
+def _copy(rows, alias):
+    # Raw saves keep created_at, bulk_create would reset it (auto_now_add)
+    for row in rows:
+        row.save_base(using=alias, raw=True, force_insert=True)
+
+
+def _missing(model, alias, rows):
+    # Rows not already on alias, so an interrupted move can simply be rerun
+    present = set(model.objects.using(alias).filter(pk__in=[row.pk for row in rows]).values_list('pk', flat=True))
+    return [row for row in rows if row.pk not in present]
+
+
+def move_rows(source, target, bills, settlements, chunk_size=500):
+    # Copy the bills matching `bills` (with participants, splits and their
+    # settlements) and the settlements matching `settlements` from source to
+    # target, then delete them from source. Returns (bills, settlements) moved.
+    through = Bill.participants.through
+    bill_ids = list(Bill.objects.using(source).filter(bills).order_by('pk').values_list('pk', flat=True))
+    moved_bills = moved_settlements = 0
+    with suppress_ledger_events():
+        for start in range(0, len(bill_ids), chunk_size):
+            chunk = bill_ids[start:start + chunk_size]
+            rows = _missing(Bill, target, Bill.objects.using(source).filter(pk__in=chunk))
+            copied = {row.pk for row in rows}
+            members = [
+                through(bill_id=bill_id, user_id=user_id)
+                for bill_id, user_id in through.objects.using(source).filter(bill_id__in=chunk).values_list('bill_id', 'user_id')
+                if bill_id in copied
+            ]
+            splits = _missing(BillSplit, target, BillSplit.objects.using(source).filter(bill_id__in=chunk))
+            paid = _missing(Settlement, target, Settlement.objects.using(source).filter(bill_id__in=chunk))
+            with transaction.atomic(using=target):
+                _copy(rows, target)
+                # Through rows get fresh ids, nothing refers to them
+                through.objects.using(target).bulk_create(members)
+                _copy(splits, target)
+                _copy(paid, target)
+            with transaction.atomic(using=source):
+                Bill.objects.using(source).filter(pk__in=chunk).delete()
+            moved_bills += len(chunk)
+            moved_settlements += len(paid)
+
+        standalone = list(Settlement.objects.using(source).filter(settlements).order_by('pk'))
+        for start in range(0, len(standalone), chunk_size):
+            chunk = standalone[start:start + chunk_size]
+            with transaction.atomic(using=target):
+                _copy(_missing(Settlement, target, chunk), target)
+            with transaction.atomic(using=source):
+                Settlement.objects.using(source).filter(pk__in=[row.pk for row in chunk]).delete()
+            moved_settlements += len(chunk)
+    return moved_bills, moved_settlements
@@ -0,0 +1,54 @@
+from django.db import transaction
+
+from .balances import group_positions, pair_balances, spending_rollup
+from .models import BalanceSnapshot, GroupPositionSnapshot, SpendingSnapshot
+
+
+def compute_chunk(bounds):
+    # Snapshot rows for users lo <= id < hi, as plain tuples so they can be
+    # sent back from a worker process
+    lo, hi = bounds
+    balances = [
+        (user_id, other_id, amount)
+        for (user_id, other_id), amount in pair_balances(lo, hi).items()
+    ]
+    spending = [
+        (user_id, category, month, total, count)
+        for (user_id, category, month), (total, count) in spending_rollup(lo, hi).items()
+    ]
+    positions = [
+        (user_id, group_id, paid, share)
+        for (user_id, group_id), (paid, share) in group_positions(lo, hi).items()
+    ]
+    return lo, hi, balances, spending, positions
+
+
+def write_chunk(lo, hi, balances, spending, positions):
+    # Replace the snapshot rows of users lo <= id < hi
+    with transaction.atomic():
+        BalanceSnapshot.objects.filter(user_id__gte=lo, user_id__lt=hi).delete()
+        SpendingSnapshot.objects.filter(user_id__gte=lo, user_id__lt=hi).delete()
+        GroupPositionSnapshot.objects.filter(user_id__gte=lo, user_id__lt=hi).delete()
+
+        BalanceSnapshot.objects.bulk_create([
+            BalanceSnapshot(user_id=user_id, counterparty_id=other_id, amount=amount)
+            for user_id, other_id, amount in balances
+        ], batch_size=1000)
+        SpendingSnapshot.objects.bulk_create([
+            SpendingSnapshot(user_id=user_id, category=category, month=month, total=total, count=count)
+            for user_id, category, month, total, count in spending
+        ], batch_size=1000)
+        GroupPositionSnapshot.objects.bulk_create([
+            GroupPositionSnapshot(user_id=user_id, group_id=group_id, paid=paid, share=share, net=paid - share)
+            for user_id, group_id, paid, share in positions
+        ], batch_size=1000)
+
+    return len(balances) + len(spending) + len(positions)
+
+
+def refresh_users(user_ids):
+    # Rebuild the snapshots of a few users, one id at a time
+    rows = 0
+    for user_id in sorted(set(user_ids)):
+        rows += write_chunk(*compute_chunk((user_id, user_id + 1)))
+    return rows
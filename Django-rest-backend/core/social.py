@@ -0,0 +1,199 @@
+import threading
+from array import array
+from collections import Counter, defaultdict
+from itertools import chain
+
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import BatchCheckpoint, Friend, Group
+
+# Scoring for suggested friends
+MUTUAL_FRIEND_WEIGHT = 2
+SHARED_GROUP_WEIGHT = 1
+# Bound the work for very well connected users: only the least connected
+# friends (the most telling ones) are expanded and huge groups are skipped
+MAX_FRIENDS_EXPANDED = 300
+MAX_GROUP_SIZE = 500
+# Pending incremental changes before the arrays are rebuilt
+REBUILD_THRESHOLD = 10000
+
+GENERATION_NAME = 'social_graph'
+
+
+class CSR:
+    # Compressed sparse rows: the neighbours of key k are
+    # indices[indptr[row[k]]:indptr[row[k] + 1]], sorted
+
+    def __init__(self, pairs):
+        self.row = {}
+        self.indptr = array('q', [0])
+        self.indices = array('q')
+        for key, value in sorted(set(pairs)):
+            if key not in self.row:
+                if self.row:
+                    self.indptr.append(len(self.indices))
+                self.row[key] = len(self.row)
+            self.indices.append(value)
+        if self.row:
+            self.indptr.append(len(self.indices))
+
+    def neighbours(self, key):
+        row = self.row.get(key)
+        if row is None:
+            return self.indices[0:0]
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+
+class Edges:
+    # A CSR plus the edges added and removed since it was built
+
+    def __init__(self, pairs):
+        self.csr = CSR(pairs)
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+        self.pending = 0
+
+    def neighbours(self, key):
+        base = self.csr.neighbours(key)
+        if key not in self.added and key not in self.removed:
+            return base
+        return (set(base) - self.removed[key]) | self.added[key]
+
+    def add(self, key, value):
+        self.removed[key].discard(value)
+        self.added[key].add(value)
+        self.pending += 1
+
+    def remove(self, key, value):
+        self.added[key].discard(value)
+        self.removed[key].add(value)
+        self.pending += 1
+
+
+class SocialGraph:
+    # Friendships and group memberships of all users, shared by the process.
+    # Changes made here are applied in place; a generation counter in the
+    # database tells other processes their copy is stale.
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.friends = None
+        self.generation = None
+
+    def _load(self):
+        pairs = Friend.objects.values_list('user_id', 'friend_id')
+        friendships = list(pairs)
+        self.friends = Edges(friendships + [(b, a) for a, b in friendships])
+        memberships = list(Group.members.through.objects.values_list('user_id', 'group_id'))
+        self.groups = Edges(memberships)
+        self.members = Edges([(group_id, user_id) for user_id, group_id in memberships])
+
+    def _current_generation(self):
+        return BatchCheckpoint.objects.filter(name=GENERATION_NAME).values_list('position', flat=True).first() or 0
+
+    def ensure_fresh(self):
+        generation = self._current_generation()
+        with self.lock:
+            pending = self.friends and (self.friends.pending + self.groups.pending + self.members.pending)
+            if self.friends is None or generation != self.generation or pending > REBUILD_THRESHOLD:
+                self._load()
+                self.generation = generation
+
+    def invalidate(self):
+        self.friends = None
+
+    def changed(self, apply):
+        # Bump the shared generation; our own copy stays valid if it was current
+        updated = BatchCheckpoint.objects.filter(name=GENERATION_NAME).update(position=F('position') + 1)
+        if not updated:
+            BatchCheckpoint.objects.get_or_create(name=GENERATION_NAME, defaults={'position': 1})
+        with self.lock:
+            if self.friends is None:
+                return
+            if self.generation is not None and self._current_generation() == self.generation + 1:
+                apply()
+                self.generation += 1
+            else:
+                self.invalidate()
+
+    def suggestions(self, user_id, limit=10):
+        self.ensure_fresh()
+        with self.lock:
+            friends = set(self.friends.neighbours(user_id))
+            expanded = sorted(friends, key=lambda friend_id: len(self.friends.neighbours(friend_id)))
+            mutual = Counter(chain.from_iterable(
+                self.friends.neighbours(friend_id) for friend_id in expanded[:MAX_FRIENDS_EXPANDED]
+            ))
+            groups = [
+                members for members in (self.members.neighbours(group_id) for group_id in self.groups.neighbours(user_id))
+                if len(members) <= MAX_GROUP_SIZE
+            ]
+            shared = Counter(chain.from_iterable(groups))
+
+        excluded = friends | {user_id}
+        scores = Counter()
+        for candidate, count in mutual.items():
+            if candidate not in excluded:
+                scores[candidate] += MUTUAL_FRIEND_WEIGHT * count
+        for candidate, count in shared.items():
+            if candidate not in excluded:
+                scores[candidate] += SHARED_GROUP_WEIGHT * count
+        # Ties go to the lower id so results don't depend on overlay order
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [
+            {'user_id': candidate, 'score': score, 'mutual_friends': mutual[candidate], 'shared_groups': shared[candidate]}
+            for candidate, score in ranked
+        ]
+
+
+graph = SocialGraph()
+
+
+@receiver(post_save, sender=Friend)
+def friend_saved(sender, instance, created, **kwargs):
+    if created:
+        def apply():
+            graph.friends.add(instance.user_id, instance.friend_id)
+            graph.friends.add(instance.friend_id, instance.user_id)
+        graph.changed(apply)
+
+
+@receiver(post_delete, sender=Friend)
+def friend_deleted(sender, instance, **kwargs):
+    def apply():
+        # The reverse row may still exist, keep the edge until both are gone
+        if not Friend.objects.filter(user_id=instance.friend_id, friend_id=instance.user_id).exists():
+            graph.friends.remove(instance.user_id, instance.friend_id)
+            graph.friends.remove(instance.friend_id, instance.user_id)
+    graph.changed(apply)
+
+
+@receiver(m2m_changed, sender=Group.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear' or reverse:
+        # Rare and without the affected ids at hand: reload
+        graph.changed(graph.invalidate)
+        return
+
+    def apply():
+        for user_id in pk_set:
+            if action == 'post_add':
+                graph.groups.add(user_id, instance.pk)
+                graph.members.add(instance.pk, user_id)
+            else:
+                graph.groups.remove(user_id, instance.pk)
+                graph.members.remove(instance.pk, user_id)
+    graph.changed(apply)
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    def apply():
+        for user_id in list(graph.members.neighbours(instance.pk)):
+            graph.groups.remove(user_id, instance.pk)
+            graph.members.remove(instance.pk, user_id)
+    graph.changed(apply)
@@ -0,0 +1,15 @@
+from .jobs import enqueue_on_commit, register
+from .snapshots import refresh_users
+
+
+# Job handlers, registered when the app is ready
+
+@register('refresh_snapshots')
+def refresh_snapshots(user_ids):
+    refresh_users(user_ids)
+
+
+def refresh_snapshots_later(user_ids):
+    # One queued refresh per user, however many writes touch them before it runs
+    for user_id in user_ids:
+        enqueue_on_commit('refresh_snapshots', {'user_ids': [user_id]}, dedup_key=f'snapshots:{user_id}')
@@ -1,3 +1,890 @@
-from django.test import TestCase
+import gzip
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .admin import EstimatedCountPaginator
+from .coalescing import LocalFlights
+from .balances import pair_balance
+from .budgets import budgets_over, month_start
+from .events import balances_at
+from .fast_serializers import bill_rows, group_rows, settlement_rows
+from .jobs import HANDLERS, LOCK_TIMEOUT, claim, enqueue, run
+from .models import (
+    ArchivedBill, ArchivedDebt, ArchivedGroupRollup, BalancePair, Bill, BillSplit, Budget, BudgetAlert, Friend, FxRate, Group, Job, LedgerEvent, LedgerSnapshot,
+    Settlement, ShardPlacement, SpendingPeriod,
+)
+from .reminders import build_reminders
+from .serializers import BillSerializer, GroupSerializer, SettlementSerializer
+from .sharding import ID_STRIDE, SHARDS, on_shard
+from .social import graph
+
+
+def make_friends(*usernames):
+    users = [User.objects.create_user(username, password='pass') for username in usernames]
+    for user in users:
+        for other in users:
+            if other != user:
+                Friend.objects.create(user=user, friend=other)
+    return users
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class APIHelpers:
+    def setUp(self):
+        # Throttle buckets live in the cache
+        cache.clear()
+
+    def add_bill(self, user, amount, participants, **fields):
+        response = client_for(user).post('/api/bills/', {
+            'desc': 'dinner', 'amount': amount, 'split_type': 'equal',
+            'participants': [participant.pk for participant in participants], 'category': 'food', **fields,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()
+
+    def settle(self, payer, payee, amount, key=None, **fields):
+        return client_for(payer).post(
+            '/api/settlements/', {'payee_id': payee.pk, 'amount': amount, **fields},
+            format='json', HTTP_IDEMPOTENCY_KEY=key or str(uuid.uuid4()),
+        )
+
+
+class APITestCase(APIHelpers, TestCase):
+    pass
+
+
+class ShardedTestCase(APIHelpers, TransactionTestCase):
+    # Two in-memory SQLite shards for this class, as CORE_SHARDS=2 would set
+    # up. fan_out reads them from other threads, so no enclosing transaction.
+    databases = '__all__'
+    shards = ['shard_0', 'shard_1']
+
+    @classmethod
+    def setUpClass(cls):
+        configured = connections.configure_settings({
+            alias: {'ENGINE': 'django.db.backends.sqlite3'} for alias in [DEFAULT_DB_ALIAS, *cls.shards]
+        })
+        # Every module shares this list
+        SHARDS[:] = cls.shards
+        cls.addClassCleanup(SHARDS.clear)
+        for alias in cls.shards:
+            connections.settings[alias] = configured[alias]
+            connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            cls.addClassCleanup(cls.drop_shard, alias)
+        super().setUpClass()
+
+    @classmethod
+    def drop_shard(cls, alias):
+        connections[alias].creation.destroy_test_db(':memory:', verbosity=0)
+        del connections[alias]
+        del connections.settings[alias]
+
+
+class LocalFlightsTests(SimpleTestCase):
+    def test_overlapping_calls_share_one_run(self):
+        flights = LocalFlights()
+        started = threading.Event()
+        runs = []
+
+        def compute():
+            runs.append(1)
+            started.set()
+            time.sleep(0.2)
+            return len(runs)
+
+        with ThreadPoolExecutor(4) as pool:
+            leader = pool.submit(flights.run, 'key', compute)
+            started.wait()
+            followers = [pool.submit(flights.run, 'key', compute) for _ in range(3)]
+            results = [leader.result()] + [future.result() for future in followers]
+        self.assertEqual(results, [1, 1, 1, 1])
+        # Nothing is kept once the run is over
+        self.assertEqual(flights.run('key', compute), 2)
+
+    def test_followers_get_the_leaders_error(self):
+        flights = LocalFlights()
+        started = threading.Event()
+
+        def fail():
+            started.set()
+            time.sleep(0.1)
+            raise ValueError('boom')
+
+        with ThreadPoolExecutor(2) as pool:
+            leader = pool.submit(flights.run, 'key', fail)
+            started.wait()
+            follower = pool.submit(flights.run, 'key', lambda: 'ran')
+            with self.assertRaises(ValueError):
+                leader.result()
+            with self.assertRaises(ValueError):
+                follower.result()
+
+
+class CoalescedViewTests(APITestCase):
+    def test_insights_answer_promptly_with_balances(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '1000.00', [alice, bob])
+
+        started = time.monotonic()
+        response = client_for(alice).get('/api/insights/')
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response.status_code, 200)
+        credit = [insight for insight in response.json()['insights'] if insight['type'] == 'credit']
+        self.assertEqual(len(credit), 1)
+        self.assertIn('500.00', credit[0]['message'])
+
+    def test_heavy_views_cost_more_of_the_budget(self):
+        alice, = make_friends('alice')
+        client = client_for(alice)
+        # 600 tokens a minute, 20 per analytics request
+        codes = [client.get('/api/analytics/').status_code for _ in range(31)]
+        self.assertEqual(codes.count(200), 30)
+        self.assertEqual(codes[-1], 429)
+        self.assertEqual(client.get('/api/bills/').status_code, 200)
+
+
+class ReminderTests(APITestCase):
+    def reminders(self):
+        now = timezone.now()
+        messages = build_reminders(0, 10 ** 9, now - timedelta(days=7), Decimal('1'), now - timedelta(days=1), now=now)
+        return {message.user.username: message.body for message in messages}
+
+    def test_debt_charged_within_the_grace_window_is_not_reminded(self):
+        alice, bob = make_friends('alice', 'bob')
+        # Bob was charged 300 and paid back 200, all of it this week
+        self.add_bill(alice, '600.00', [alice, bob])
+        self.assertEqual(self.settle(bob, alice, '200.00').status_code, 201)
+        self.assertEqual(self.reminders(), {})
+
+    def test_overdue_part_of_a_debt_is_reminded(self):
+        alice, bob = make_friends('alice', 'bob')
+        old = self.add_bill(alice, '200.00', [alice, bob])
+        Bill.objects.filter(pk=old['id']).update(created_at=timezone.now() - timedelta(days=30))
+        self.add_bill(alice, '600.00', [alice, bob])
+
+        reminders = self.reminders()
+        self.assertIn('You are owed:\n  bob: ₹100.00', reminders['alice'])
+        self.assertIn('You owe:\n  alice: ₹100.00', reminders['bob'])
+
+
+class ArchiveTests(APITestCase):
+    def test_archive_and_verify_bills_in_another_currency(self):
+        alice, bob = make_friends('alice', 'bob')
+        FxRate.objects.create(currency='USD', date=timezone.localdate() - timedelta(days=400), rate=Decimal('80'))
+        self.add_bill(alice, '100.00', [alice, bob], currency='USD')
+        self.add_bill(alice, '1000.00', [alice, bob])
+        self.assertEqual(self.settle(bob, alice, '50.00', currency='USD').status_code, 201)
+        self.assertEqual(self.settle(bob, alice, '500.00').status_code, 201)
+        long_ago = timezone.now() - timedelta(days=100)
+        Bill.objects.update(created_at=long_ago)
+        Settlement.objects.update(created_at=long_ago)
+
+        out = StringIO()
+        call_command('archive_bills', older_than=90, stdout=out)
+        self.assertIn('Archived 2 bills and 2 settlements', out.getvalue())
+        self.assertEqual(ArchivedBill.objects.get(currency='USD').fx_rate, Decimal('80'))
+        # Rolled up in rupees: 50 USD at 80 plus 500
+        debt = ArchivedDebt.objects.get(debtor=bob, creditor=alice)
+        self.assertEqual((debt.owed, debt.paid), (Decimal('4500.00'), Decimal('4500.00')))
+
+        call_command('verify_archive', stdout=out)
+        self.assertIn('Archive totals match', out.getvalue())
+        self.assertEqual(client_for(alice).get('/api/balances/').json(), {'bob': 0.0})
+
+
+class SettlementTests(APITestCase):
+    def test_cannot_settle_more_than_owed(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '200.00', [alice, bob])
+        response = self.settle(bob, alice, '150.00')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'amount': 'You only owe alice ₹100.00.'})
+        self.assertEqual(self.settle(bob, alice, '100.00').status_code, 201)
+        self.assertEqual(self.settle(bob, alice, '0.01').status_code, 400)
+
+    def test_retry_with_the_same_key_replays_the_settlement(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '200.00', [alice, bob])
+        first = self.settle(bob, alice, '60.00', key='pay-1')
+        again = self.settle(bob, alice, '60.00', key='pay-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json()['id'], first.json()['id'])
+        self.assertEqual(Settlement.objects.count(), 1)
+        self.assertEqual(pair_balance(alice.pk, bob.pk), Decimal('40.00'))
+
+    def test_splits_move_the_pair_version(self):
+        alice, bob = make_friends('alice', 'bob')
+        bill = self.add_bill(alice, '200.00', [alice, bob])
+        pair = BalancePair.objects.get(user_a=alice, user_b=bob)
+        version = pair.version
+        BillSplit.objects.get(bill_id=bill['id'], user=bob).delete()
+        pair.refresh_from_db()
+        self.assertEqual(pair.version, version + 1)
+
+    def test_bill_and_settlement_edits_move_the_pair_versions(self):
+        alice, bob, carol = make_friends('alice', 'bob', 'carol')
+        bill = Bill.objects.get(pk=self.add_bill(alice, '200.00', [alice, bob])['id'])
+        self.assertEqual(self.settle(bob, alice, '50.00').status_code, 201)
+
+        def version(user, other):
+            return BalancePair.objects.get(user_a=user, user_b=other).version
+
+        # The bill moves from the alice/bob pair to bob/carol
+        old = version(alice, bob)
+        bill.created_by = carol
+        bill.save()
+        self.assertGreater(version(alice, bob), old)
+        new = version(bob, carol)
+
+        old = version(alice, bob)
+        settlement = Settlement.objects.get()
+        settlement.payee = carol
+        settlement.save()
+        self.assertGreater(version(alice, bob), old)
+        self.assertGreater(version(bob, carol), new)
+
+    def test_bill_written_while_settling_forces_a_recheck(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '200.00', [alice, bob])
+        calls = []
+
+        def balance_then_bill(user_id, other_id):
+            balance = pair_balance(user_id, other_id)
+            if not calls:
+                # Another request records a bill for the pair after the balance was read
+                bill = Bill.objects.create(desc='taxi', amount=Decimal('20.00'), created_by=bob, split_type='equal')
+                BillSplit.objects.create(bill=bill, user=alice, amount=Decimal('10.00'))
+            calls.append(balance)
+            return balance
+
+        with mock.patch('core.views.pair_balance', side_effect=balance_then_bill):
+            self.assertEqual(self.settle(bob, alice, '100.00').status_code, 201)
+        # The first check's version was stale, so the settlement checked again
+        self.assertEqual(len(calls), 2)
+
+
+class CompressionTests(APITestCase):
+    def test_gzip_bodies_are_padded_against_breach(self):
+        alice, bob = make_friends('alice', 'bob')
+        for _ in range(10):
+            self.add_bill(alice, '10.00', [alice, bob])
+        client = client_for(alice)
+        bodies = [client.get('/api/bills/', HTTP_ACCEPT_ENCODING='gzip') for _ in range(2)]
+        for response in bodies:
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            # FNAME flag: the random bytes ride in the header's file name
+            self.assertTrue(response.content[3] & 0x08)
+        self.assertNotEqual(bodies[0].content, bodies[1].content)
+        self.assertEqual(*[json.loads(gzip.decompress(response.content)) for response in bodies])
+
+
+class LedgerCompactionTests(TestCase):
+    def test_events_past_the_horizon_survive_whatever_their_id(self):
+        alice, bob = make_friends('alice', 'bob')
+        long_ago = timezone.now() - timedelta(days=400)
+
+        def event(amount, occurred_at):
+            return LedgerEvent.objects.create(
+                kind='split_created', debtor=bob, creditor=alice, amount=Decimal(amount), occurred_at=occurred_at,
+            )
+
+        first = event('10.00', long_ago)
+        recent = event('20.00', timezone.now())
+        # Committed late: a higher id than the recent event, an old timestamp
+        late = event('40.00', long_ago)
+
+        call_command('compact_ledger', older_than=365, stdout=StringIO())
+        self.assertEqual(
+            set(LedgerEvent.objects.values_list('id', flat=True)), {recent.pk, late.pk},
+        )
+        self.assertEqual(LedgerSnapshot.objects.get(user=alice).event_id, first.pk)
+        self.assertEqual(balances_at(alice.pk), {bob.pk: Decimal('70.00')})
+        self.assertEqual(balances_at(alice.pk, timezone.now() - timedelta(days=1)), {bob.pk: Decimal('50.00')})
+
+
+class GroupTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol, self.dave = make_friends('alice', 'bob', 'carol', 'dave')
+        self.group = self.add_group(self.alice, [self.bob, self.carol])
+
+    def add_group(self, user, members, name='trip'):
+        response = client_for(user).post(
+            '/api/groups/', {'name': name, 'members_ids': [member.pk for member in members]}, format='json',
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()
+
+    def figures(self, user, **params):
+        response = client_for(user).get('/api/groups/', params)
+        self.assertEqual(response.status_code, 200)
+        return {
+            row['name']: (row['member_count'], row['bill_count'], row['total_spend'], row['net_position'])
+            for row in response.json()
+        }
+
+    def test_list_adds_counts_spend_and_position_with_the_archive(self):
+        members = [self.alice, self.bob, self.carol]
+        self.add_bill(self.alice, '90.00', members, group=self.group['id'])
+        self.add_bill(self.bob, '30.00', members, group=self.group['id'])
+        self.add_bill(self.alice, '500.00', [self.alice, self.bob])
+        self.add_group(self.alice, [], name='empty')
+        self.add_group(self.dave, [self.bob], name='other')
+        # An archived 60 paid by alice, shared by the three
+        group = Group.objects.get(pk=self.group['id'])
+        ArchivedGroupRollup.objects.create(group=group, user=self.alice, bill_count=1, paid=60, share=20)
+        ArchivedGroupRollup.objects.create(group=group, user=self.bob, share=20)
+        ArchivedGroupRollup.objects.create(group=group, user=self.carol, share=20)
+
+        self.assertEqual(self.figures(self.alice), {
+            # 60 - 20 archived, 90 - 30 - 10 hot
+            'trip': (3, 3, '180.00', '90.00'),
+            'empty': (1, 0, '0.00', '0.00'),
+        })
+        self.assertEqual(self.figures(self.bob), {
+            'trip': (3, 3, '180.00', '-30.00'),
+            'other': (2, 0, '0.00', '0.00'),
+        })
+        self.assertEqual(self.figures(self.alice, summary=1), self.figures(self.alice))
+        self.assertNotIn('members', client_for(self.alice).get('/api/groups/?summary=1').json()[0])
+
+    def test_group_bills_page_by_cursor(self):
+        members = [self.alice, self.bob]
+        ids = [self.add_bill(self.alice, '10.00', members, group=self.group['id'])['id'] for _ in range(12)]
+        self.add_bill(self.alice, '10.00', members)
+        # Ties on created_at fall back to the id
+        Bill.objects.filter(pk__in=ids[3:8]).update(created_at=timezone.now() - timedelta(hours=1))
+        expected = list(Bill.objects.filter(group_id=self.group['id']).order_by('-created_at', '-id').values_list('pk', flat=True))
+
+        client = client_for(self.bob)
+        url = f'/api/groups/{self.group["id"]}/bills/?page_size=5'
+        seen = []
+        while url:
+            page = client.get(url).json()
+            self.assertLessEqual(len(page['results']), 5)
+            seen += [bill['id'] for bill in page['results']]
+            url = page['next']
+        self.assertEqual(seen, expected)
+        self.assertEqual(sorted(seen), sorted(ids))
+        self.assertEqual(client_for(self.dave).get(f'/api/groups/{self.group["id"]}/bills/').status_code, 404)
+
+
+class SuggestionTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        # The graph is shared by the process, start from the database
+        graph.invalidate()
+        self.users = {name: User.objects.create_user(name, password='pass') for name in 'abcdefg'}
+        for pair in ['ab', 'ac', 'ad', 'bc', 'be', 'bf', 'ce', 'de', 'df', 'dg']:
+            self.befriend(*pair)
+
+    def befriend(self, first, second):
+        Friend.objects.create(user=self.users[first], friend=self.users[second])
+        Friend.objects.create(user=self.users[second], friend=self.users[first])
+
+    def suggested(self, name='a'):
+        response = client_for(self.users[name]).get('/api/friends/suggestions/')
+        self.assertEqual(response.status_code, 200)
+        return [(row['user']['username'], row['mutual_friends'], row['shared_groups']) for row in response.json()]
+
+    def test_ranked_by_mutual_friends_without_existing_friends(self):
+        # b, c and d are a's friends already and never suggested
+        self.assertEqual(self.suggested(), [('e', 3, 0), ('f', 2, 0), ('g', 1, 0)])
+
+    def test_changes_apply_before_the_arrays_are_rebuilt(self):
+        self.suggested()
+        with mock.patch.object(graph, '_load', side_effect=AssertionError('rebuilt')):
+            self.befriend('c', 'g')
+            Friend.objects.filter(user=self.users['d'], friend=self.users['f']).delete()
+            Friend.objects.filter(user=self.users['f'], friend=self.users['d']).delete()
+            group = Group.objects.create(name='trip', created_by=self.users['a'])
+            group.members.add(self.users['a'], self.users['f'])
+            self.assertEqual(self.suggested(), [('e', 3, 0), ('g', 2, 0), ('f', 1, 1)])
+            self.befriend('a', 'e')
+            self.assertEqual(self.suggested(), [('g', 2, 0), ('f', 1, 1)])
+        self.assertTrue(graph.friends.pending)
+
+    def test_enough_changes_rebuild_the_arrays(self):
+        self.suggested()
+        with mock.patch('core.social.REBUILD_THRESHOLD', 1):
+            self.befriend('c', 'g')
+            # Ties go to the lower id
+            self.assertEqual(self.suggested(), [('e', 3, 0), ('f', 2, 0), ('g', 2, 0)])
+        self.assertEqual(graph.friends.pending, 0)
+
+
+class BudgetTests(APITestCase):
+    def spent(self, user, category):
+        period = SpendingPeriod.objects.filter(user=user, category=category, month=month_start()).first()
+        return (period.total, period.count) if period else None
+
+    def test_running_totals_follow_bill_writes(self):
+        alice, bob = make_friends('alice', 'bob')
+        bill = Bill.objects.get(pk=self.add_bill(alice, '300.00', [alice, bob])['id'])
+        self.add_bill(bob, '50.00', [alice, bob])
+        self.assertEqual(self.spent(alice, 'food'), (Decimal('175.00'), 2))
+        self.assertEqual(self.spent(bob, 'food'), (Decimal('175.00'), 2))
+
+        bill.category = 'travel'
+        bill.save()
+        self.assertEqual(self.spent(alice, 'food'), (Decimal('25.00'), 1))
+        self.assertEqual(self.spent(alice, 'travel'), (Decimal('150.00'), 1))
+
+        split = BillSplit.objects.get(bill=bill, user=bob)
+        split.amount = Decimal('100.00')
+        split.save()
+        self.assertEqual(self.spent(bob, 'travel'), (Decimal('100.00'), 1))
+
+        bill.delete()
+        self.assertEqual(self.spent(alice, 'travel'), (Decimal('0.00'), 0))
+        self.assertEqual(self.spent(bob, 'travel'), (Decimal('0.00'), 0))
+        self.assertEqual(self.spent(bob, 'food'), (Decimal('25.00'), 1))
+
+    def test_each_threshold_alerts_once_a_period(self):
+        alice, bob = make_friends('alice', 'bob')
+        Budget.objects.create(user=alice, category='food', limit=Decimal('200.00'), alert_at=80)
+        self.add_bill(alice, '300.00', [alice, bob])
+        self.assertFalse(BudgetAlert.objects.exists())
+        # 170 of 200 passes the 80% warning, 220 the limit
+        self.add_bill(alice, '40.00', [alice, bob])
+        self.assertEqual(list(BudgetAlert.objects.values_list('level', 'total')), [('warning', Decimal('170.00'))])
+        self.add_bill(alice, '100.00', [alice, bob])
+        self.add_bill(alice, '100.00', [alice, bob])
+        self.assertEqual(sorted(BudgetAlert.objects.values_list('level', flat=True)), ['over', 'warning'])
+
+        self.assertEqual(
+            list(budgets_over(level='over')), [(alice.pk, 'alice', 'food', Decimal('200.00'), Decimal('270.00'))],
+        )
+
+    def test_evaluate_budgets_alerts_budgets_set_after_the_crossing(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '300.00', [alice, bob])
+        Budget.objects.create(user=bob, category='food', limit=Decimal('100.00'), alert_at=80)
+        Budget.objects.create(user=alice, category='food', limit=Decimal('1000.00'), alert_at=80)
+        self.assertFalse(BudgetAlert.objects.exists())
+
+        for _ in range(2):
+            out = StringIO()
+            call_command('evaluate_budgets', stdout=out)
+            self.assertIn('bob: food 150.00/100.00', out.getvalue())
+            self.assertNotIn('alice:', out.getvalue())
+        alert, = BudgetAlert.objects.all()
+        self.assertEqual((alert.user, alert.level, alert.total), (bob, 'over', Decimal('150.00')))
+
+    def test_rebuild_corrects_drifted_totals(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '300.00', [alice, bob])
+        SpendingPeriod.objects.filter(user=alice).update(total=Decimal('1.00'))
+        out = StringIO()
+        call_command('evaluate_budgets', rebuild=True, stdout=out)
+        self.assertIn('1 rows corrected', out.getvalue())
+        self.assertEqual(self.spent(alice, 'food'), (Decimal('150.00'), 1))
+
+
+class AdminTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = make_friends('alice', 'bob', 'carol')
+        self.admin = User.objects.create_superuser('admin', password='pass')
+        self.client.force_login(self.admin)
+
+    def test_count_past_the_limit_is_estimated(self):
+        for _ in range(8):
+            Bill.objects.create(desc='taxi', amount=Decimal('10.00'), created_by=self.alice, split_type='equal')
+        # A gap in the ids, the estimate reads the highest one
+        Bill.objects.filter(pk=Bill.objects.order_by('pk')[2].pk).delete()
+        last = Bill.objects.order_by('-pk').first().pk
+        with mock.patch('core.admin.COUNT_LIMIT', 10):
+            self.assertEqual(EstimatedCountPaginator(Bill.objects.order_by('-pk'), 5).count, 7)
+        with mock.patch('core.admin.COUNT_LIMIT', 3):
+            self.assertEqual(EstimatedCountPaginator(Bill.objects.order_by('-pk'), 5).count, last)
+            # Filtered lists stop at the limit instead of scanning on
+            self.assertEqual(EstimatedCountPaginator(Bill.objects.filter(desc='taxi').order_by('-pk'), 5).count, 4)
+
+    def test_rebuild_balances_queues_one_job_per_user(self):
+        bills = [self.add_bill(self.alice, '30.00', [self.alice, self.bob]) for _ in range(2)]
+        bills.append(self.add_bill(self.carol, '30.00', [self.carol, self.bob]))
+        Job.objects.all().delete()
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/admin/core/bill/', {
+                    'action': 'rebuild_balances', '_selected_action': [bill['id'] for bill in bills],
+                })
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            sorted(Job.objects.values_list('name', 'dedup_key')),
+            sorted(('refresh_snapshots', f'snapshots:{user.pk}') for user in [self.alice, self.bob, self.carol]),
+        )
+
+    def test_creator_and_rate_are_fixed_once_a_bill_exists(self):
+        add = self.client.get('/admin/core/bill/add/').context['adminform'].form.fields
+        self.assertTrue({'created_by', 'currency', 'fx_rate'} <= set(add))
+        bill = self.add_bill(self.alice, '30.00', [self.alice, self.bob])
+        change = self.client.get(f'/admin/core/bill/{bill["id"]}/change/').context['adminform'].form.fields
+        self.assertFalse({'created_by', 'currency', 'fx_rate'} & set(change))
+        self.assertIn('desc', change)
+
+        self.assertEqual(self.settle(self.bob, self.alice, '5.00').status_code, 201)
+        settlement = Settlement.objects.get()
+        change = self.client.get(f'/admin/core/settlement/{settlement.pk}/change/').context['adminform'].form.fields
+        self.assertFalse({'currency', 'fx_rate'} & set(change))
+
+
+class FastSerializerTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = make_friends('alice', 'bob', 'carol')
+        FxRate.objects.create(currency='USD', date=timezone.localdate() - timedelta(days=1), rate=Decimal('80'))
+        response = client_for(self.alice).post(
+            '/api/groups/', {'name': 'trip', 'members_ids': [self.bob.pk, self.carol.pk]}, format='json',
+        )
+        self.group = Group.objects.get(pk=response.json()['id'])
+        ArchivedGroupRollup.objects.create(
+            group=self.group, user=self.alice, bill_count=2, paid=Decimal('120.00'), share=Decimal('45.50'),
+        )
+        bill = self.add_bill(self.alice, '100.00', [self.alice, self.bob, self.carol], group=self.group.pk)
+        self.add_bill(self.bob, '12.34', [self.alice, self.bob], currency='USD', category='travel')
+        self.add_bill(
+            self.carol, '600.00', [self.alice, self.carol], is_recurring=True, recurrence_type='monthly',
+            next_due_date=str(timezone.localdate() + timedelta(days=30)),
+        )
+        self.assertEqual(self.settle(self.alice, self.bob, '10.00', bill=bill['id']).status_code, 201)
+        self.assertEqual(self.settle(self.alice, self.carol, '1.50', currency='USD').status_code, 201)
+
+    def assertSameJSON(self, fast, slow):
+        # Rendered, so a Decimal and its string (or a datetime and its text) compare as the client sees them
+        self.assertEqual(json.loads(JSONRenderer().render(fast)), json.loads(JSONRenderer().render(slow)))
+
+    def test_bills_match_the_serializer(self):
+        bills = Bill.objects.order_by('-created_at')
+        self.assertSameJSON(bill_rows(bills), BillSerializer(bills, many=True).data)
+
+    def test_settlements_match_the_serializer(self):
+        settlements = Settlement.objects.order_by('-created_at')
+        self.assertSameJSON(settlement_rows(settlements), SettlementSerializer(settlements, many=True).data)
+
+    def test_groups_match_the_serializer_with_the_hot_figures(self):
+        response = client_for(self.alice).get('/api/groups/')
+        group = self.group
+        # Annotations from the archive plus the hot bills on top
+        group.member_count, group.bill_count = 3, 3
+        share = BillSplit.objects.get(bill__group=group, user=self.alice).amount
+        group.total_spend, group.net_position = Decimal('220.00'), Decimal('74.50') + Decimal('100.00') - share
+        self.assertSameJSON(response.json(), GroupSerializer([group], many=True).data)
+
+    def test_bench_parity_checks_pass(self):
+        out = StringIO()
+        call_command('bench_serializers', repeat=1, user='alice', stdout=out)
+        self.assertIn('groups: 1 rows', out.getvalue())
+
+
+class LedgerEditTests(APITestCase):
+    def assert_ledger_matches(self, user, others):
+        balances = balances_at(user.pk)
+        for other in others:
+            self.assertEqual(balances.get(other.pk, Decimal('0')), pair_balance(user.pk, other.pk), other.username)
+
+    def test_bill_edits_move_the_ledger_with_the_balances(self):
+        alice, bob, carol = make_friends('alice', 'bob', 'carol')
+        FxRate.objects.create(currency='USD', date=timezone.localdate() - timedelta(days=1), rate=Decimal('80'))
+        data = self.add_bill(alice, '90.00', [alice, bob, carol])
+        bill = Bill.objects.get(pk=data['id'])
+
+        bill.created_by = carol
+        bill.save()
+        self.assert_ledger_matches(alice, [bob, carol])
+        self.assert_ledger_matches(bob, [alice, carol])
+        self.assertEqual(balances_at(carol.pk), {alice.pk: Decimal('30.00'), bob.pk: Decimal('30.00')})
+
+        bill.currency, bill.fx_rate = 'USD', Decimal('80')
+        bill.save()
+        self.assert_ledger_matches(carol, [alice, bob])
+        self.assertEqual(balances_at(carol.pk)[bob.pk], Decimal('2400.00'))
+
+        # Nothing the balances depend on changed, nothing is recorded
+        events = LedgerEvent.objects.count()
+        bill.desc = 'lunch'
+        bill.save()
+        self.assertEqual(LedgerEvent.objects.count(), events)
+
+    def test_settlement_currency_edits_reach_the_ledger(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.add_bill(alice, '1000.00', [alice, bob])
+        self.assertEqual(self.settle(bob, alice, '100.00').status_code, 201)
+        settlement = Settlement.objects.get()
+        # Same amount, now 100 at 4 rupees to the unit
+        settlement.currency, settlement.fx_rate = 'USD', Decimal('4')
+        settlement.save()
+        self.assert_ledger_matches(alice, [bob])
+        self.assertEqual(balances_at(alice.pk), {bob.pk: Decimal('100.00')})
+
+
+class LedgerCursorTests(APITestCase):
+    def test_pages_chain_without_gaps_or_repeats(self):
+        alice, bob = make_friends('alice', 'bob')
+        for amount in ['100.00', '40.00', '300.00', '60.00']:
+            self.add_bill(alice, amount, [alice, bob])
+        self.assertEqual(self.settle(bob, alice, '70.00').status_code, 201)
+        self.add_bill(bob, '80.00', [alice, bob])
+        self.assertEqual(self.settle(bob, alice, '20.00').status_code, 201)
+        # Ties on created_at must still page in a stable order
+        tied = timezone.now() - timedelta(days=1)
+        Bill.objects.filter(amount__in=[Decimal('40.00'), Decimal('300.00')]).update(created_at=tied)
+        Settlement.objects.filter(amount=Decimal('70.00')).update(created_at=tied)
+
+        client = client_for(alice)
+        url = f'/api/friends/{bob.pk}/ledger/?page_size=2'
+        entries = []
+        while url:
+            page = client.get(url).json()
+            self.assertLessEqual(len(page['results']), 2)
+            entries += page['results']
+            url = page['next']
+
+        self.assertEqual(len(entries), 7)
+        self.assertEqual(len({(entry['type'], entry['id']) for entry in entries}), 7)
+        self.assertEqual(entries, sorted(entries, key=lambda entry: entry['created_at'], reverse=True))
+        balance = pair_balance(alice.pk, bob.pk)
+        self.assertEqual(Decimal(entries[0]['balance']), balance)
+        for entry in entries:
+            self.assertEqual(Decimal(entry['balance']), balance)
+            balance -= Decimal(entry['amount'])
+        # The oldest entry starts from nothing owed
+        self.assertEqual(balance, 0)
+
+    def test_cursor_only_pages_its_own_ledger(self):
+        alice, bob, carol = make_friends('alice', 'bob', 'carol')
+        for _ in range(3):
+            self.add_bill(alice, '20.00', [alice, bob, carol])
+        client = client_for(alice)
+        cursor = client.get(f'/api/friends/{bob.pk}/ledger/?page_size=1').json()['next'].split('cursor=')[1]
+        response = client.get(f'/api/friends/{carol.pk}/ledger/?page_size=1&cursor={cursor}')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(client_for(bob).get(f'/api/friends/{alice.pk}/ledger/?cursor={cursor}').status_code, 400)
+
+    def test_tampered_cursor_is_rejected(self):
+        alice, bob = make_friends('alice', 'bob')
+        response = client_for(alice).get(f'/api/friends/{bob.pk}/ledger/?cursor=forged')
+        self.assertEqual(response.status_code, 404)
+
+
+class JobDedupTests(APITestCase):
+    def test_same_key_returns_the_queued_job(self):
+        first = enqueue('refresh_snapshots', {'user_ids': [1]}, dedup_key='snapshots:1')
+        again = enqueue('refresh_snapshots', {'user_ids': [1]}, dedup_key='snapshots:1')
+        self.assertEqual(again.pk, first.pk)
+        self.assertEqual(Job.objects.count(), 1)
+        # Jobs without a key are never merged
+        enqueue('refresh_snapshots', {'user_ids': [1]})
+        enqueue('refresh_snapshots', {'user_ids': [1]})
+        self.assertEqual(Job.objects.count(), 3)
+
+    def test_key_is_free_again_once_the_job_is_claimed(self):
+        first = enqueue('refresh_snapshots', {'user_ids': [1]}, dedup_key='snapshots:1')
+        self.assertEqual(claim('worker-1').pk, first.pk)
+        # Writes after the claim may be missed by the running job
+        second = enqueue('refresh_snapshots', {'user_ids': [1]}, dedup_key='snapshots:1')
+        self.assertNotEqual(second.pk, first.pk)
+
+    def test_failed_job_gives_up_its_key_to_a_queued_copy(self):
+        first = enqueue('missing_handler', dedup_key='missing')
+        job = claim('worker-1')
+        second = enqueue('missing_handler', dedup_key='missing')
+        self.assertFalse(run(job))
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.dedup_key), ('queued', None))
+        self.assertEqual(Job.objects.get(dedup_key='missing').pk, second.pk)
+
+    def test_writes_queue_one_refresh_per_user(self):
+        alice, bob = make_friends('alice', 'bob')
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                self.add_bill(alice, '30.00', [alice, bob])
+        self.assertEqual(
+            sorted(Job.objects.filter(status='queued').values_list('dedup_key', flat=True)),
+            [f'snapshots:{alice.pk}', f'snapshots:{bob.pk}'],
+        )
+
+
+class JobWorkerTests(TestCase):
+    # Two workers interleaved: the first stalls past LOCK_TIMEOUT and the
+    # second takes its job over
+
+    def backdate(self, job):
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - LOCK_TIMEOUT - timedelta(minutes=1))
+        job.refresh_from_db()
+        return job
+
+    def test_only_the_current_holder_finishes_a_job(self):
+        enqueue('noop')
+        with mock.patch.dict(HANDLERS, {'noop': lambda: None}):
+            slow = self.backdate(claim('worker-1'))
+            # worker-1 looks dead, worker-2 takes the job over
+            taken = claim('worker-2')
+            self.assertEqual(taken.pk, slow.pk)
+            self.assertFalse(run(slow))
+            self.assertEqual(Job.objects.get(pk=slow.pk).locked_by, 'worker-2')
+            self.assertTrue(run(taken))
+        self.assertEqual(Job.objects.get(pk=slow.pk).status, 'done')
+
+    def test_finished_job_is_not_requeued_as_stale(self):
+        enqueue('noop')
+        with mock.patch.dict(HANDLERS, {'noop': lambda: None}):
+            job = self.backdate(claim('worker-1'))
+            self.assertTrue(run(job))
+            self.assertIsNone(claim('worker-2'))
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'done')
+
+    def test_stale_job_out_of_attempts_fails(self):
+        job = enqueue('noop', max_attempts=2)
+        for worker in ['worker-1', 'worker-2']:
+            self.backdate(claim(worker))
+        self.assertIsNone(claim('worker-3'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+
+
+class ShardingTests(ShardedTestCase):
+    def place(self, kind, key, shard):
+        ShardPlacement.objects.update_or_create(kind=kind, key=key, defaults={'shard': shard})
+
+    def add_group(self, user, members):
+        response = client_for(user).post(
+            '/api/groups/', {'name': 'trip', 'members_ids': [member.pk for member in members]}, format='json',
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()
+
+    def test_pinned_queries_stay_on_their_shard(self):
+        alice, bob = make_friends('alice', 'bob')
+        with on_shard('shard_1'):
+            bill = Bill.objects.create(desc='taxi', amount=Decimal('10.00'), created_by=alice, split_type='equal')
+            self.assertTrue(Bill.objects.filter(pk=bill.pk).exists())
+        self.assertEqual(bill._state.db, 'shard_1')
+        self.assertFalse(Bill.objects.filter(pk=bill.pk).exists())
+        self.assertFalse(Bill.objects.using('shard_0').filter(pk=bill.pk).exists())
+        # Reached from the bill, its splits follow it without pinning
+        split = bill.splits.create(user=bob, amount=Decimal('5.00'))
+        self.assertEqual(split._state.db, 'shard_1')
+        self.assertTrue(BillSplit.objects.using('shard_1').filter(pk=split.pk).exists())
+        # Everything else stays on default
+        self.assertEqual(LedgerEvent.objects.get(split_id=split.pk).amount, Decimal('5.00'))
+        self.assertEqual(User.objects.using('shard_1').get(pk=bob.pk).password, '!')
+
+    def test_ids_stride_by_shard(self):
+        alice, = make_friends('alice')
+        # Rows from before sharding keep their ids, new ones start past them
+        Bill.objects.create(pk=1000, desc='old', amount=Decimal('1.00'), created_by=alice, split_type='equal')
+        ids = {}
+        for alias in self.shards:
+            with on_shard(alias):
+                ids[alias] = [
+                    Bill.objects.create(desc='new', amount=Decimal('1.00'), created_by=alice, split_type='equal').pk
+                    for _ in range(3)
+                ]
+        for number, alias in enumerate(self.shards):
+            first = ids[alias][0]
+            self.assertGreater(first, 1000)
+            self.assertEqual(first % ID_STRIDE, number)
+            self.assertEqual(ids[alias], [first, first + ID_STRIDE, first + 2 * ID_STRIDE])
+
+    def test_reads_fold_every_shard_together(self):
+        alice, bob = make_friends('alice', 'bob')
+        self.place('user', alice.pk, 'shard_0')
+        self.place('user', bob.pk, 'shard_1')
+        group = self.add_group(alice, [bob])
+        self.place('group', group['id'], 'shard_1')
+        mine = self.add_bill(alice, '100.00', [alice, bob])
+        theirs = self.add_bill(bob, '60.00', [alice, bob])
+        trip = self.add_bill(alice, '40.00', [alice, bob], group=group['id'])
+        self.assertEqual(self.settle(bob, alice, '10.00').status_code, 201)
+        self.assertEqual(
+            [Bill.objects.using(alias).filter(pk__in=[mine['id'], theirs['id'], trip['id']]).count()
+             for alias in [DEFAULT_DB_ALIAS, *self.shards]],
+            [0, 1, 2],
+        )
+
+        client = client_for(alice)
+        # 50 + 20 lent, 30 owed, 10 paid back
+        self.assertEqual(client.get('/api/balances/').json(), {'bob': 30.0})
+        self.assertEqual(client_for(bob).get('/api/balances/').json(), {'alice': -30.0})
+        self.assertEqual(len(client.get('/api/bills/').json()), 3)
+        summary = client.get('/api/analytics/').json()['summary']
+        self.assertEqual((summary['total_bills'], summary['total_amount']), (3, 200.0))
+        row, = client.get('/api/groups/').json()
+        self.assertEqual(
+            (row['member_count'], row['bill_count'], row['total_spend'], row['net_position']),
+            (2, 1, '40.00', '20.00'),
+        )
+
+    def test_rebalancing_keeps_every_answer(self):
+        urls = ['/api/balances/', '/api/bills/', '/api/settlements/', '/api/analytics/', '/api/groups/']
+
+        def answers(users):
+            cache.clear()
+            found = {}
+            for user in users:
+                client = client_for(user)
+                for url in urls:
+                    found[(user.username, url)] = client.get(url).json()
+                for other in users:
+                    # Cursors are signed with a timestamp, compare the entries
+                    url = f'/api/friends/{other.pk}/ledger/?page_size=3'
+                    entries = found[(user.username, other.username)] = []
+                    while other != user and url:
+                        page = client.get(url).json()
+                        entries += page['results']
+                        url = page['next']
+            return found
+
+        # Written before sharding, everything on default
+        SHARDS.clear()
+        alice, bob, carol = make_friends('alice', 'bob', 'carol')
+        group = self.add_group(alice, [bob, carol])
+        for amount in ['90.00', '30.00']:
+            self.add_bill(alice, amount, [alice, bob, carol])
+            self.add_bill(bob, amount, [alice, bob])
+            self.add_bill(carol, amount, [alice, bob, carol], group=group['id'])
+        self.assertEqual(self.settle(alice, bob, '10.00').status_code, 201)
+        self.assertEqual(self.settle(bob, carol, '10.00').status_code, 201)
+        users = [alice, bob, carol]
+        before = answers(users)
+        SHARDS[:] = self.shards
+
+        self.place('user', alice.pk, 'shard_0')
+        self.place('user', bob.pk, 'shard_1')
+        self.place('user', carol.pk, 'shard_0')
+        self.place('group', group['id'], 'shard_1')
+        call_command('rebalance_shards', all=True, grace=0, stdout=StringIO())
+        self.assertFalse(Bill.objects.using(DEFAULT_DB_ALIAS).exists())
+        self.assertFalse(Settlement.objects.using(DEFAULT_DB_ALIAS).exists())
+        # alice's bills on shard_0, bob's and the group's on shard_1
+        self.assertEqual([Bill.objects.using(alias).count() for alias in self.shards], [2, 4])
+        self.assertEqual(answers(users), before)
+
+        call_command('rebalance_shards', user=alice.pk, to='shard_1', grace=0, stdout=StringIO())
+        self.assertEqual([Bill.objects.using(alias).count() for alias in self.shards], [0, 6])
+        self.assertEqual(answers(users), before)
@@ -0,0 +1,42 @@
+from rest_framework.throttling import SimpleRateThrottle
+
+# What a request costs when its view doesn't set throttle_cost
+DEFAULT_COST = 1
+
+
+class CostRateThrottle(SimpleRateThrottle):
+    # A token bucket per user (per address before login): the rate's N tokens
+    # refill evenly over its period and each request takes its view's
+    # throttle_cost, so a user can make N cheap reads a period but only a few
+    # heavy aggregations. The buckets live in the default cache: per process,
+    # or shared by every process when CACHES points at Redis.
+    scope = 'user_cost'
+    cache_format = 'throttle_%(scope)s_%(ident)s'
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        # A cost above the bucket size could never be paid
+        self.cost = min(getattr(view, 'throttle_cost', DEFAULT_COST), self.num_requests)
+        self.now = self.timer()
+        tokens, updated = self.cache.get(self.key, (self.num_requests, self.now))
+        self.tokens = min(self.num_requests, tokens + (self.now - updated) * self.num_requests / self.duration)
+        if self.tokens < self.cost:
+            return False
+        self.cache.set(self.key, (self.tokens - self.cost, self.now), self.duration)
+        return True
+
+    def wait(self):
+        # Seconds until the bucket holds enough tokens again
+        return (self.cost - self.tokens) * self.duration / self.num_requests
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import RegisterView,UserSearchView,FriendListCreateView,BillListCreateView,SettlementListCreateView,BalancesView,GroupListCreateView,AnalyticsView,InsightsView
+from .views import RegisterView,UserSearchView,FriendListCreateView,FriendSuggestionsView,FriendLedgerView,BillListCreateView,SettlementListCreateView,BalancesView,GroupListCreateView,GroupBillListView,AnalyticsView,InsightsView,BudgetListCreateView,BudgetDetailView,BudgetAlertListView
 from rest_framework.authtoken.views import obtain_auth_token
 
 
@@ -8,10 +8,16 @@ urlpatterns = [
     path('login/',obtain_auth_token,name='login'), 
     path('search/',UserSearchView.as_view(),name='user-search'),
     path('friends/',FriendListCreateView.as_view(),name='friend-list-create'),
+    path('friends/suggestions/', FriendSuggestionsView.as_view(), name='friend-suggestions'),
+    path('friends/<int:pk>/ledger/', FriendLedgerView.as_view(), name='friend-ledger'),
     path('bills/', BillListCreateView.as_view(), name='bill-list-create'),
     path('settlements/', SettlementListCreateView.as_view(), name='settlement-list-create'),
     path('balances/', BalancesView.as_view(), name='balances'),
     path('groups/', GroupListCreateView.as_view(), name='group-list-create'),
+    path('groups/<int:pk>/bills/', GroupBillListView.as_view(), name='group-bills'),
     path('analytics/', AnalyticsView.as_view(), name='analytics'),
     path('insights/', InsightsView.as_view(), name='insights'),
+    path('budgets/', BudgetListCreateView.as_view(), name='budget-list-create'),
+    path('budgets/alerts/', BudgetAlertListView.as_view(), name='budget-alerts'),
+    path('budgets/<int:pk>/', BudgetDetailView.as_view(), name='budget-detail'),
 ]   
\ No newline at end of file
@@ -1,13 +1,46 @@
+import heapq
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
 from django.contrib.auth.models import User
-from django.db import models
-from rest_framework import generics,filters,permissions
+from django.db import DEFAULT_DB_ALIAS, models, transaction, IntegrityError
+from rest_framework import generics,filters,permissions,status
 from rest_framework.permissions import AllowAny
-from .serializers import UserSerializer, FriendSerializer, FriendCreateSerializer, BillSerializer,SettlementSerializer,GroupSerializer
-from .models import Friend,Bill,BillSplit,Settlement,Group
-from rest_framework.exceptions import ValidationError
+from .serializers import UserSerializer, FriendSerializer, FriendCreateSerializer, BillSerializer,SettlementSerializer,GroupSerializer,GroupSummarySerializer,BudgetSerializer,BudgetAlertSerializer
+from .models import BASE_CURRENCY,Friend,Bill,BillSplit,Settlement,Group,BalancePair,ArchivedBill,ArchivedDebt,ArchivedGroupRollup,ArchivedSpending,Budget,BudgetAlert
+from .balances import pair_balance
+from .fast_serializers import bill_rows, friend_rows, group_rows, settlement_rows, user_rows
+from .social import graph as social_graph
+from .ledger import ForeignCursor, ledger_page
+from .tasks import refresh_snapshots_later
+from .events import balances_at
+from .budgets import budget_status, spent_this_month
+from .currency import CENT, base_value, converter, rate_on, symbol, viewer_currency
+from .renderers import list_response
+from .coalescing import coalesced
+from .sharding import fan_out, home_shard, on_shard, shard_for_bill, shard_for_group, shard_for_user
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.utils.urls import replace_query_param
+from django.core import signing
+from rest_framework.pagination import CursorPagination
+from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.db.models import Sum
+from django.db.models import Sum, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+logger = logging.getLogger(__name__)
+
+# How many times a settlement is retried when another one races it for the same pair
+SETTLEMENT_RETRIES = 3
+
+def newest_first(row):
+    # Sort key for merging serialized rows from several shards
+    return parse_datetime(row['created_at'])
 
 class RegisterView(generics.ListCreateAPIView):
     queryset = User.objects.all()
@@ -53,6 +86,11 @@ class FriendListCreateView(generics.ListCreateAPIView):
         
         return unique_friendships
 
+    def list(self, request, *args, **kwargs):
+        # Read path skips the ModelSerializer machinery, see fast_serializers
+        rows = friend_rows(request.user)
+        return list_response(request, rows, len(rows))
+
     def perform_create(self, serializer):
         friend = serializer.validated_data['friend']
         # Create the friendship from current user to friend
@@ -73,29 +111,46 @@ class BillListCreateView(generics.ListCreateAPIView):
     def get_queryset(self):
         return Bill.objects.filter(participants=self.request.user).order_by('-created_at')
 
+    def list(self, request, *args, **kwargs):
+        # Each shard's rows come back newest first, merge them
+        parts = fan_out(lambda: bill_rows(self.get_queryset()))
+        rows = heapq.merge(*parts, key=newest_first, reverse=True)
+        return list_response(request, rows, sum(len(part) for part in parts))
+
     def perform_create(self, serializer):
-        bill = serializer.save(created_by=self.request.user)
-        if self.request.user not in bill.participants.all():
-            bill.participants.add(self.request.user)
-        splits_data = self.request.data.get('splits')
-        
-        if bill.split_type == 'equal' or not splits_data:
-            participants = bill.participants.all()
-            split_amount = bill.amount / participants.count()
-            for user in participants:
-                BillSplit.objects.create(bill=bill, user=user, amount=split_amount)
-        else:
-            # For both 'amount' and 'percentage', frontend sends amount
-            total_split_amount = sum(float(split['amount']) for split in splits_data)
-            if round(total_split_amount, 2) != float(bill.amount):
-                raise ValidationError({'splits': 'Sum of split amounts must equal bill amount.'})
-            
-            for split in splits_data:
-                BillSplit.objects.create(
-                    bill=bill,
-                    user_id=split['user_id'],
-                    amount=split['amount']
-                )
+        group = serializer.validated_data.get('group')
+        shard = home_shard(group.pk if group else None, self.request.user.pk, for_write=True)
+        # The rate is fixed now, later rate imports don't change the bill
+        fx_rate = rate_on(serializer.validated_data.get('currency', BASE_CURRENCY))
+        # The splits (on the shard) and the pair versions they bump (on
+        # default) commit together, the shard first, like settlements do
+        with on_shard(shard), transaction.atomic(), transaction.atomic(using=shard, savepoint=False):
+            bill = serializer.save(created_by=self.request.user, fx_rate=fx_rate)
+            if self.request.user not in bill.participants.all():
+                bill.participants.add(self.request.user)
+            splits_data = self.request.data.get('splits')
+
+            if bill.split_type == 'equal' or not splits_data:
+                participants = bill.participants.all()
+                split_amount = bill.amount / participants.count()
+                for user in participants:
+                    BillSplit.objects.create(bill=bill, user=user, amount=split_amount)
+            else:
+                # For both 'amount' and 'percentage', frontend sends amount
+                total_split_amount = sum(float(split['amount']) for split in splits_data)
+                if round(total_split_amount, 2) != float(bill.amount):
+                    raise ValidationError({'splits': 'Sum of split amounts must equal bill amount.'})
+
+                for split in splits_data:
+                    BillSplit.objects.create(
+                        bill=bill,
+                        user_id=split['user_id'],
+                        amount=split['amount']
+                    )
+
+        # Snapshot rollups are rebuilt by the job worker, not in the request
+        user_ids = set(bill.splits.values_list('user_id', flat=True)) | {bill.created_by_id}
+        refresh_snapshots_later(user_ids)
 
 
 class SettlementListCreateView(generics.ListCreateAPIView):
@@ -106,163 +161,517 @@ class SettlementListCreateView(generics.ListCreateAPIView):
         return Settlement.objects.filter(
             models.Q(payer=self.request.user) | models.Q(payee=self.request.user)
         ).order_by('-created_at')
-    
+
+    def list(self, request, *args, **kwargs):
+        parts = fan_out(lambda: settlement_rows(self.get_queryset()))
+        rows = heapq.merge(*parts, key=newest_first, reverse=True)
+        return list_response(request, rows, sum(len(part) for part in parts))
+
     def create(self, request, *args, **kwargs):
-        print(f"Settlement creation request data: {request.data}")  # Debug log
+        # A settlement lives with its bill, or on the payer's shard without one;
+        # retries carry the same bill so the idempotency lookups stay on one shard
+        bill_id = request.data.get('bill')
+        shard = (shard_for_bill(bill_id, for_write=True) if bill_id else None) or shard_for_user(request.user.pk, for_write=True)
+        with on_shard(shard):
+            return self.create_on_shard(request, shard)
+
+    def create_on_shard(self, request, shard):
+        key = request.headers.get('Idempotency-Key') or None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('settlement.request payer=%s key=%s data=%r', request.user.pk, key, dict(request.data))
+
+        # A retried request returns the settlement recorded the first time
+        if key:
+            existing = Settlement.objects.filter(payer=request.user, idempotency_key=key).first()
+            if existing is not None:
+                logger.info('settlement.replayed id=%s payer=%s key=%s', existing.pk, request.user.pk, key)
+                return Response(self.get_serializer(existing).data, status=status.HTTP_200_OK)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
         try:
-            response = super().create(request, *args, **kwargs)
-            print(f"Settlement created successfully")  # Debug log
-            return response
-        except Exception as e:
-            print(f"Settlement creation error: {str(e)}")  # Debug log
-            return Response({'error': str(e)}, status=400)
-    
-    def perform_create(self, serializer):
+            self.perform_create(serializer, idempotency_key=key, shard=shard)
+        except IntegrityError:
+            # A concurrent retry with the same key won the insert
+            if not key:
+                raise
+            existing = Settlement.objects.get(payer=request.user, idempotency_key=key)
+            return Response(self.get_serializer(existing).data, status=status.HTTP_200_OK)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def perform_create(self, serializer, idempotency_key=None, shard=DEFAULT_DB_ALIAS):
         # The payer is always the current user
-        settlement = serializer.save(payer=self.request.user)
-        print(f"Created settlement: {settlement.payer.username} paid {settlement.payee.username} ${settlement.amount}")  # Debug log
+        payer = self.request.user
+        payee = serializer.validated_data['payee']
+        amount = serializer.validated_data['amount']
+        if payee == payer:
+            raise ValidationError({'payee_id': 'You cannot settle with yourself.'})
+        if amount <= 0:
+            raise ValidationError({'amount': 'Amount must be greater than zero.'})
+        currency = serializer.validated_data.get('currency', BASE_CURRENCY)
+        fx_rate = rate_on(currency)
+
+        user_a, user_b = sorted((payer.pk, payee.pk))
+        for attempt in range(SETTLEMENT_RETRIES):
+            # The pair version is on default, the settlement on its shard: one
+            # transaction each, rolled back together
+            with transaction.atomic(), transaction.atomic(using=shard, savepoint=False):
+                # Row lock where the database supports it, version check everywhere else
+                pair, _ = BalancePair.objects.select_for_update().get_or_create(user_a_id=user_a, user_b_id=user_b)
+                # The balance is in the base currency, compare in the settlement's
+                outstanding = (-pair_balance(payer.pk, payee.pk) / fx_rate).quantize(CENT)
+                if amount > outstanding:
+                    raise ValidationError({
+                        'amount': f'You only owe {payee.username} {symbol(currency)}{max(outstanding, 0):.2f}.'
+                    })
+                settlement = Settlement.objects.create(
+                    payer=payer, idempotency_key=idempotency_key, fx_rate=fx_rate, **serializer.validated_data
+                )
+                bumped = BalancePair.objects.filter(pk=pair.pk, version=pair.version).update(
+                    version=models.F('version') + 1
+                )
+                if bumped:
+                    serializer.instance = settlement
+                    refresh_snapshots_later([payer.pk, payee.pk])
+                    logger.info(
+                        'settlement.created id=%s payer=%s payee=%s amount=%s currency=%s',
+                        settlement.pk, payer.pk, payee.pk, amount, currency,
+                    )
+                    return
+                # Another settlement for this pair committed since we read it
+                transaction.set_rollback(True)
+                transaction.set_rollback(True, using=shard)
+            logger.debug('settlement.conflict payer=%s payee=%s attempt=%s', payer.pk, payee.pk, attempt)
+
+        logger.warning('settlement.gave_up payer=%s payee=%s', payer.pk, payee.pk)
+        raise ValidationError({'non_field_errors': 'Balance changed while settling, please retry.'})
 
 class BalancesView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    # Out of the per-user throttle budget, where a plain read costs 1
+    throttle_cost = 5
 
+    @coalesced
     def get(self, request):
+        return Response(self.balances(request))
+
+    def balances(self, request):
+        # {username: amount in the viewer's currency}, positive when they owe
+        # the user; not coalesced, so other views can call it inside their own flight
         user = request.user
-        balances = {}
-
-        # Calculate what the user owes to others (from BillSplits)
-        splits = BillSplit.objects.filter(user=user)
-        for split in splits:
-            if split.bill.created_by != user:
-                friend = split.bill.created_by
-                balances.setdefault(friend.username, 0)
-                balances[friend.username] -= float(split.amount)
-
-        # Calculate what others owe to the user (from BillSplits)
-        bills = Bill.objects.filter(created_by=user)
-        for bill in bills:
-            for split in bill.splits.all():
-                if split.user != user:
-                    balances.setdefault(split.user.username, 0)
-                    balances[split.user.username] += float(split.amount)
-
-        # Apply settlements to balance calculations
-        # When user pays someone, it reduces what they owe (makes negative balance less negative)
-        settlements_paid = Settlement.objects.filter(payer=user)
-        for s in settlements_paid:
-            balances.setdefault(s.payee.username, 0)
-            balances[s.payee.username] += float(s.amount)  # Reduces debt (less negative)
-
-        # When user receives payment, it reduces what others owe them (makes positive balance less positive)
-        settlements_received = Settlement.objects.filter(payee=user)
-        for s in settlements_received:
-            balances.setdefault(s.payer.username, 0)
-            balances[s.payer.username] -= float(s.amount)  # Reduces what they owe to user
-
-        return Response(balances)
-    
+        # Sums are in the base currency, converted once per friend at the end
+        convert = converter(viewer_currency(request))
+        balances = defaultdict(Decimal)
+
+        # ?at=<ISO datetime> reconstructs past balances from the event ledger
+        if request.query_params.get('at'):
+            at = parse_datetime(request.query_params['at'])
+            if at is None:
+                raise ValidationError({'at': 'Expected an ISO 8601 datetime.'})
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+            past = balances_at(user.pk, at)
+            usernames = dict(User.objects.filter(pk__in=past).values_list('id', 'username'))
+            return {usernames[other_id]: float(convert(amount)) for other_id, amount in past.items() if other_id in usernames}
+
+        # Every shard holds part of the user's bills and settlements
+        for part in fan_out(self.shard_balances, user):
+            for username, amount in part:
+                balances[username] += amount
+
+        # Carry-forward of bills and settlements that were archived
+        for username, owed, paid in ArchivedDebt.objects.filter(debtor=user).values_list('creditor__username', 'owed', 'paid'):
+            balances[username] += paid - owed
+        for username, owed, paid in ArchivedDebt.objects.filter(creditor=user).values_list('debtor__username', 'owed', 'paid'):
+            balances[username] += owed - paid
+
+        return {username: float(convert(amount)) for username, amount in balances.items()}
+
+    def shard_balances(self, user):
+        # [(username, amount)] from grouped sums, positive when they owe the user
+        split_value = Sum(base_value('amount', 'bill__fx_rate'))
+        splits = BillSplit.objects.exclude(user=F('bill__created_by'))
+        settlements = Settlement.objects.all()
+        rows = []
+
+        # What the user owes to bill creators
+        owed = splits.filter(user=user).values_list('bill__created_by__username').annotate(total=split_value).order_by()
+        rows.extend((username, -total) for username, total in owed)
+        # What others owe the user for bills they created
+        lent = splits.filter(bill__created_by=user).values_list('user__username').annotate(total=split_value).order_by()
+        rows.extend(lent)
+        # Paying someone reduces the debt, being paid reduces the credit
+        paid = settlements.filter(payer=user).values_list('payee__username').annotate(total=Sum(base_value())).order_by()
+        rows.extend(paid)
+        received = settlements.filter(payee=user).values_list('payer__username').annotate(total=Sum(base_value())).order_by()
+        rows.extend((username, -total) for username, total in received)
+        return rows
+
 class GroupListCreateView(generics.ListCreateAPIView):
-    serializer_class = GroupSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_serializer_class(self):
+        # ?summary=1 leaves out the member lists
+        if self.request.method == 'GET' and self.request.query_params.get('summary'):
+            return GroupSummarySerializer
+        return GroupSerializer
+
     def get_queryset(self):
-        return Group.objects.filter(members=self.request.user)
+        # Annotated with what default knows: members and the archive rollups.
+        # The hot bills are on the shards, list() adds them (group_figures).
+        user = self.request.user
+        decimal = models.DecimalField(max_digits=14, decimal_places=2)
+        zero = models.Value(Decimal('0'), output_field=decimal)
+
+        # Correlated subqueries so the aggregates don't multiply each other
+        member_count = (
+            Group.members.through.objects.filter(group=OuterRef('pk'))
+            .values('group').annotate(c=models.Count('*')).values('c')
+        )
+        # Archived group bills only survive in the rollup, in the base currency
+        archived = ArchivedGroupRollup.objects.filter(group=OuterRef('pk')).values('group')
+        archived_position = archived.filter(user=user).annotate(t=Sum(F('paid') - F('share'))).values('t')
+
+        queryset = (
+            Group.objects.filter(members=user)
+            .select_related('created_by')
+            .annotate(
+                member_count=Coalesce(Subquery(member_count), 0),
+                bill_count=Coalesce(Subquery(archived.annotate(c=Sum('bill_count')).values('c')), 0),
+                total_spend=Coalesce(Subquery(archived.annotate(t=Sum('paid')).values('t'), output_field=decimal), zero),
+                net_position=Coalesce(Subquery(archived_position, output_field=decimal), zero),
+            )
+            .order_by('-created_at')
+        )
+        if self.get_serializer_class() is GroupSerializer:
+            queryset = queryset.prefetch_related('members')
+        return queryset
+
+    def group_figures(self, user):
+        # {group_id: [bill_count, total_spend, net_position]} of the hot bills
+        # in the user's groups, from every shard
+        group_ids = list(Group.members.through.objects.filter(user=user).values_list('group_id', flat=True))
+        figures = defaultdict(lambda: [0, Decimal('0'), Decimal('0')])
+        for bills, shares in fan_out(self.shard_group_figures, user, group_ids):
+            for group_id, count, total, paid in bills:
+                figures[group_id][0] += count
+                figures[group_id][1] += total
+                figures[group_id][2] += paid or 0
+            for group_id, share in shares:
+                figures[group_id][2] -= share
+        return figures
+
+    def shard_group_figures(self, user, group_ids):
+        # Amounts in the base currency
+        value = base_value()
+        bills = (
+            Bill.objects.filter(group__in=group_ids).values_list('group')
+            .annotate(count=models.Count('id'), total=Sum(value), paid=Sum(value, filter=models.Q(created_by=user)))
+            .order_by()
+        )
+        shares = (
+            BillSplit.objects.filter(bill__group__in=group_ids, user=user).values_list('bill__group')
+            .annotate(total=Sum(base_value('amount', 'bill__fx_rate')))
+            .order_by()
+        )
+        return list(bills), list(shares)
+
+    def list(self, request, *args, **kwargs):
+        summary = self.get_serializer_class() is GroupSummarySerializer
+        rows = group_rows(self.get_queryset(), summary=summary, hot=self.group_figures(request.user))
+        return list_response(request, rows, len(rows))
 
     def perform_create(self, serializer):
         group = serializer.save(created_by=self.request.user)
         group.members.add(self.request.user)
 
+class GroupBillsPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    # Matches the (group, created_at) index on Bill
+    ordering = ('-created_at', '-id')
+
+
+class GroupBillListView(generics.ListAPIView):
+    serializer_class = BillSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = GroupBillsPagination
+
+    def get_queryset(self):
+        group = get_object_or_404(Group, pk=self.kwargs['pk'], members=self.request.user)
+        # A group's bills all live on the group's shard
+        self.shard = shard_for_group(group.pk)
+        return Bill.objects.using(self.shard).filter(group=group)
+
+    def list(self, request, *args, **kwargs):
+        # Paginate on the bare rows, then serialize just the page
+        page = self.paginate_queryset(self.get_queryset().only('id', 'created_at'))
+        with on_shard(self.shard):
+            rows = {row['id']: row for row in bill_rows(Bill.objects.filter(pk__in=[bill.pk for bill in page]))}
+        return self.get_paginated_response([rows[bill.pk] for bill in page])
+
+def with_archived(rows, archived, key):
+    # Fold archived spending rollups (or another shard's rows) into per-key aggregates
+    merged = {row[key]: dict(row) for row in rows}
+    for row in archived:
+        entry = merged.setdefault(row[key], {key: row[key], 'total': 0, 'count': 0})
+        entry['total'] += row['total']
+        entry['count'] += row['count']
+        entry['avg'] = entry['total'] / entry['count']
+    return list(merged.values())
+
+
+class FriendSuggestionsView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+        suggestions = social_graph.suggestions(request.user.pk, limit)
+        users = user_rows(row['user_id'] for row in suggestions)
+        return Response([
+            {
+                'user': users[row['user_id']],
+                'mutual_friends': row['mutual_friends'],
+                'shared_groups': row['shared_groups'],
+                'score': row['score'],
+            }
+            for row in suggestions
+            if row['user_id'] in users
+        ])
+
+class FriendLedgerView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    page_size = 20
+    max_page_size = 100
+
+    def get(self, request, pk):
+        other = get_object_or_404(User, pk=pk)
+        try:
+            size = min(int(request.query_params.get('page_size', self.page_size)), self.max_page_size)
+        except ValueError:
+            size = self.page_size
+        try:
+            entries, next_cursor = ledger_page(request.user.pk, other.pk, max(size, 1), request.query_params.get('cursor'))
+        except signing.BadSignature:
+            raise NotFound('Invalid cursor.')
+        except ForeignCursor:
+            raise ValidationError({'cursor': 'This cursor belongs to another ledger.'})
+
+        results = [
+            {
+                **entry,
+                'amount': f"{entry['amount']:.2f}",
+                'balance': f"{entry['balance']:.2f}",
+                'created_at': serializers.DateTimeField().to_representation(entry['created_at']),
+            }
+            for entry in entries
+        ]
+        next_url = None
+        if next_cursor:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+        return Response({
+            'friend': {'id': other.pk, 'username': other.username},
+            'next': next_url,
+            'results': results,
+        })
+
 class AnalyticsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_cost = 20
 
+    @coalesced
     def get(self, request):
         user = request.user
-        
-        # Get bills where user participated (not just created)
-        user_bills = Bill.objects.filter(participants=user)
-        
-        # Total spent per category
-        category_data = (
-            user_bills
-            .values('category')
-            .annotate(
-                total=models.Sum('amount'),
-                count=models.Count('id'),
-                avg=models.Avg('amount')
-            )
-            .order_by('-total')
-        )
-        
-        # Total spent per month with more details
-        monthly_data = (
-            user_bills
-            .extra({'month': "strftime('%%Y-%%m', created_at)"})
-            .values('month')
-            .annotate(
-                total=models.Sum('amount'),
-                count=models.Count('id'),
-                avg=models.Avg('amount')
-            )
-            .order_by('month')
-        )
-        
-        # Calculate additional stats
-        total_bills = user_bills.count()
-        total_amount = user_bills.aggregate(total=models.Sum('amount'))['total'] or 0
-        avg_bill_amount = user_bills.aggregate(avg=models.Avg('amount'))['avg'] or 0
-        
-        # Most expensive bill
-        most_expensive = user_bills.order_by('-amount').first()
-        
+        currency = viewer_currency(request)
+        convert = converter(currency)
+
         # Recent trends (last 30 days vs previous 30 days)
         from datetime import datetime, timedelta
         now = datetime.now()
         last_30_days = now - timedelta(days=30)
         prev_30_days = now - timedelta(days=60)
-        
-        recent_spending = user_bills.filter(created_at__gte=last_30_days).aggregate(
-            total=models.Sum('amount'), count=models.Count('id')
-        )
-        previous_spending = user_bills.filter(
-            created_at__gte=prev_30_days, created_at__lt=last_30_days
-        ).aggregate(
-            total=models.Sum('amount'), count=models.Count('id')
-        )
-        
+
+        # The user's bills are spread over the shards, fold their figures together.
+        # Everything is summed in the base currency and converted at the end.
+        parts = fan_out(self.shard_figures, user, last_30_days, prev_30_days)
+        figures = parts[0]
+        for part in parts[1:]:
+            figures = self.merge_figures(figures, part)
+        category_data = figures['by_category']
+        monthly_data = figures['by_month']
+        total_bills = figures['count']
+        total_amount = figures['total']
+        avg_bill_amount = figures['avg']
+        most_expensive = figures['most_expensive']
+        recent_spending = figures['recent']
+        previous_spending = figures['previous']
+
+        archived = ArchivedSpending.objects.filter(user=user)
+        if archived.exists():
+            category_data = sorted(
+                with_archived(category_data, archived.values('category').annotate(
+                    total=models.Sum('total'), count=models.Sum('count')
+                ), 'category'),
+                key=lambda row: row['total'], reverse=True
+            )
+            archived_months = [
+                {'month': row['month'].strftime('%Y-%m'), 'total': row['total'], 'count': row['count']}
+                for row in archived.values('month').annotate(total=models.Sum('total'), count=models.Sum('count'))
+            ]
+            monthly_data = sorted(with_archived(monthly_data, archived_months, 'month'), key=lambda row: row['month'])
+
+        archived_totals = archived.aggregate(total=models.Sum('total'), count=models.Sum('count'))
+        if archived_totals['count']:
+            total_bills += archived_totals['count']
+            total_amount += archived_totals['total']
+            avg_bill_amount = total_amount / total_bills
+            archived_top = (
+                ArchivedBill.objects.filter(participants=user).annotate(value=base_value()).order_by('-value').first()
+            )
+            if most_expensive is None or archived_top.value > most_expensive.value:
+                most_expensive = archived_top
+
+        def converted(rows):
+            return [
+                {**row, **{field: convert(row[field]) for field in ('total', 'avg') if field in row}}
+                for row in rows
+            ]
+
         return Response({
-            'by_category': list(category_data),
-            'by_month': list(monthly_data),
+            'currency': currency,
+            'by_category': converted(category_data),
+            'by_month': converted(monthly_data),
             'summary': {
                 'total_bills': total_bills,
-                'total_amount': float(total_amount),
-                'avg_bill_amount': float(avg_bill_amount),
+                'total_amount': float(convert(total_amount)),
+                'avg_bill_amount': float(convert(avg_bill_amount)),
                 'most_expensive_bill': {
-                    'amount': float(most_expensive.amount) if most_expensive else 0,
+                    'amount': float(convert(most_expensive.value)) if most_expensive else 0,
                     'description': most_expensive.desc if most_expensive else '',
                     'category': most_expensive.category if most_expensive else ''
                 },
                 'recent_trend': {
                     'last_30_days': {
-                        'total': float(recent_spending['total'] or 0),
+                        'total': float(convert(recent_spending['total'])),
                         'count': recent_spending['count']
                     },
                     'previous_30_days': {
-                        'total': float(previous_spending['total'] or 0),
+                        'total': float(convert(previous_spending['total'])),
                         'count': previous_spending['count']
                     }
                 }
             }
         })
-    
+
+    def shard_figures(self, user, last_30_days, prev_30_days):
+        # Get bills where user participated (not just created), valued in the base currency
+        user_bills = Bill.objects.filter(participants=user)
+        value = base_value()
+
+        # Total spent per category
+        category_data = (
+            user_bills
+            .values('category')
+            .annotate(
+                total=models.Sum(value),
+                count=models.Count('id'),
+                avg=models.Avg(value)
+            )
+            .order_by('-total')
+        )
+
+        # Total spent per month with more details
+        monthly_data = (
+            user_bills
+            .extra({'month': "strftime('%%Y-%%m', created_at)"})
+            .values('month')
+            .annotate(
+                total=models.Sum(value),
+                count=models.Count('id'),
+                avg=models.Avg(value)
+            )
+            .order_by('month')
+        )
+
+        return {
+            'by_category': list(category_data),
+            'by_month': list(monthly_data),
+            'count': user_bills.count(),
+            'total': user_bills.aggregate(total=models.Sum(value))['total'] or 0,
+            'avg': user_bills.aggregate(avg=models.Avg(value))['avg'] or 0,
+            # Most expensive bill
+            'most_expensive': user_bills.annotate(value=value).order_by('-value').first(),
+            'recent': user_bills.filter(created_at__gte=last_30_days).aggregate(
+                total=models.Sum(value), count=models.Count('id')
+            ),
+            'previous': user_bills.filter(
+                created_at__gte=prev_30_days, created_at__lt=last_30_days
+            ).aggregate(
+                total=models.Sum(value), count=models.Count('id')
+            ),
+        }
+
+    def merge_figures(self, figures, other):
+        count = figures['count'] + other['count']
+        total = figures['total'] + other['total']
+        most_expensive = max(
+            (bill for bill in (figures['most_expensive'], other['most_expensive']) if bill is not None),
+            key=lambda bill: bill.value, default=None,
+        )
+        return {
+            'by_category': sorted(
+                with_archived(figures['by_category'], other['by_category'], 'category'),
+                key=lambda row: row['total'], reverse=True
+            ),
+            'by_month': sorted(
+                with_archived(figures['by_month'], other['by_month'], 'month'), key=lambda row: row['month']
+            ),
+            'count': count,
+            'total': total,
+            'avg': total / count if count else 0,
+            'most_expensive': most_expensive,
+            'recent': {
+                'total': (figures['recent']['total'] or 0) + (other['recent']['total'] or 0),
+                'count': figures['recent']['count'] + other['recent']['count'],
+            },
+            'previous': {
+                'total': (figures['previous']['total'] or 0) + (other['previous']['total'] or 0),
+                'count': figures['previous']['count'] + other['previous']['count'],
+            },
+        }
+
 class InsightsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_cost = 20
 
+    @coalesced
     def get(self, request):
         user = request.user
-        user_bills = Bill.objects.filter(participants=user)
+        # Bills are valued in the base currency, money shown in the viewer's
+        currency = viewer_currency(request)
+        convert = converter(currency)
+        sign = symbol(currency)
+
+        from datetime import datetime, timedelta
+        now = datetime.now()
+        last_30_days = now - timedelta(days=30)
+        prev_30_days = now - timedelta(days=60)
+
+        # The user's bills are spread over the shards, fold their figures together
+        parts = fan_out(self.shard_figures, user, now, last_30_days, prev_30_days)
+        figures = parts[0]
+        for part in parts[1:]:
+            figures = self.merge_figures(figures, part)
         
         insights = []
         
-        if not user_bills.exists():
+        archived = ArchivedSpending.objects.filter(user=user)
+        if not figures['count'] and not archived.exists():
             insights.append({
                 'type': 'welcome',
                 'title': '👋 Welcome to EvenSplit!',
@@ -272,16 +681,14 @@ class InsightsView(APIView):
             return Response({'insights': insights})
         
         # Category analysis
-        category_data = (
-            user_bills
-            .values('category')
-            .annotate(
-                total=models.Sum('amount'),
-                count=models.Count('id'),
-                avg=models.Avg('amount')
+        category_data = figures['by_category']
+        if archived.exists():
+            category_data = sorted(
+                with_archived(category_data, archived.values('category').annotate(
+                    total=models.Sum('total'), count=models.Sum('count')
+                ), 'category'),
+                key=lambda row: row['total'], reverse=True
             )
-            .order_by('-total')
-        )
         
         if category_data:
             top_category = category_data[0]
@@ -297,20 +704,8 @@ class InsightsView(APIView):
                 })
         
         # Recent spending trends
-        from datetime import datetime, timedelta
-        now = datetime.now()
-        last_30_days = now - timedelta(days=30)
-        prev_30_days = now - timedelta(days=60)
-        
-        recent_spending = user_bills.filter(created_at__gte=last_30_days).aggregate(
-            total=models.Sum('amount')
-        )['total'] or 0
-        
-        previous_spending = user_bills.filter(
-            created_at__gte=prev_30_days, created_at__lt=last_30_days
-        ).aggregate(
-            total=models.Sum('amount')
-        )['total'] or 0
+        recent_spending = figures['recent']
+        previous_spending = figures['previous']
         
         if previous_spending > 0:
             change_percentage = ((recent_spending - previous_spending) / previous_spending) * 100
@@ -330,35 +725,31 @@ class InsightsView(APIView):
                 })
         
         # Debt analysis
-        from .views import BalancesView
-        balances_view = BalancesView()
-        balances_view.request = request
-        balances_response = balances_view.get(request)
-        balances = balances_response.data
+        balances = BalancesView().balances(request)
         
         total_debt = sum(amount for amount in balances.values() if amount < 0)
         total_owed = sum(amount for amount in balances.values() if amount > 0)
         
-        if abs(total_debt) > 100:  # If owing more than ₹100
+        # BalancesView answered in the viewer's currency too
+        threshold = float(convert(100))
+        if abs(total_debt) > threshold:  # If owing more than ₹100
             insights.append({
                 'type': 'debt',
                 'title': '💳 Outstanding Debts',
-                'message': f'You owe ₹{abs(total_debt):.2f} to friends. Consider settling some payments.',
+                'message': f'You owe {sign}{abs(total_debt):.2f} to friends. Consider settling some payments.',
                 'priority': 'medium'
             })
         
-        if total_owed > 100:  # If owed more than ₹100
+        if total_owed > threshold:  # If owed more than ₹100
             insights.append({
                 'type': 'credit',
                 'title': '💰 Money Owed to You',
-                'message': f'Friends owe you ₹{total_owed:.2f}. You might want to remind them about pending payments.',
+                'message': f'Friends owe you {sign}{total_owed:.2f}. You might want to remind them about pending payments.',
                 'priority': 'low'
             })
         
         # Activity insights
-        bills_this_week = user_bills.filter(
-            created_at__gte=now - timedelta(days=7)
-        ).count()
+        bills_this_week = figures['this_week']
         
         if bills_this_week == 0:
             insights.append({
@@ -375,8 +766,95 @@ class InsightsView(APIView):
                 'priority': 'low'
             })
         
+        # Budgets: the running totals make this one query
+        for budget in Budget.objects.filter(user=user).annotate(spent=spent_this_month()):
+            status = budget_status(budget.spent, budget.limit, budget.alert_at)
+            if status == 'over':
+                insights.append({
+                    'type': 'budget',
+                    'title': f'🚨 {budget.category.title()} Budget Exceeded',
+                    'message': f'You have spent {sign}{convert(budget.spent):.2f} of your {sign}{convert(budget.limit):.2f} {budget.category} budget this month.',
+                    'priority': 'high'
+                })
+            elif status == 'warning':
+                insights.append({
+                    'type': 'budget',
+                    'title': f'⚠️ {budget.category.title()} Budget Almost Used',
+                    'message': f'You have used {budget.spent / budget.limit * 100:.0f}% of your {budget.category} budget this month.',
+                    'priority': 'medium'
+                })
+
         # Sort insights by priority
         priority_order = {'high': 3, 'medium': 2, 'low': 1}
         insights.sort(key=lambda x: priority_order.get(x['priority'], 0), reverse=True)
         
-        return Response({'insights': insights[:5]})  # Return top 5 insights
\ No newline at end of file
+        return Response({'insights': insights[:5]})  # Return top 5 insights
+
+    def shard_figures(self, user, now, last_30_days, prev_30_days):
+        from datetime import timedelta
+        user_bills = Bill.objects.filter(participants=user)
+        value = base_value()
+        return {
+            'count': user_bills.count(),
+            'by_category': list(
+                user_bills.values('category')
+                .annotate(total=models.Sum(value), count=models.Count('id'), avg=models.Avg(value))
+                .order_by('-total')
+            ),
+            'recent': user_bills.filter(created_at__gte=last_30_days).aggregate(total=models.Sum(value))['total'] or 0,
+            'previous': user_bills.filter(
+                created_at__gte=prev_30_days, created_at__lt=last_30_days
+            ).aggregate(total=models.Sum(value))['total'] or 0,
+            'this_week': user_bills.filter(created_at__gte=now - timedelta(days=7)).count(),
+        }
+
+    def merge_figures(self, figures, other):
+        return {
+            'count': figures['count'] + other['count'],
+            'by_category': sorted(
+                with_archived(figures['by_category'], other['by_category'], 'category'),
+                key=lambda row: row['total'], reverse=True
+            ),
+            'recent': figures['recent'] + other['recent'],
+            'previous': figures['previous'] + other['previous'],
+            'this_week': figures['this_week'] + other['this_week'],
+        }
+
+
+class BudgetListCreateView(generics.ListCreateAPIView):
+    serializer_class = BudgetSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Budget.objects.filter(user=self.request.user).annotate(spent=spent_this_month()).order_by('category')
+
+    def perform_create(self, serializer):
+        # One budget per category: posting again replaces the limit
+        budget, _ = Budget.objects.update_or_create(
+            user=self.request.user, category=serializer.validated_data['category'],
+            defaults={
+                'limit': serializer.validated_data['limit'],
+                'alert_at': serializer.validated_data.get('alert_at', 80),
+            },
+        )
+        serializer.instance = self.get_queryset().get(pk=budget.pk)
+
+
+class BudgetDetailView(generics.RetrieveUpdateDestroyAPIView):
+    serializer_class = BudgetSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Budget.objects.filter(user=self.request.user).annotate(spent=spent_this_month())
+
+    def perform_update(self, serializer):
+        budget = serializer.save()
+        serializer.instance = self.get_queryset().get(pk=budget.pk)
+
+
+class BudgetAlertListView(generics.ListAPIView):
+    serializer_class = BudgetAlertSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return BudgetAlert.objects.filter(user=self.request.user).order_by('-created_at')